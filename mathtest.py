@@ -23,27 +23,449 @@
 #
 import sys
 import argparse
-import copy
+import codecs
 import os
-from random import randint
+import select
+from array import array
+from collections import OrderedDict, deque
+from operator import add, sub, mul, mod, truediv
+from random import randint, shuffle
 from time import time
 
+try:
+    from time import monotonic, perf_counter
+except ImportError:  # Python 2
+    from time import time as monotonic, time as perf_counter
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 if sys.version_info.major == 2:
     print("This will run in Python 2 but with some problems.\n\t* You've been warned *")
-    if os.name == 'nt':
-        operator_translation = {ord('*'): u"x", ord('/'): u"÷"}
-    else:
-        operator_translation = {ord('*'): u"×", ord('/'): u"÷"}
 else:
     raw_input = input
     unicode = str
-    operator_translation = str.maketrans("*/", "×÷")
+
+
+# functions called as listener(event, data) for events in the test engine, e.g. to collect metrics:
+#   "question"  a new question was generated               data: question
+#   "answer"    a question was scored                      data: question, outcome (right, wrong or skip)
+#   "render"    a display or visualization string was made  data: name, seconds
+listeners = []
+
+
+def _notify(event, **data):
+    for listener in listeners:
+        listener(event, data)
+
+
+class Operator(object):
+    """
+    One kind of question, e.g. addition.  Everything the test needs to know about an operator lives here:
+    how to work out the answer, which numbers to ask about, how to show it and which constraints apply to it.
+    Add new operators with register_operator.
+    """
+    def __init__(self, symbol, name, evaluate, first_range, second_range, **kwargs):
+        """
+        :param symbol: One character typed for the operator, e.g. "+"
+        :param name: What the operator is called, e.g. "addition"
+        :param evaluate: Function taking the first and second number and returning the whole number answer.
+                         Raises ZeroDivisionError if the answer is undefined.
+        :param first_range: (low, high) of first numbers asked, not including high
+        :param second_range: (low, high) of second numbers asked, not including high
+        :param glyph: Optional character shown for the operator.  Default is the symbol.
+        :param divisor: The second number can't be zero.  Default False.
+        :param exact: The first number must be a multiple of the second, so the answer has no remainder.
+                      Default False.
+        :param generate: Optional function(first_range, second_range, **kwargs) returning a random first and second
+                         number.
+                         first_number and second_number in kwargs are used if given.  Default picks from the ranges.
+        :param pairs: Optional function(first_range, second_range) yielding every first and second number to ask.
+                      Default is every pair from the ranges.
+        :param visualize: Optional function taking a Question and returning a picture of it as a string
+        :param operands: Optional function taking a Question and returning the numbers that count as its factors
+                         for the no_zero_one constraint.  Default is the first and second number.
+        :param in_tables: Questions belong to times tables, so the table setting applies.  Default False.
+        :param constraints: Optional dictionary of named constraints that apply to this operator.
+                            Other operators always pass them.
+        :param batch: Optional function(first_numbers, second_numbers, missing) returning the list of answers
+                      for whole lists of numbers at once, with missing for undefined answers.  Used to build the
+                      answer key; the default calls evaluate for each pair.
+        """
+        self.symbol = symbol
+        self.name = name
+        self.evaluate = evaluate
+        self.first_range = first_range
+        self.second_range = second_range
+        self.glyph = kwargs.get("glyph", symbol)
+        self.divisor = kwargs.get("divisor", False)
+        self.exact = kwargs.get("exact", False)
+        self.generate = kwargs.get("generate", _generate_from_ranges)
+        self.pairs = kwargs.get("pairs", _every_pair)
+        self.visualize = kwargs.get("visualize")
+        self.operands = kwargs.get("operands", _first_and_second)
+        self.in_tables = kwargs.get("in_tables", False)
+        self.constraints = kwargs.get("constraints", {})
+        self.batch = kwargs.get("batch", self._batch)
+
+    def __repr__(self):
+        return "Operator({!r}, {!r})".format(self.symbol, self.name)
+
+    def _batch(self, first_numbers, second_numbers, missing=None):
+        answers = []
+        for first_number, second_number in zip(first_numbers, second_numbers):
+            try:
+                answers.append(self.evaluate(first_number, second_number))
+            except ZeroDivisionError:
+                answers.append(missing)
+        return answers
+
+
+def _generate_from_ranges(first_range, second_range, **kwargs):
+    first_number = kwargs.get("first_number", randint(first_range[0], first_range[1] - 1))
+    second_number = kwargs.get("second_number", randint(second_range[0], second_range[1] - 1))
+    return first_number, second_number
+
+
+def _every_pair(first_range, second_range):
+    for first_number in range(*first_range):
+        for second_number in range(*second_range):
+            yield first_number, second_number
+
+
+def _first_and_second(question):
+    return question.first_number, question.second_number
+
+
+operators = OrderedDict()  # symbol -> Operator, in the order they were registered
+operator_codes = {}  # symbol -> code used to index the answer key
+operator_symbols = []  # code -> symbol
+operator_translation = {}  # for unicode.translate; symbol -> glyph where they differ
+
+
+def register_operator(operator):
+    """
+    Make an Operator available to questions, tests and the command line.
+    Registering a symbol again replaces the operator but keeps its code.
+    Register operators before the answer key is built (the first time an answer is looked up) so they are in it.
+    :param operator: Operator
+    :return: The operator
+    """
+    if operator.symbol not in operator_codes:
+        operator_codes[operator.symbol] = len(operator_symbols)
+        operator_symbols.append(operator.symbol)
+    operators[operator.symbol] = operator
+    if operator.glyph != operator.symbol:
+        operator_translation[ord(operator.symbol)] = unicode(operator.glyph)
+    else:
+        operator_translation.pop(ord(operator.symbol), None)
+    for name in operator.constraints:
+        constraint_rules.setdefault(name, _operator_rule(name))
+    return operator
+
+
+def _operator_rule(name):
+    """
+    A constraint that checks each question with its operator's rule of this name; operators without one pass.
+    """
+    def rule(question):
+        check = operators[question.operator].constraints.get(name)
+        return check is None or check(question)
+    rule.__name__ = name
+    return rule
+
+
+def _evaluate(operator, first_number, second_number):
+    """
+    Work out the answer to an equation.  Division is truncated to a whole number.
+    """
+    return operators[operator].evaluate(first_number, second_number)
+
+
+class AnswerKey(object):
+    """
+    A dense table of correct answers for every operator code and every pair of small operands.
+    Looking up an answer is a single index into the table.  Anything outside the table is worked out instead.
+    """
+    MISSING = -2 ** 31  # marks entries with no answer (division by zero)
+
+    def __init__(self, first_limit=100, second_limit=20, table=None):
+        """
+        :param first_limit: First numbers from 0 up to (not including) this are in the table
+        :param second_limit: Second numbers from 0 up to (not including) this are in the table
+        :param table: Optional existing table (array or memoryview of 'i') to use instead of building one
+        """
+        self.first_limit = first_limit
+        self.second_limit = second_limit
+        self.stride = first_limit * second_limit
+        if table is None:
+            table = array('i')
+            first_numbers = [first_number for first_number in range(first_limit) for _ in range(second_limit)]
+            second_numbers = list(range(second_limit)) * first_limit
+            for symbol in operator_symbols:
+                answers = operators[symbol].batch(first_numbers, second_numbers, self.MISSING)
+                try:
+                    table.extend(array('i', answers))
+                except OverflowError:  # e.g. large powers; they're worked out when asked for instead
+                    table.extend(array('i', [answer if self.MISSING < answer < -self.MISSING else self.MISSING
+                                             for answer in answers]))
+        self.table = table
+        self.operator_count = len(table) // self.stride
+
+    @classmethod
+    def frombuffer(cls, buffer, first_limit=100, second_limit=20):
+        """
+        Use a table made by tobytes without copying it, e.g. from shared memory or an mmap'd file.
+        """
+        return cls(first_limit, second_limit, table=memoryview(buffer).cast('i'))
+
+    def tobytes(self):
+        """
+        Return the table as bytes so it can be saved or shared with other processes.
+        """
+        return bytes(self.table) if isinstance(self.table, memoryview) else self.table.tobytes()
+
+    def _index(self, code, first_number, second_number):
+        return code * self.stride + first_number * self.second_limit + second_number
+
+    def lookup(self, operator, first_number, second_number):
+        """
+        Return the correct answer to an equation.
+        Raises ZeroDivisionError when dividing by zero.
+        """
+        code = operator_codes.get(operator)
+        if code is not None and code < self.operator_count and 0 <= first_number < self.first_limit \
+                and 0 <= second_number < self.second_limit:
+            answer = self.table[self._index(code, first_number, second_number)]
+            if answer != self.MISSING:
+                return answer
+        return _evaluate(operator, first_number, second_number)
+
+
+answer_key = None  # built the first time it's needed; see _default_answer_key
+
+
+def _default_answer_key():
+    """
+    Build the module answer key unless another one (e.g. from shared memory) was installed first.
+    """
+    global answer_key
+    if answer_key is None:
+        answer_key = AnswerKey()
+    return answer_key
+
+
+class ConsoleIO(object):
+    """
+    Ask questions on the terminal.  This is the default way Question and Test talk to the user.
+    Other backends override write and read_line.
+    """
+    def write(self, text):
+        """
+        Show text without adding a new line.
+        """
+        sys.stdout.write(text)
+
+    def writeline(self, text=''):
+        """
+        Show text followed by a new line, like print().
+        """
+        self.write(u"{}\n".format(text))
+
+    def read_line(self, prompt='', timeout=None):
+        """
+        Show the prompt and return the line the user typed, without the new line.
+        Raises EOFError when there is no more input.
+        :param timeout: Optional seconds to wait.  Returns None if nothing was typed in time.
+        """
+        if timeout is None or os.name == 'nt':  # select can't wait on the console on Windows
+            return raw_input(prompt)
+        self.write(prompt)
+        sys.stdout.flush()
+        if not select.select([sys.stdin], [], [], timeout)[0]:
+            self.writeline('')
+            return None
+        line = sys.stdin.readline()
+        if not line:
+            raise EOFError
+        return line.rstrip(u'\r\n')
+
+    def attach(self, test):
+        """
+        Called when a Test starts using this backend.
+        """
+        pass
+
+    def show_score(self, test, **kwargs):
+        """
+        Show the score of a test.  Backends with a scoreboard can draw it in place instead.
+        :param kwargs: keyword arguments to pass Test.display_string
+        """
+        self.writeline(test.display_string(**kwargs))
+
+    def close(self):
+        """
+        Finish showing output, e.g. flush buffers or restore the terminal.
+        """
+        pass
+
+
+class PipeIO(ConsoleIO):
+    """
+    Read answers from a pipe or file many at a time instead of one line per read.
+    Output is buffered until more input is needed so prompts still show up before blocking.
+    """
+    def __init__(self, in_stream=None, out_stream=None, chunk_size=65536):
+        self.in_stream = in_stream or sys.stdin
+        self.out_stream = out_stream or sys.stdout
+        self.chunk_size = chunk_size
+        self.lines = deque()
+        self._partial = u''
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._output = []
+        self._eof = False
+
+    def write(self, text):
+        self._output.append(text)
+
+    def flush(self):
+        """
+        Write everything buffered so far to the output stream.
+        """
+        if self._output:
+            self.out_stream.write(u''.join(self._output))
+            self.out_stream.flush()
+            del self._output[:]
+
+    def close(self):
+        self.flush()
+
+    def _fill(self):
+        """
+        Read one chunk from the input and split it into complete lines.
+        """
+        data = os.read(self.in_stream.fileno(), self.chunk_size)
+        if not data:
+            self._eof = True
+            data = self._partial + self._decoder.decode(b'', True)
+            self._partial = u''
+            if data:
+                self.lines.append(data)
+            return
+        lines = (self._partial + self._decoder.decode(data)).split(u'\n')
+        self._partial = lines.pop()
+        self.lines.extend(line.rstrip(u'\r') for line in lines)
+
+    def read_line(self, prompt='', timeout=None):
+        self.write(prompt)
+        deadline = None if timeout is None else monotonic() + timeout
+        while len(self.lines) == 0:
+            if self._eof:
+                self.flush()
+                raise EOFError
+            self.flush()
+            if deadline is not None and not select.select([self.in_stream], [], [],
+                                                          max(0.0, deadline - monotonic()))[0]:
+                return None
+            self._fill()
+        return self.lines.popleft()
+
+
+class ScriptedIO(ConsoleIO):
+    """
+    Answer questions from a list of lines, e.g. to replay a recorded session.  Output is kept in self.output.
+    """
+    def __init__(self, answers, echo=False):
+        """
+        :param answers: Iterable of answer strings, one per prompt
+        :param echo: Also print the output and answers to the screen
+        """
+        self.answers = iter(answers)
+        self.echo = echo
+        self.output = []
+
+    def write(self, text):
+        self.output.append(text)
+        if self.echo:
+            sys.stdout.write(text)
+
+    def read_line(self, prompt='', timeout=None):
+        self.write(prompt)
+        answer = next(self.answers, None)
+        if answer is None:
+            raise EOFError
+        if self.echo:
+            sys.stdout.write(u"{}\n".format(answer))
+        return answer
+
+
+default_operators = ["/", "*", "+", "-"]  # shared by every Question; assign a new list instead of changing it
+
+
+class Fact(object):
+    """
+    The two numbers and operator of a question.  Facts can't be changed, so equal facts are the same object:
+    Fact(6, '*', 7) is Fact(6, '*', 7).  They can be used in sets and as dictionary keys.
+    """
+    __slots__ = ("first_number", "operator", "second_number", "_hash")
+    _interned = {}  # (first_number, operator, second_number) -> Fact
+
+    def __new__(cls, first_number=None, operator=None, second_number=None):
+        key = (first_number, operator, second_number)
+        fact = cls._interned.get(key)
+        if fact is None:
+            fact = object.__new__(cls)
+            object.__setattr__(fact, "first_number", first_number)
+            object.__setattr__(fact, "operator", operator)
+            object.__setattr__(fact, "second_number", second_number)
+            object.__setattr__(fact, "_hash", hash(key))
+            fact = cls._interned.setdefault(key, fact)
+        return fact
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Facts can't be changed; make a new Fact instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("Facts can't be changed; make a new Fact instead")
+
+    def __reduce__(self):
+        # unpickling and copying go through __new__ so the result is interned too
+        return Fact, (self.first_number, self.operator, self.second_number)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if type(other) is not Fact:
+            return False
+        return self is other or (self.first_number == other.first_number and self.operator == other.operator
+                                 and self.second_number == other.second_number)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Fact({!r}, {!r}, {!r})".format(self.first_number, self.operator, self.second_number)
+
+    def __str__(self):
+        return "{n.first_number} {n.operator} {n.second_number} = ".format(n=self)
+
+    @property
+    def correct_answer(self):
+        if self.first_number is None or self.second_number is None or self.operator not in operators:
+            return None
+        return (answer_key or _default_answer_key()).lookup(self.operator, self.first_number, self.second_number)
 
 
 class Question(object):
     """
-    A single math question that has two numbers and an operator between them.
+    One attempt at a math question: a Fact plus the user's answer and how long it took.
+    Changing the numbers or operator replaces the Fact, so Facts can be shared between any number of Questions.
     """
+    __slots__ = ("fact", "user_answer", "elapsed", "valid_operators")
+
     def __init__(self, **kwargs):
         """
         Create an empty Question object or supply keyword elements.
@@ -53,28 +475,58 @@ class Question(object):
         :param operator: The operator for the math question
         :param first_number: The first number displayed on screen
         :param second_number: The second number displayed on screen
+        :param fact: A Fact to use instead of operator, first_number and second_number
         :param user_answer: The answer that the user gave
         :param correct_answer: The correct answer (should let the program decide)
         :param valid_operators: A list of operators that are allowed in this question
+        :param elapsed: Seconds the user took to answer
         """
-        self.operator = kwargs.get("operator")
-        self.first_number = kwargs.get("first_number")
-        self.second_number = kwargs.get("second_number")
+        self.fact = kwargs.get("fact") or Fact(kwargs.get("first_number"), kwargs.get("operator"),
+                                               kwargs.get("second_number"))
         self.user_answer = kwargs.get("user_answer")
-        self.valid_operators = kwargs.get("valid_operators", ["/", "*", "+", "-"])
+        self.elapsed = kwargs.get("elapsed")
+        self.valid_operators = kwargs.get("valid_operators", default_operators)
+
+    @property
+    def operator(self):
+        return self.fact.operator
+
+    @operator.setter
+    def operator(self, operator):
+        self.fact = Fact(self.fact.first_number, operator, self.fact.second_number)
+
+    @property
+    def first_number(self):
+        return self.fact.first_number
+
+    @first_number.setter
+    def first_number(self, first_number):
+        self.fact = Fact(first_number, self.fact.operator, self.fact.second_number)
+
+    @property
+    def second_number(self):
+        return self.fact.second_number
+
+    @second_number.setter
+    def second_number(self, second_number):
+        self.fact = Fact(self.fact.first_number, self.fact.operator, second_number)
 
     def __str__(self):
-        formula = "{n.first_number} {n.operator} {n.second_number} = ".format(n=self)
-        return formula
+        return str(self.fact)
 
     def __eq__(self, other):
         if type(other) is type(self):
-            return self.first_number == other.first_number \
-                   and self.operator == other.operator \
-                   and self.second_number == other.second_number
+            return self.fact == other.fact
         else:
             return False
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # questions hash by their fact; don't change the numbers of a question while it's in a set or dict
+        return hash(self.fact)
+
     def _check(self):
         """
         Ensure all properties are set properly.
@@ -96,31 +548,19 @@ class Question(object):
         :param second_number: Optionally specify the second number in equation
         """
         self.valid_operators = kwargs.get("valid_operators", self.valid_operators)
-        self.operator = kwargs.get("operator", self.valid_operators[randint(0, len(self.valid_operators) - 1)])
-        # multiplication generates [0-9] * [0-9]
-        if self.operator == "*":
-            self.first_number = kwargs.get("first_number", randint(0, 9))
-            self.second_number = kwargs.get("second_number", randint(0, 9))
-        # division chooses numbers that will only divide evenly; won't divide by zero
-        elif self.operator == "/":
-            self.second_number = kwargs.get("second_number", randint(1, 9))
-            self.first_number = kwargs.get("first_number", self.second_number * randint(0, 9))
-            # if the user wants the second number to be zero and the operator is division
-            # raise the error now. dev can handle this how they see fit. still sets the first number.
-            if self.second_number == 0:
-                raise ZeroDivisionError  # "Second number is zero in division equation."
-        elif self.operator == "+":
-            self.first_number = kwargs.get("first_number", randint(0, 19))
-            self.second_number = kwargs.get("second_number", randint(0, 19))
-        # subtraction chooses numbers that only result in positive answers (or 0)
-        elif self.operator == "-":
-            self.first_number = kwargs.get("first_number", randint(4, 19))
-            self.second_number = kwargs.get("second_number", randint(0, self.first_number))
+        operator = kwargs.get("operator", self.valid_operators[randint(0, len(self.valid_operators) - 1)])
+        first_number, second_number = operators[operator].generate(
+            operators[operator].first_range, operators[operator].second_range, **kwargs)
+        self.fact = Fact(first_number, operator, second_number)
+        # if the user wants the second number to be zero and the operator divides by it
+        # raise the error now. dev can handle this how they see fit. still sets the numbers.
+        if operators[operator].divisor and second_number == 0:
+            raise ZeroDivisionError  # "Second number is zero in division equation."
 
     @property
     def correct_answer(self):
         if self._check():
-            return int(eval("{}".format(self.__str__().replace('=', ''))))
+            return self.fact.correct_answer
         else:
             return None
 
@@ -153,48 +593,18 @@ class Question(object):
         """
         Reset values to None.
         """
-        self.operator = None
-        self.first_number = None
-        self.second_number = None
+        self.fact = Fact()
         self.user_answer = None
-
-    def _visualize_add_sub(self):
-        return_string = ''
-        for number in (self.first_number, self.second_number):
-            return_string += "{number:<3} {stars}\n".format(number="{}:".format(number), stars='* ' * number)
-        return return_string.rstrip()
-
-    def _visualize_mul_div(self):
-        return_string = ''
-        if self.operator == '*':
-            num2 = self.first_number
-            num1 = self.second_number
-        if self.operator == '/':
-            num1 = self.correct_answer
-            num2 = self.second_number
-
-        # print column titles
-        return_string += "   "
-        for y in range(num1):
-            return_string += "{:^3}".format(y+1 if self.operator == '*' else '*')
-        return_string += "\n"
-
-        for y in range(num2):
-            return_string += "{row_number}: ".format(row_number=y+1)
-            for x in range(num1):
-                display = (x+(y*num1))+1 if self.operator == '/' else '*'
-                return_string += "{number:^3}".format(number=display)
-            return_string += '\n'
-
-        return return_string
+        self.elapsed = None
 
     def visualize_string(self):
-
-        if self._check():
-            if self.operator in '+-':
-                return self._visualize_add_sub()
-            if self.operator in '*/':
-                return self._visualize_mul_div()
+        start = time()
+        visualize_string = None
+        if self._check() and operators[self.operator].visualize is not None:
+            visualize_string = operators[self.operator].visualize(self)
+        if listeners:
+            _notify("render", name="visualize_string", seconds=time() - start)
+        return visualize_string
 
     def visualize(self):
         """
@@ -208,42 +618,220 @@ class Question(object):
         :param operator (Optional): specify specific operator when generating a random question
         :param first_number (Optional): specify constant first number when generating a random question
         :param second_number (Optional): specify constant second number when generating a random question
+        :param io (Optional): ConsoleIO (or other backend) to ask the question with
+        :param deadline (Optional): time.monotonic() time to stop waiting for an answer.  The question is skipped
+                                    if it isn't answered by then.
+        :return: True if the time ran out before it was answered
         """
-        valid = False
+        io = kwargs.get("io") or ConsoleIO()
+        steps = self._prompt_steps(**dict(kwargs, io=io))
+        text, wait = next(steps)
+        while text is not None:
+            text, wait = steps.send(io.read_line(text) if wait is None else io.read_line(text, timeout=wait))
+        return wait  # the last step says whether the time ran out
 
+    def _prompt_steps(self, **kwargs):
+        """
+        Everything prompt does except wait for the answer, so other loops (e.g. mathtest_aio) can wait their own way.
+        Yields a tuple of the text to read a line with and the seconds to wait (None for no limit) and is sent the
+        line read, None if the time ran out.  Last it yields None and whether the time ran out (None if the question
+        couldn't be asked).
+        :param io: Backend to write messages with
+        """
+        io = kwargs["io"]
         # if the question is missing any portions, generate new question
         if not self._check():
             self.generate_rand_question(**kwargs)
 
-        if self._check():
-            if kwargs.get("visualize"):
-                self.visualize()
-                print("")
-            while not valid:
-                try:
-                    sys.stdout.write(self.human_readable())
-                    self.user_answer = raw_input()
-                    if self.user_answer == '':
-                        pass  # put on skipped stack
-                    else:
-                        self.user_answer = int(self.user_answer)
-                    valid = True
-                except ValueError:
-                    print("Invalid answer: Try again!")
-                    continue
-        else:
+        if not self._check():
             self.user_answer = None
+            yield None, None
+            return
+        if kwargs.get("visualize"):
+            io.writeline(self.visualize_string())
+            io.writeline("")
+        deadline = kwargs.get("deadline")
+        timed_out = False
+        start = perf_counter()
+        while True:
+            if deadline is None:
+                answer = yield self.human_readable(), None
+            else:
+                remaining = deadline - monotonic()
+                answer = (yield self.human_readable(), remaining) if remaining > 0 else None
+                if answer is None:
+                    timed_out = True
+                    answer = ''
+            if answer == '':
+                self.user_answer = answer  # put on skipped stack
+                break
+            try:
+                self.user_answer = int(answer)
+                break
+            except ValueError:
+                io.writeline("Invalid answer: Try again!")
+        self.elapsed = perf_counter() - start
+        yield None, timed_out
+
+
+def _no_carrying(question):
+    """
+    Addition where no column of digits adds up to more than 9.
+    """
+    first, second = question.first_number, question.second_number
+    while first > 0 or second > 0:
+        if first % 10 + second % 10 > 9:
+            return False
+        first //= 10
+        second //= 10
+    return True
+
+
+def _no_borrowing(question):
+    """
+    Subtraction where every digit of the first number is at least the digit below it.
+    """
+    first, second = question.first_number, question.second_number
+    while first > 0 or second > 0:
+        if first % 10 < second % 10:
+            return False
+        first //= 10
+        second //= 10
+    return True
+
+
+def _no_zero_one(question):
+    """
+    Exclude facts where a factor, divisor or quotient is 0 or 1 (and addends or subtrahends for + and -).
+    """
+    return all(number not in (0, 1) for number in operators[question.operator].operands(question))
+
+
+# named constraints that can be passed with the "constraints" keyword; operators add their own when registered
+constraint_rules = {
+    "no_zero_one": _no_zero_one,
+}
+
+
+def _visualize_add_sub(question):
+    return_string = ''
+    for number in (question.first_number, question.second_number):
+        return_string += "{number:<3} {stars}\n".format(number="{}:".format(number), stars='* ' * number)
+    return return_string.rstrip()
+
+
+def _visualize_mul_div(question):
+    return_string = ''
+    if question.operator == '*':
+        num2 = question.first_number
+        num1 = question.second_number
+    if question.operator == '/':
+        num1 = question.correct_answer
+        num2 = question.second_number
+
+    # print column titles
+    return_string += "   "
+    for y in range(num1):
+        return_string += "{:^3}".format(y+1 if question.operator == '*' else '*')
+    return_string += "\n"
+
+    for y in range(num2):
+        return_string += "{row_number}: ".format(row_number=y+1)
+        for x in range(num1):
+            display = (x+(y*num1))+1 if question.operator == '/' else '*'
+            return_string += "{number:^3}".format(number=display)
+        return_string += '\n'
+
+    return return_string
+
+
+def _visualize_remainder(question):
+    # share the first number out in rows of the second number; the short row left over is the remainder
+    return_string = ''
+    for row, start in enumerate(range(0, question.first_number, question.second_number)):
+        stars = min(question.second_number, question.first_number - start)
+        return_string += "{number:<3} {stars}\n".format(number="{}:".format(row + 1), stars='* ' * stars)
+    return return_string.rstrip()
+
+
+def _visualize_power(question):
+    return question.human_readable() + (" * ".join([str(question.first_number)] * question.second_number) or "1")
+
+
+# subtraction chooses numbers that only result in positive answers (or 0)
+def _generate_subtraction(first_range, second_range, **kwargs):
+    first_number = kwargs.get("first_number", randint(first_range[0], first_range[1] - 1))
+    second_number = kwargs.get("second_number", randint(second_range[0], first_number))
+    return first_number, second_number
+
+
+def _subtraction_pairs(first_range, second_range):
+    for first_number in range(*first_range):
+        for second_number in range(second_range[0], first_number + 1):
+            yield first_number, second_number
+
+
+# division chooses numbers that will only divide evenly; the first range is the answers (quotients)
+def _generate_division(first_range, second_range, **kwargs):
+    second_number = kwargs.get("second_number", randint(second_range[0], second_range[1] - 1))
+    first_number = kwargs.get("first_number", second_number * randint(first_range[0], first_range[1] - 1))
+    return first_number, second_number
+
+
+def _division_pairs(first_range, second_range):
+    for quotient in range(*first_range):
+        for second_number in range(*second_range):
+            yield quotient * second_number, second_number
+
+
+def _divide(first_number, second_number):
+    return int(truediv(first_number, second_number))
+
+
+def _batch_kernel(function):
+    """
+    Answers for whole lists of numbers with a function that's never undefined, e.g. add.
+    """
+    def batch(first_numbers, second_numbers, missing=None):
+        return list(map(function, first_numbers, second_numbers))
+    return batch
+
+
+register_operator(Operator("+", "addition", add, (0, 20), (0, 20), visualize=_visualize_add_sub,
+                           constraints={"no_carrying": _no_carrying}, batch=_batch_kernel(add)))
+register_operator(Operator("-", "subtraction", sub, (4, 20), (0, 20), generate=_generate_subtraction,
+                           pairs=_subtraction_pairs, visualize=_visualize_add_sub,
+                           constraints={"no_borrowing": _no_borrowing}, batch=_batch_kernel(sub)))
+register_operator(Operator("*", "multiplication", mul, (0, 10), (0, 10),
+                           glyph=u"x" if sys.version_info.major == 2 and os.name == 'nt' else u"×",
+                           visualize=_visualize_mul_div, in_tables=True, batch=_batch_kernel(mul)))
+register_operator(Operator("/", "division", _divide, (0, 10), (1, 10), glyph=u"÷", divisor=True, exact=True,
+                           generate=_generate_division, pairs=_division_pairs, visualize=_visualize_mul_div,
+                           operands=lambda question: (question.second_number, question.correct_answer),
+                           in_tables=True))
+register_operator(Operator("%", "remainders", mod, (0, 20), (1, 10), divisor=True, visualize=_visualize_remainder))
+register_operator(Operator("^", "exponents", pow, (0, 10), (0, 4), visualize=_visualize_power))
 
 
 class Test(object):
     """
     Track multiple questions and log right and wrong answers.  Display results at the end of the test.
     """
+    _fact_index_cache = OrderedDict()  # shared by every Test, least recently used first; see _fact_index
+    _fact_index_cache_size = 32  # configurations kept; constraint functions made on the fly each get their own
+
     def __init__(self, **kwargs):
         self.right = []
         self.wrong = []
         self.skip = []
         self.question = Question(**kwargs)
+        self.position = 0  # number of questions get_questions has handed out
+        self.remaining = []  # Facts not yet asked this round when questions are unique
+        self.bank = None  # question bank get_questions is asking from, for the rows it rejected
+        self._bank_questions = None  # iterator over self.bank, where get_questions has got to
+        self.io = kwargs.get("io") or ConsoleIO()
+        self.io.attach(self)
+        self.time_used = None  # seconds a timed test took; see run_timed
 
     def __str__(self):
         return self.display_string()
@@ -260,6 +848,16 @@ class Test(object):
         else:
             return 0
 
+    @property
+    def facts_per_minute(self):
+        """
+        Right answers per minute of a timed test.
+        :return: Float or None if the test wasn't timed
+        """
+        if not self.time_used:
+            return None
+        return len(self.right) * 60.0 / self.time_used
+
     def reset(self):
         """
         Reset the results of the test by clearing the list of right and wrong answers.
@@ -281,11 +879,11 @@ class Test(object):
         """
         valid_operator_list = []
         for operator in operator_list:
-            if operator in Question().valid_operators:
+            if operator in operators:
                 valid_operator_list.append(operator)
         if len(valid_operator_list) == 0:
             print("List of supplied operators doesn't contain any valid operators! ({})".format(operator_list))
-            print("The valid list of operators is: {}".format(Question().valid_operators))
+            print("The valid list of operators is: {}".format(list(operators)))
             exit(9)
         self.question.valid_operators = valid_operator_list
 
@@ -295,16 +893,51 @@ class Test(object):
         Does nothing if the question isn't answered.
         """
         if self.question.user_answer is not None:
-            if str(self.question.user_answer) == '':
-                self.skip.append(copy.deepcopy(self.question))
+            # the answered question goes on a list as it is; later questions are asked with a new one
+            question = self.question
+            self.question = Question(valid_operators=question.valid_operators)
+            if str(question.user_answer) == '':
+                self.skip.append(question)
+                if listeners:
+                    _notify("answer", question=question, outcome="skip")
                 return "Skipped!\n"
-            elif self.question.user_answer_correct:
-                self.right.append(copy.deepcopy(self.question))
+            elif question.user_answer_correct:
+                self.right.append(question)
+                if listeners:
+                    _notify("answer", question=question, outcome="right")
                 return "Correct!\n"
             else:
-                self.wrong.append(copy.deepcopy(self.question))
-                return "Wrong! ({})\n".format(self.question.correct_answer)
-            self.question.reset()
+                self.wrong.append(question)
+                if listeners:
+                    _notify("answer", question=question, outcome="wrong")
+                return "Wrong! ({})\n".format(question.correct_answer)
+
+    @staticmethod
+    def _row_blocks(equation_list, columns=16, showing_answers=True, user_answers=True):
+        """
+        Lay out a list of equations in a grid of 5 character cells.  Used by _rows_str and printed worksheets.
+        :param equation_list: List of Questions
+        :param columns: Optional number of equations per row.  Default is 16.
+        :param showing_answers: Add a line of correct answers if any answer is wrong
+        :param user_answers: Show the user's answers; False leaves the answer line blank (e.g. for a worksheet)
+        :yields: List of lines for each row of equations; each line is a list of cells
+        """
+        highs = [x.first_number for x in equation_list]
+        ops = [x.operator for x in equation_list]
+        lows = [x.second_number for x in equation_list]
+        answers = [x.user_answer if user_answers else None for x in equation_list]
+        correct = [x.correct_answer for x in equation_list]
+        for x in range(0, len(highs), columns):
+            row = range(x, min(x + columns, len(highs)))
+            block = [
+                ["{:>3}  ".format(highs[y]) for y in row],
+                [u"{}  ".format(u"{}{:>2}".format(ops[y], lows[y])).translate(operator_translation) for y in row],
+                ["---  " for _ in row],
+                ["{:>3}  ".format(answers[y]) if user_answers else "     " for y in row],
+            ]
+            if answers != correct and showing_answers:
+                block.append(["({:>2}) ".format(int(correct[y])) for y in row])
+            yield block
 
     @staticmethod
     def _rows_str(equation_list, columns=16, showing_answers=True):
@@ -317,29 +950,9 @@ class Test(object):
             return_string = "None\n"
         else:
             return_string = ''
-            highs = [x.first_number for x in equation_list]
-            ops = [x.operator for x in equation_list]
-            lows = [x.second_number for x in equation_list]
-            answers = [x.user_answer for x in equation_list]
-            correct = [x.correct_answer for x in equation_list]
-            for x in range(0, len(highs), columns):
-                for y in range(columns if x + columns < (len(highs)) else len(highs) - x):
-                    return_string += "{:>3}  ".format(highs[x + y])
-                return_string += '\n'
-                for y in range(columns if x + columns < (len(lows)) else len(lows) - x):
-                    return_string += u"{}  ".format(u"{}{:>2}".format(ops[x + y], lows[x + y])).translate(
-                        operator_translation)
-                return_string += '\n'
-                for y in range(columns if x + columns < (len(highs)) else len(highs) - x):
-                    return_string += "---  ".format(highs[x + y])
-                return_string += '\n'
-                for y in range(columns if x + columns < (len(answers)) else len(answers) - x):
-                    return_string += "{:>3}  ".format(answers[x + y])
-                return_string += '\n'
-                if answers != correct and showing_answers:
-                    for y in range(columns if x + columns < (len(correct)) else len(correct) - x):
-                        return_string += "({:>2}) ".format(int(correct[x + y]))
-                    return_string += '\n'
+            for block in Test._row_blocks(equation_list, columns=columns, showing_answers=showing_answers):
+                for line in block:
+                    return_string += ''.join(line) + '\n'
                 return_string += '\n'  # extra new line separator
         return return_string
 
@@ -349,13 +962,14 @@ class Test(object):
         :param equation_list: List of tuple values using format (first number, operator, second operator, user answer)
         :param columns: Optional number of columns to print to the screen.  Default is 5.
         """
-        print(self._rows_str(equation_list, columns=columns))
+        self.io.writeline(self._rows_str(equation_list, columns=columns))
 
     def display_string(self, **kwargs):
         """
         Display the number of equations answered correctly and incorrectly.
         :param columns: The number of columns per row to print to the screen.
         """
+        start = time()
         skipped = len(self.skip)
         columns = kwargs.get("columns", 16)
         summary_format = "{{:^{}}}\n".format(columns * 5)
@@ -376,14 +990,17 @@ class Test(object):
             test_string += self._rows_str(self.skip, columns=columns, showing_answers=kwargs.get('showing_answers',
                                                                                                  False))
             test_string += "\n"
+        if listeners:
+            _notify("render", name="display_string", seconds=time() - start)
         return test_string
 
     def display_score(self, **kwargs):
         """
         Display the number of equations answered correctly and incorrectly.
         :param columns: The number of columns per row to print to the screen.
+        :param io: Optional backend to display the score with instead of self.io
         """
-        print(self.display_string(**kwargs))
+        (kwargs.get("io") or self.io).show_score(self, **kwargs)
 
     def get(self, attribute):
         """
@@ -404,12 +1021,23 @@ class Test(object):
         """
         Yield each question from a question list.
         After yielding the question, score it.
-        :param question_list: List of Questions
+        :param question_list: List or deque of Questions, which are taken off the front as they're asked, so
+                              questions added to the end while asking (e.g. wrong answers) are asked too.
+                              Any other iterable, e.g. a generator or a question bank, is read as it goes.
         :yields: Question Object until the list is empty
         """
-        while len(question_list) != 0:
-            self.question = question_list.pop(0)
-            yield self.question
+        if isinstance(question_list, deque):
+            while question_list:
+                self.question = question_list.popleft()
+                yield self.question
+        elif isinstance(question_list, list):
+            while len(question_list) != 0:
+                self.question = question_list.pop(0)
+                yield self.question
+        else:
+            for question in question_list:
+                self.question = question
+                yield self.question
 
     def prompt_list(self, question_list, **kwargs):
         """
@@ -417,28 +1045,31 @@ class Test(object):
 
         Warning: If submitting the list of right questions this will go on forever.
         """
+        io = kwargs["io"] = kwargs.get("io") or self.io
         try:
             for question in self.question_list(question_list):
                 question.prompt(**kwargs)
-                print(self.score())
+                io.writeline(self.score())
         except KeyboardInterrupt:
-            print('')
-            print(self.score())
+            io.writeline('')
+            io.writeline(self.score())
 
-    def review_wrong(self):
+    def review_wrong(self, **kwargs):
         """
         Review questions that the user got wrong.
+        :param io: Optional backend to ask the questions with instead of self.io
         """
+        io = kwargs.get("io") or self.io
         answer = 'x'
         while len(self.get("wrong")) > 0 or len(self.get("skip")) > 0:
             while answer.lower() not in ['y', 'n']:
-                answer = raw_input("Would you like review the questions you got wrong? (Y/N)>")
-            print("")
+                answer = io.read_line("Would you like review the questions you got wrong? (Y/N)>")
+            io.writeline("")
             if answer.lower() == "y":
-                self.prompt_list(self.get('wrong'), visualize=True)
+                self.prompt_list(self.get('wrong'), visualize=True, io=io)
                 if len(self.skip) > 0:
-                    print("Returned to skipped questions!")
-                    self.prompt_list(self.get('skip'), visualize=True)
+                    io.writeline("Returned to skipped questions!")
+                    self.prompt_list(self.get('skip'), visualize=True, io=io)
                     self._move_skipped_to_wrong()
             else:
                 return
@@ -456,65 +1087,204 @@ class Test(object):
 
     def _all_questions(self, **kwargs):
         all_questions = []
-        operation_ranges = {
-            "*": [(0, 9+1), (0, 9+1)],
-            "/": [(0, 9+1), (1, 9+1)],
-            "+": [(0, 19+1), (0, 19+1)],
-            "-": [(4, 19+1), (0, "first_number")],
-        }
-
-        operators = kwargs.get("valid_operators", self.question.valid_operators)
-        operators = kwargs.get("operator", operators)
+        operator_list = kwargs.get("valid_operators", self.question.valid_operators)
+        operator_list = kwargs.get("operator", operator_list)
 
         custom_first_number = kwargs.get('first_number')
         custom_second_number = kwargs.get('second_number')
-        for operator in operators:
+        for operator in operator_list:
+            first_range = operators[operator].first_range
+            second_range = operators[operator].second_range
             if custom_first_number is not None:
-                operation_ranges[operator][0] = (custom_first_number, custom_first_number+1)
+                first_range = (custom_first_number, custom_first_number+1)
             if custom_second_number is not None:
-                operation_ranges[operator][1] = (custom_second_number, custom_second_number+1)
-            first_range = operation_ranges[operator][0]
-            for first_number in range(*first_range):
-                # if operator is subtraction, only generate equations with positive results
-                if operator == '-':
-                    second_range = (operation_ranges[operator][1][0], first_number+1)
-                else:
-                    second_range = operation_ranges[operator][1]
-                for second_number in range(*second_range):
-                    if operator == '/':
-                        first_number_value = first_number * second_number
-                    else:
-                        first_number_value = first_number
-                    all_questions.append(
-                        Question(
-                            first_number=first_number_value,
-                            second_number=second_number,
-                            operator=operator,
-                            valid_operators=kwargs.get("valid_operators", Question().valid_operators)
-                        )
+                second_range = (custom_second_number, custom_second_number+1)
+            for first_number, second_number in operators[operator].pairs(first_range, second_range):
+                all_questions.append(
+                    Question(
+                        first_number=first_number,
+                        second_number=second_number,
+                        operator=operator,
+                        valid_operators=kwargs.get("valid_operators", Question().valid_operators)
                     )
+                )
         return all_questions
 
+    @staticmethod
+    def _constraint_filters(**kwargs):
+        """
+        Build the list of filters for the constraints in kwargs.
+        :param constraints: Optional list of names from constraint_rules or functions taking a Question
+        :param max_answer: Optional largest allowed correct answer
+        :param table: Optional number that must be one of the factors (or the divisor or quotient)
+        :return: List of functions that return True if the Question qualifies
+        """
+        filters = []
+        for constraint in kwargs.get("constraints") or []:
+            if callable(constraint):
+                filters.append(constraint)
+            elif constraint in constraint_rules:
+                filters.append(constraint_rules[constraint])
+            else:
+                raise ValueError("Unknown constraint: {}".format(constraint))
+        max_answer = kwargs.get("max_answer")
+        if max_answer is not None:
+            filters.append(lambda question: question.correct_answer <= max_answer)
+        table = kwargs.get("table")
+        if table is not None:
+            def in_table(question):
+                if operators[question.operator].in_tables:
+                    return table in operators[question.operator].operands(question)
+                return True
+            filters.append(in_table)
+        return filters
+
+    def _fact_key(self, **kwargs):
+        """
+        The settings in kwargs that decide which questions are in the fact index.
+        :return: Tuple
+        """
+        operators = kwargs.get("valid_operators", self.question.valid_operators)
+        operators = kwargs.get("operator", operators)
+        return (
+            tuple(operators),
+            tuple(kwargs.get("valid_operators", ())),
+            kwargs.get("first_number"),
+            kwargs.get("second_number"),
+            tuple(kwargs.get("constraints") or ()),
+            kwargs.get("max_answer"),
+            kwargs.get("table"),
+        )
+
+    def fact_space_name(self, **kwargs):
+        """
+        A name for the list of possible questions, e.g. to store a student's coverage under.
+        :return: String that is the same every time for the same settings
+        """
+        operators, _, first_number, second_number, constraints, max_answer, table = self._fact_key(**kwargs)
+        constraints = [getattr(constraint, "__name__", constraint) for constraint in constraints]
+        return u"{}|{}|{}|{}|{}|{}".format(''.join(sorted(operators)), first_number, second_number,
+                                           ','.join(sorted(constraints)), max_answer, table)
+
+    def _fact_index(self, **kwargs):
+        """
+        Return every fact allowed by the operators, numbers and constraints in kwargs.
+        The list is built once per configuration and cached, so don't change it.  Only the most recently used
+        configurations are kept, so a long running server doesn't keep every one it has seen.
+        :return: List of Facts (empty if the settings are impossible)
+        """
+        key = self._fact_key(**kwargs)
+        facts = self._fact_index_cache.pop(key, None)
+        if facts is None:
+            filters = self._constraint_filters(**kwargs)
+            facts = [
+                question.fact for question in self._all_questions(**kwargs)
+                # a question that divides by zero can never be asked
+                if not (operators[question.operator].divisor and question.second_number == 0)
+                and all(constraint(question) for constraint in filters)
+            ]
+            while len(self._fact_index_cache) >= self._fact_index_cache_size:
+                self._fact_index_cache.popitem(last=False)
+        self._fact_index_cache[key] = facts  # most recently used last
+        return facts
+
+    @staticmethod
+    def _question_for(fact, **kwargs):
+        """
+        Make a new Question to ask a Fact from the fact index.
+        """
+        return Question(fact=fact, valid_operators=kwargs.get("valid_operators", default_operators))
+
     def get_questions(self, **kwargs):
-        all_questions = []  # all possible questions, only generated if this is unique
+        """
+        Yield each new question for the test.
+        :param questions: Optional number of questions.  Default 25.
+        :param unique: Optional Boolean to not repeat questions until every possible question was asked.
+        :param coverage: Optional Coverage of questions a student has already seen (used with unique).
+                         It's updated as questions are asked so it can be saved for the next test.
+        :param resume: Optional Boolean to carry on from self.position and self.remaining instead of starting over,
+                       e.g. with a session moved from another process
+        :param bank: Optional iterable of Questions to ask instead of making them up, or the path of a question bank
+                     file (see mathtest_bank).  The test stops early if it runs out.
+        :yields: Tuple of question number and Question
+        """
+        if not kwargs.get("resume"):
+            self.position = 0
+            self.remaining = []
+        elif self.position > 0 and self.question.user_answer is None and self.question.operator is not None:
+            # the session was saved while this question was being asked; ask it again
+            yield self.position - 1, self.question
         number_of_questions = kwargs.get("questions", 25)
-        question_number = 0
-        while question_number < number_of_questions:
+        bank = kwargs.get("bank")
+        if bank is not None and kwargs.get("resume") and self._bank_questions is not None:
+            bank = self._bank_questions  # carry on from the bank's next row instead of reading it again
+        else:
+            filters = self._constraint_filters(**kwargs)
+            if isinstance(bank, (str, unicode)):
+                from mathtest_bank import QuestionBank
+                bank = QuestionBank(bank, valid_operators=[kwargs["operator"]] if kwargs.get("operator")
+                                    else kwargs.get("valid_operators"), max_answer=kwargs.get("max_answer"),
+                                    filters=filters)
+            elif bank is not None and filters:
+                # bank questions are held to the same constraints as made up ones
+                bank = (question for question in bank if all(rule(question) for rule in filters))
+            self.bank = bank
+            bank = self._bank_questions = iter(bank) if bank is not None else None
+        constrained = len(self._constraint_filters(**kwargs)) > 0
+        coverage = kwargs.get("coverage") if kwargs.get("unique") else None
+        if coverage is not None and len(coverage) != len(self._fact_index(**kwargs)):
+            raise ValueError("Coverage has {} facts but the settings have {}".format(
+                len(coverage), len(self._fact_index(**kwargs))))
+        if (constrained or kwargs.get("unique")) and bank is None and len(self._fact_index(**kwargs)) == 0:
+            # user chose an impossible situation; no question will ever qualify
+            (kwargs.get("io") or self.io).writeline("Your settings don't match any questions.  Exiting.")
+            if __name__ == '__main__':
+                exit(0)
+            else:
+                return
+        while self.position < number_of_questions:
             try:
-                if kwargs.get("unique"):
+                if bank is not None:
+                    question = next(bank, None)
+                    if question is None and self.position == 0:
+                        # every row of the bank was rejected, e.g. none of them have the operators chosen
+                        (kwargs.get("io") or self.io).writeline("Your settings don't match any questions.  Exiting.")
+                        if __name__ == '__main__':
+                            exit(0)
+                        else:
+                            return
+                    if question is None:
+                        return  # the bank ran out
+                    self.question = question
+                elif coverage is not None:
+                    # start over once the student has seen every question
+                    if coverage.uncovered == 0:
+                        coverage.clear()
+                    index = coverage.select_uncovered(randint(0, coverage.uncovered - 1))
+                    coverage.cover(index)
+                    self.question = self._question_for(self._fact_index(**kwargs)[index], **kwargs)
+                elif kwargs.get("unique"):
                     # if we haven't generated the whole list
                     # will also run if we finished the old list
-                    if len(all_questions) == 0:
-                        all_questions = self._all_questions(**kwargs)
-                    self.question = all_questions.pop(randint(0, len(all_questions) - 1))
+                    if len(self.remaining) == 0:
+                        self.remaining = list(self._fact_index(**kwargs))
+                    self.question = self._question_for(self.remaining.pop(randint(0, len(self.remaining) - 1)),
+                                                       **kwargs)
+                elif constrained:
+                    facts = self._fact_index(**kwargs)
+                    self.question = self._question_for(facts[randint(0, len(facts) - 1)], **kwargs)
                 else:
                     self.question.generate_rand_question(**kwargs)
-                yield question_number, self.question
-                question_number += 1
+                if listeners:
+                    _notify("question", question=self.question)
+                # count the question before handing it out so a session saved while it's asked won't repeat it
+                self.position += 1
+                yield self.position - 1, self.question
             except ZeroDivisionError:
-                if kwargs.get("operator") == '/' and kwargs.get("second_number") == 0:
+                if kwargs.get("operator") in operators and operators[kwargs["operator"]].divisor \
+                        and kwargs.get("second_number") == 0:
                     # user chose an impossible situation
-                    print("Your settings will always divide by zero.  Exiting.")
+                    (kwargs.get("io") or self.io).writeline("Your settings will always divide by zero.  Exiting.")
                     if __name__ == '__main__':
                         exit(0)
                     else:
@@ -523,34 +1293,210 @@ class Test(object):
                     # there's still a chance!
                     continue
 
+    def assign_worksheets(self, students, **kwargs):
+        """
+        Hand out a worksheet to each student in a class so neighbours overlap as little as possible.
+        Possible questions are dealt from shuffled decks: every question is used before any is used again,
+        so each question is given out the same number of times (give or take one).
+        No worksheet repeats a question unless it has more questions than there are possible questions.
+        :param students: Number of worksheets to make
+        :param kwargs: Settings for the questions, like get_questions.  questions is the number per worksheet.
+        :return: List of worksheets, each a list of Questions
+        """
+        return list(self.deal_worksheets(students, **kwargs))
+
+    def deal_worksheets(self, students, **kwargs):
+        """
+        Make the worksheets of assign_worksheets one at a time, e.g. to print a class of any size in the same memory.
+        :yields: Worksheet, a list of Questions
+        """
+        facts = self._fact_index(**kwargs)
+        if len(facts) == 0:
+            return
+        number_of_questions = kwargs.get("questions", 25)
+        deck = list(range(len(facts)))
+        shuffle(deck)
+        position = 0
+        for _ in range(students):
+            worksheet = []
+            on_worksheet = set()
+            while len(worksheet) < number_of_questions:
+                if position == len(deck):
+                    shuffle(deck)
+                    position = 0
+                if len(on_worksheet) == len(deck):
+                    on_worksheet.clear()  # more questions than facts; repeats can't be avoided
+                # a fresh deck may start with questions already on this worksheet; deal the next one instead
+                swap = position
+                while deck[swap] in on_worksheet:
+                    swap += 1
+                    if swap == len(deck):
+                        swap = position
+                        break
+                deck[position], deck[swap] = deck[swap], deck[position]
+                on_worksheet.add(deck[position])
+                worksheet.append(self._question_for(facts[deck[position]], **kwargs))
+                position += 1
+            yield worksheet
+
     def run(self, **kwargs):
         """
         Run the test by prompting user, scoring the answer, and finally displaying the score.
         :param questions: Optional number of questions to ask.  Default 25.
         :param unique: Optional Boolean to generate unique, one of a kind questions.
+        :param io: Optional backend to ask the questions with instead of self.io
+        :param time_limit: Optional seconds for a timed test (see run_timed)
         :param kwargs: keyword arguments to pass Question.prompt and display_score.
         :return:
         """
+        if kwargs.get("time_limit"):
+            return self.run_timed(**kwargs)
+        io = kwargs["io"] = kwargs.get("io") or self.io
         number_of_questions = kwargs.get("questions", 25)
         for question_number, question in self.get_questions(**kwargs):
-            print("Question {} of {}:".format(question_number + 1, number_of_questions))
+            io.writeline("Question {} of {}:".format(question_number + 1, number_of_questions))
             question.prompt(**kwargs)
-            print(self.score())
+            io.writeline(self.score())
 
         if len(self.skip) > 0:
-            print("Returned to skipped questions!")
+            io.writeline("Returned to skipped questions!")
             self.prompt_list(self.get('skip'), **kwargs)
             self._move_skipped_to_wrong()
         self.display_score(**kwargs)
         if len(self.get("wrong")) > 0 or len(self.get("skip")) > 0:
             try:
-                self.review_wrong()
+                self.review_wrong(io=io)
             except KeyboardInterrupt:
                 raise
             finally:
                 kwargs['showing_answers'] = True
                 self.display_score(**kwargs)
 
+    def run_timed(self, **kwargs):
+        """
+        Run a timed fluency check, e.g. 40 questions in 60 seconds.  Questions are asked until they run out or
+        time_limit seconds pass, whichever is first.  The question being asked when time runs out and any that
+        weren't reached are skipped, and there's no review, so the score is what was done in the time.
+        :param time_limit: Seconds for the test
+        :param kwargs: keyword arguments to pass run
+        """
+        io = kwargs["io"] = kwargs.get("io") or self.io
+        number_of_questions = kwargs.get("questions", 25)
+        start = perf_counter()
+        deadline = kwargs["deadline"] = monotonic() + kwargs["time_limit"]
+        try:
+            for question_number, question in self.get_questions(**kwargs):
+                io.writeline("Question {} of {}:".format(question_number + 1, number_of_questions))
+                timed_out = question.prompt(**kwargs)
+                io.writeline(self.score())
+                if timed_out or monotonic() >= deadline:
+                    io.writeline("Time's up!")
+                    break
+        except (KeyboardInterrupt, EOFError):
+            io.writeline('')  # stopped early; the rest are skipped like when time runs out
+        self.time_used = perf_counter() - start
+        self.skip_unanswered(**kwargs)
+        kwargs['showing_answers'] = True
+        self.display_score(**kwargs)
+
+    def skip_unanswered(self, **kwargs):
+        """
+        Skip the questions of a timed test that weren't answered in time, including the one being asked.
+        :param kwargs: Settings the questions were asked with, like get_questions
+        """
+        kwargs = dict(kwargs, resume=True, coverage=None)  # the student never saw these
+        for _, question in self.get_questions(**kwargs):
+            question.user_answer = ''
+            self.score()
+
+
+class NameFile(object):
+    """
+    Names kept one per line in a file that several processes may add to, e.g. the students of a coverage or history
+    store.  A name's number is its line number.  Adding a name locks the file (with fcntl, so not on Windows, where
+    only one process may write a store) and reads the names other processes added first, so two processes never
+    give two students the same number.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.numbers = {}
+        self._file = open(path, 'a+b')
+        self._read = 0  # bytes of the file already read into names
+        self.refresh()
+
+    def refresh(self):
+        """
+        Read the names added since the last read.
+        """
+        self._file.seek(self._read)
+        data = self._file.read()
+        data = data[:data.rfind(b'\n') + 1]  # a line still being written is read next time
+        for line in data.splitlines():
+            self.numbers[line.decode('utf-8')] = len(self.names)
+            self.names.append(line.decode('utf-8'))
+        self._read += len(data)
+
+    def number(self, name, add=False):
+        """
+        :param add: Give a new name the next number.  Otherwise an unknown name is None.
+        """
+        number = self.numbers.get(name)
+        if number is None:
+            if fcntl is not None and add:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                number = self.numbers.get(name)
+                if number is None and add:
+                    self._file.write(name.encode('utf-8') + b'\n')  # append mode: always at the end
+                    self._file.flush()
+                    self.refresh()
+                    number = self.numbers[name]
+            finally:
+                if fcntl is not None and add:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        return number
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        self._file.close()
+
+
+def imap_bounded(pool, function, jobs, window):
+    """
+    Like pool.imap, but never more than window jobs are read ahead of the results.
+    (imap reads every job into the pool's queue as fast as it can, however many there are.)
+    :param pool: multiprocessing.Pool
+    :param jobs: Iterable of single arguments for function, read lazily
+    :yields: Results in the order of the jobs
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+# settings that can be saved with a session (recordings, encoded sessions, cached worksheets); everything else
+# (io, files, ports) belongs to the machine it ran on
+CONFIG_KEYS = ("questions", "unique", "visualize", "operator", "valid_operators", "first_number", "second_number",
+               "constraints", "max_answer", "table", "columns", "time_limit")
+
+
+def config_of(kwargs):
+    """
+    The settings from kwargs that can be saved with a session, as JSON types.
+    """
+    config = dict((key, kwargs[key]) for key in CONFIG_KEYS if kwargs.get(key) is not None)
+    if "constraints" in config:
+        config["constraints"] = [getattr(constraint, "__name__", constraint) for constraint in config["constraints"]]
+    return config
+
 
 def arg_parse():
     def assign_if_greater_than_0(value):
@@ -562,18 +1508,12 @@ def arg_parse():
 
     def interactive_operators():
         question = Question()
-        words = {
-            "+": "addition",
-            "-": "subtraction",
-            "*": "multiplication",
-            "/": "division",
-        }
         operator_list = ''
 
-        for op in question.valid_operators:
+        for op in question.valid_operators + [op for op in operators if op not in question.valid_operators]:
             answer = 'x'
             while answer.lower() not in ['y', 'n', '']:
-                answer = raw_input("Would you like to do {}? (Y/N)>".format(words[op]))
+                answer = raw_input("Would you like to do {}? (Y/N)>".format(operators[op].name))
             if answer.lower() == 'y':
                 operator_list += op
 
@@ -607,12 +1547,38 @@ def arg_parse():
                         help="Show visualization of equation.")
     parser.add_argument("-u", "--unique", action='store_true',
                         help="Only unique questions; don't repeat unless necessary.")
-    parser.add_argument("-o", "--operator", help="Type of questions (+ - * /). No spaces if multiple.",
-                        metavar="OPERATOR or OPERATORS")
+    parser.add_argument("-o", "--operator", help="Type of questions ({}). No spaces if multiple.".format(
+                        ' '.join(operators).replace('%', '%%')), metavar="OPERATOR or OPERATORS")
     parser.add_argument("-q", "--questions", help="Number of questions.")
     parser.add_argument("-n", "--constant-number", help="Constant number for every question.",
                         metavar="NUMBER")
     parser.add_argument("-c", "--columns", help="Number of columns to print when the test score is displayed.")
+    parser.add_argument("-x", "--constraint", action='append', choices=sorted(constraint_rules),
+                        help="Only ask questions that follow this rule. Can be used more than once.")
+    parser.add_argument("-s", "--student", help="Remember which questions this student has seen between tests. "
+                                                   "Implies --unique.", metavar="NAME")
+    parser.add_argument("--coverage-file", default=os.path.join(os.path.expanduser("~"), ".mathtest_coverage"),
+                        help="Where to remember the questions students have seen. Default ~/.mathtest_coverage.")
+    parser.add_argument("--curses", action='store_true',
+                        help="Keep the question and a live scoreboard on screen instead of scrolling.")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics while the test runs.")
+    parser.add_argument("--memory", action='store_true',
+                        help="Show which parts of the program are using memory at the end of the test. Slow.")
+    parser.add_argument("--memory-budget", type=float, metavar="MB",
+                        help="Warn when the test is using more than this much memory. Implies --memory.")
+    parser.add_argument("--record", help="Add this session to a file that mathtest_replay.py can replay.",
+                        metavar="FILE")
+    parser.add_argument("-e", "--export", help="Add the results to a CSV or NPZ file for analysis.", metavar="FILE")
+    parser.add_argument("--history", help="Add every answer to a history file that mathtest_history.py can search. "
+                                          "Answers are filed under --student.", metavar="FILE")
+    parser.add_argument("--bank", help="Ask the questions in this CSV or JSON lines file instead of making them up.",
+                        metavar="FILE")
+    parser.add_argument("--max-answer", help="Largest correct answer allowed.", metavar="NUMBER")
+    parser.add_argument("-t", "--time", help="Timed fluency check: stop after this many seconds and skip the "
+                                             "questions not answered.", metavar="SECONDS")
+    parser.add_argument("--table", help="Only ask questions from this multiplication/division table.",
+                        metavar="NUMBER")
     args = parser.parse_args()
     kwargs = dict()
     if args.interactive:
@@ -620,20 +1586,22 @@ def arg_parse():
         args.questions = args.questions or interactive_questions()
         args.visualize = args.visualize or interactive_visualize()
     if args.operator:
-        question = Question()
-        if len(args.operator) == 1 and args.operator in question.valid_operators:
+        if len(args.operator) == 1 and args.operator in operators:
             kwargs["operator"] = args.operator
+            if args.operator not in default_operators:
+                # questions only accept the default operators unless told otherwise
+                kwargs["valid_operators"] = [args.operator]
         elif len(args.operator) > 1:
             for operator in args.operator:
-                if operator not in question.valid_operators:
+                if operator not in operators:
                     print("{} is not a valid operator!".format(operator))
-                    print("Valid operators are {}.".format(question.valid_operators))
+                    print("Valid operators are {}.".format(list(operators)))
                     exit(3)
             kwargs["valid_operators"] = [x for x in args.operator]
             kwargs.pop("operator", None)
         else:
             print("'{}' is an invalid operator!".format(args.operator))
-            print("Valid operators are: {}".format(question.valid_operators))
+            print("Valid operators are: {}".format(list(operators)))
             exit(1)
     if args.questions:
         try:
@@ -653,6 +1621,54 @@ def arg_parse():
         except ValueError:
             print("--columns must be a number greater than 0!")
             exit(4)
+    if args.constraint:
+        kwargs["constraints"] = args.constraint
+    if args.max_answer:
+        try:
+            kwargs["max_answer"] = int(args.max_answer)
+        except ValueError:
+            print("--max-answer must be a number!")
+            exit(5)
+    if args.table:
+        try:
+            kwargs["table"] = int(args.table)
+        except ValueError:
+            print("--table must be a number!")
+            exit(6)
+    if args.time:
+        try:
+            kwargs["time_limit"] = float(args.time)
+            if kwargs["time_limit"] <= 0:
+                raise ValueError
+        except ValueError:
+            print("--time must be a number of seconds greater than 0!")
+            exit(7)
+    if args.student:
+        kwargs["student"] = args.student
+        kwargs["coverage_file"] = args.coverage_file
+        args.unique = True
+    if args.export:
+        if args.export.lower().endswith(".npz"):
+            try:
+                import numpy
+            except ImportError:
+                print("--export to a .npz file needs numpy (pip install numpy)!")
+                exit(8)
+        kwargs["export"] = args.export
+    if args.history:
+        kwargs["history"] = args.history
+    if args.bank:
+        kwargs["bank"] = args.bank
+    if args.record:
+        kwargs["record"] = args.record
+    if args.curses:
+        kwargs["curses"] = True
+    if args.metrics_port:
+        kwargs["metrics_port"] = args.metrics_port
+    if args.memory or args.memory_budget:
+        kwargs["memory"] = True
+        if args.memory_budget:
+            kwargs["memory_budget"] = args.memory_budget
     kwargs["visualize"] = args.visualize
     kwargs["unique"] = args.unique
     return kwargs
@@ -663,20 +1679,84 @@ def main():
         kwargs = arg_parse()
     except KeyboardInterrupt:
         exit(0)
-    start = int(time())
+    if kwargs.get("metrics_port"):
+        import mathtest_metrics
+        mathtest_metrics.enable(kwargs["metrics_port"])
+    memory = None
+    if kwargs.get("memory"):
+        import mathtest_memory
+        budget = kwargs.get("memory_budget")
+        memory = mathtest_memory.enable(budget * 1e6 if budget else None)
+    if kwargs.get("curses"):
+        from mathtest_curses import CursesIO
+        kwargs["io"] = CursesIO()
+    elif not sys.stdin.isatty() and "io" not in kwargs:
+        # answers are coming from a pipe or file; read them in bulk
+        kwargs["io"] = PipeIO()
     try:
-        test = Test(**kwargs)
-        test.run(**kwargs)
-    except KeyboardInterrupt:
-        test.display_score(**kwargs)
-    end = int(time())
-    total_time = end - start
+        recording = None
+        if kwargs.get("record"):
+            import random
+            from mathtest_replay import RecordingIO
+            recording = RecordingIO(kwargs.get("io") or ConsoleIO())
+            kwargs["io"] = recording
+            record_seed = random.SystemRandom().getrandbits(32)
+            random.seed(record_seed)
+        store = None
+        if kwargs.get("student"):
+            from mathtest_coverage import CoverageStore
+            store = CoverageStore(kwargs["coverage_file"])
+            space_name = Test().fact_space_name(**kwargs)
+            kwargs["coverage"] = store.load(kwargs["student"], len(Test()._fact_index(**kwargs)), space_name)
+        # a recording replays from the coverage the student started with
+        coverage_at_start = bytes(kwargs["coverage"].bits) if recording is not None and store is not None else None
+        start = monotonic()
+        try:
+            test = Test(**kwargs)
+            test.run(**kwargs)
+        except (KeyboardInterrupt, EOFError):
+            test.display_score(**kwargs)
+        finally:
+            if getattr(test.bank, "rejected", 0):
+                test.io.writeline("Rows skipped in the question bank {}:".format(test.bank.path))
+                for line in test.bank.report_lines():
+                    test.io.writeline(line)
+            if store is not None:
+                store.save(kwargs["student"], kwargs["coverage"], space_name)
+                store.close()
+            if kwargs.get("export"):
+                from mathtest_export import ResultsWriter
+                with ResultsWriter(kwargs["export"]) as writer:
+                    writer.append(test)
+            if kwargs.get("history"):
+                from mathtest_history import HistoryStore
+                with HistoryStore(kwargs["history"]) as history:
+                    history.append_test(kwargs.get("student") or u'', test)
+            if recording is not None:
+                import mathtest_replay
+                mathtest_replay.save(kwargs["record"], mathtest_replay.session_record(test, recording, record_seed,
+                                                                                      kwargs, coverage_at_start))
+        total_time = int(monotonic() - start)
 
-    print("Total time was:  {}:{:0>2}".format(int(total_time / 60), int(total_time % 60)))
-    print("Percentage:      {:0.2f}%".format(test.grade))
+        test.io.writeline("Total time was:  {}:{:0>2}".format(int(total_time / 60), int(total_time % 60)))
+        test.io.writeline("Percentage:      {:0.2f}%".format(test.grade))
+        if test.facts_per_minute is not None:
+            test.io.writeline("Answered in:     {:0.3f} seconds".format(test.time_used))
+            test.io.writeline("Facts per minute: {:0.1f}".format(test.facts_per_minute))
+        if memory is not None:
+            test.io.writeline('')
+            for line in memory.report_lines():
+                test.io.writeline(line)
+            memory.stop()
+    finally:
+        # give the terminal back (curses) and flush output whether or not the test finished
+        if kwargs.get("io") is not None:
+            kwargs["io"].close()
 
     return 0
 
 
 if __name__ == '__main__':
+    # modules imported by main (metrics, memory, replay...) import mathtest; give them this module, not a second copy
+    sys.modules.setdefault("mathtest", sys.modules[__name__])
     main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_aio.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Async versions of the question/test loop for use with asyncio streams (sockets, subprocess pipes).
+Python 3 only.  Scoring, generation and display all come from mathtest.Test; only the waiting is async.
+"""
+import asyncio
+from time import monotonic, perf_counter
+
+import mathtest
+
+
+class AsyncStreamIO(mathtest.ConsoleIO):
+    """
+    Ask questions over an asyncio StreamReader/StreamWriter pair.
+    """
+    def __init__(self, reader, writer, encoding="utf-8"):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = encoding
+
+    def write(self, text):
+        self.writer.write(text.encode(self.encoding))
+
+    def writeline(self, text=''):
+        self.write(u"{}\n".format(text))
+
+    async def read_line(self, prompt=''):
+        """
+        Show the prompt and wait for a line.  Raises EOFError when the stream is closed.
+        """
+        self.write(prompt)
+        await self.writer.drain()
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError
+        return line.decode(self.encoding).rstrip(u'\r\n')
+
+
+class AsyncScriptedIO(mathtest.ScriptedIO):
+    """
+    ScriptedIO for the async loop; answers come from a list without waiting.
+    """
+    async def read_line(self, prompt=''):
+        return mathtest.ScriptedIO.read_line(self, prompt)
+
+
+async def prompt(question, io, **kwargs):
+    """
+    Async version of Question.prompt.  It takes the same steps (Question._prompt_steps); only the waiting is async.
+    :return: True if the time ran out before it was answered
+    """
+    steps = question._prompt_steps(**dict(kwargs, io=io))
+    text, wait = next(steps)
+    while text is not None:
+        if wait is None:
+            line = await io.read_line(text)
+        else:
+            try:
+                line = await asyncio.wait_for(io.read_line(text), wait)
+            except asyncio.TimeoutError:
+                line = None
+        text, wait = steps.send(line)
+    return wait
+
+
+async def prompt_list(test, question_list, io, **kwargs):
+    """
+    Async version of Test.prompt_list for a list of questions.  Each question stays on the list until it's scored,
+    so one that's being asked when the connection goes away is asked again when the session carries on.
+    """
+    while question_list:
+        test.question = question_list[0]
+        await prompt(test.question, io, **kwargs)
+        question_list.pop(0)
+        io.writeline(test.score())
+
+
+async def review_wrong(test, io):
+    """
+    Async version of Test.review_wrong.
+    """
+    answer = 'x'
+    while len(test.get("wrong")) > 0 or len(test.get("skip")) > 0:
+        while answer.lower() not in ['y', 'n']:
+            answer = await io.read_line("Would you like review the questions you got wrong? (Y/N)>")
+        io.writeline("")
+        if answer.lower() == "y":
+            await prompt_list(test, test.get('wrong'), io, visualize=True)
+            if len(test.skip) > 0:
+                io.writeline("Returned to skipped questions!")
+                await prompt_list(test, test.get('skip'), io, visualize=True)
+                test._move_skipped_to_wrong()
+        else:
+            return
+
+
+async def run(test, io, **kwargs):
+    """
+    Async version of Test.run.
+    :param test: Test to record the answers in
+    :param io: AsyncStreamIO (or anything with write, writeline and an async read_line)
+    :param kwargs: keyword arguments to pass Test.get_questions and display_string.
+    """
+    if kwargs.get("time_limit"):
+        return await run_timed(test, io, **kwargs)
+    kwargs.pop("io", None)
+    number_of_questions = kwargs.get("questions", 25)
+    for question_number, question in test.get_questions(io=io, **kwargs):
+        io.writeline("Question {} of {}:".format(question_number + 1, number_of_questions))
+        await prompt(question, io, **kwargs)
+        io.writeline(test.score())
+
+    if len(test.skip) > 0:
+        io.writeline("Returned to skipped questions!")
+        await prompt_list(test, test.get('skip'), io, **kwargs)
+        test._move_skipped_to_wrong()
+    test.display_score(io=io, **kwargs)
+    if len(test.get("wrong")) > 0 or len(test.get("skip")) > 0:
+        try:
+            await review_wrong(test, io)
+        finally:
+            kwargs['showing_answers'] = True
+            test.display_score(io=io, **kwargs)
+
+
+async def run_timed(test, io, **kwargs):
+    """
+    Async version of Test.run_timed.
+    :param time_limit: Seconds for the test
+    """
+    kwargs.pop("io", None)
+    number_of_questions = kwargs.get("questions", 25)
+    start = perf_counter()
+    deadline = kwargs["deadline"] = monotonic() + kwargs["time_limit"]
+    for question_number, question in test.get_questions(io=io, **kwargs):
+        io.writeline("Question {} of {}:".format(question_number + 1, number_of_questions))
+        timed_out = await prompt(question, io, **kwargs)
+        io.writeline(test.score())
+        if timed_out or monotonic() >= deadline:
+            io.writeline("Time's up!")
+            break
+    test.time_used = perf_counter() - start
+    test.skip_unanswered(io=io, **kwargs)
+    kwargs['showing_answers'] = True
+    test.display_score(io=io, **kwargs)
+
+
+def serve(host="127.0.0.1", port=8023, **kwargs):
+    """
+    Give a math test to every client that connects, e.g. with telnet or netcat.
+    :param kwargs: keyword arguments to pass run.
+    """
+    async def handle(reader, writer):
+        io = AsyncStreamIO(reader, writer)
+        test = mathtest.Test(**kwargs)
+        try:
+            await run(test, io, **dict(kwargs))
+            io.writeline("Percentage:      {:0.2f}%".format(test.grade))
+            await writer.drain()
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start():
+        server = await asyncio.start_server(handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(start())
+
+
+if __name__ == '__main__':
+    serve(**mathtest.arg_parse())
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_bank.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Ask questions from a teacher's own question bank (python mathtest.py --bank questions.csv).
+
+A bank is a CSV file with first_number, operator and second_number columns, or a JSON lines file with one object
+per question with the same keys.  Instead of the three columns a row can have a single question column written
+the way it's shown, e.g. "6 × 7" or "12 ÷ 4".  Other columns are ignored.
+
+The file is read lazily, a batch of rows at a time, so a bank of any size starts straight away and uses the same
+memory.  Each batch is checked in one go: the operator must be registered (and allowed, if valid_operators is
+given), the numbers must be whole numbers in range, nothing may divide by zero, division must come out even and
+the answers (worked out with each operator's batch kernel) must be in range.  Then each question must pass the
+filters, e.g. the test's constraints, max_answer and table (Test._constraint_filters).  Rows that fail are skipped
+and counted, or raise ValueError if strict.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from itertools import islice
+
+import mathtest
+
+if sys.version_info.major == 3:
+    unichr = chr
+    unicode = str
+
+BATCH_ROWS = 1024
+MAX_NUMBER = 9999  # the score display and the saved formats are laid out for numbers this size
+KEPT_ERRORS = 100  # reasons kept for rejected rows; the rest are only counted
+
+
+def _symbols():
+    """
+    Every way an operator may be written, e.g. "×" and "x" for "*".
+    """
+    symbols = dict((symbol, symbol) for symbol in mathtest.operators)
+    symbols.update((glyph, unichr(symbol)) for symbol, glyph in mathtest.operator_translation.items())
+    symbols.setdefault(u"x", u"*")
+    symbols.setdefault(u"X", u"*")
+    return symbols
+
+
+def _rows(path, fmt):
+    """
+    Read the raw rows of a bank.
+    :yields: Tuple of line number and dictionary of column name to value
+    """
+    with io.open(path, encoding='utf-8', newline='' if fmt == 'csv' else None) as input_file:
+        if fmt == 'csv':
+            reader = csv.DictReader(input_file)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(input_file, 1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError:
+                        yield line_number, None  # rejected with the other bad rows
+
+
+class QuestionBank(object):
+    """
+    An iterable of Questions read from a bank file.  Each time it's iterated the file is read again from the start.
+    """
+    def __init__(self, path, fmt=None, valid_operators=None, max_number=MAX_NUMBER, max_answer=None, strict=False,
+                 batch_rows=BATCH_ROWS, filters=None):
+        """
+        :param path: CSV or JSON lines file
+        :param fmt: 'csv' or 'jsonl'.  Default comes from the path's extension.
+        :param valid_operators: Optional list of operators allowed; default is every registered operator
+        :param max_number: Largest first or second number allowed
+        :param max_answer: Optional largest correct answer allowed
+        :param strict: Raise ValueError at the first bad row instead of skipping it
+        :param batch_rows: Rows read and checked at a time
+        :param filters: Optional list of functions taking a Question that must all return True, e.g. from
+                        Test._constraint_filters
+        """
+        self.path = path
+        self.fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+        if self.fmt == 'json':
+            self.fmt = 'jsonl'
+        if self.fmt not in ('csv', 'jsonl'):
+            raise ValueError("Unknown format '{}'. Use csv or jsonl.".format(self.fmt))
+        self.valid_operators = list(valid_operators or mathtest.operators)
+        self.max_number = max_number
+        self.max_answer = max_answer
+        self.strict = strict
+        self.batch_rows = batch_rows
+        self.filters = filters or []
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []  # tuples of line number and reason, the first KEPT_ERRORS of them
+
+    def _reject(self, line_number, reason):
+        if self.strict:
+            raise ValueError("{} line {}: {}".format(self.path, line_number, reason))
+        self.rejected += 1
+        if len(self.errors) < KEPT_ERRORS:
+            self.errors.append((line_number, reason))
+
+    def _parse(self, batch, symbols):
+        """
+        Turn raw rows into tuples of line number, first number, operator and second number.
+        """
+        parsed = []
+        for line_number, row in batch:
+            try:
+                if row.get("question"):
+                    first_number, operator, second_number = unicode(row["question"]).split('=')[0].split()
+                else:
+                    first_number, operator, second_number = row["first_number"], row["operator"], row["second_number"]
+                operator = unicode(operator).strip()
+                first_number, second_number = int(first_number), int(second_number)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                self._reject(line_number, "not a question")
+                continue
+            symbol = symbols.get(operator)
+            if symbol not in self.valid_operators:
+                self._reject(line_number, u"operator {} isn't allowed".format(operator))
+            elif not (0 <= first_number <= self.max_number and 0 <= second_number <= self.max_number):
+                self._reject(line_number, "numbers must be from 0 to {}".format(self.max_number))
+            elif mathtest.operators[symbol].divisor and second_number == 0:
+                self._reject(line_number, "divides by zero")
+            elif mathtest.operators[symbol].exact and first_number % second_number:
+                self._reject(line_number, "doesn't divide evenly")
+            else:
+                parsed.append((line_number, first_number, symbol, second_number))
+        return parsed
+
+    def _check_answers(self, parsed):
+        """
+        Work out the answers of a batch with each operator's batch kernel and drop the ones out of range.
+        """
+        answers = {}
+        for symbol in set(row[2] for row in parsed):
+            rows = [row for row in parsed if row[2] == symbol]
+            kernel_answers = mathtest.operators[symbol].batch([row[1] for row in rows], [row[3] for row in rows])
+            answers.update(zip([row[0] for row in rows], kernel_answers))
+        checked = []
+        for row in parsed:
+            answer = answers[row[0]]
+            if answer is None or not 0 <= answer < -mathtest.AnswerKey.MISSING:
+                self._reject(row[0], "the answer isn't a whole number from 0 to {}".format(
+                    -mathtest.AnswerKey.MISSING - 1))
+            elif self.max_answer is not None and answer > self.max_answer:
+                self._reject(row[0], "the answer is more than {}".format(self.max_answer))
+            else:
+                checked.append(row)
+        return checked
+
+    def __iter__(self):
+        self.accepted = self.rejected = 0
+        self.errors = []
+        symbols = _symbols()
+        rows = _rows(self.path, self.fmt)
+        while True:
+            batch = list(islice(rows, self.batch_rows))
+            if not batch:
+                return
+            for line_number, first_number, operator, second_number in self._check_answers(
+                    self._parse(batch, symbols)):
+                question = mathtest.Question(first_number=first_number, operator=operator,
+                                             second_number=second_number, valid_operators=self.valid_operators)
+                if not all(rule(question) for rule in self.filters):
+                    self._reject(line_number, "doesn't meet the test's constraints")
+                    continue
+                self.accepted += 1
+                yield question
+
+    def report_lines(self):
+        """
+        Lines describing the rows rejected the last time the bank was read.
+        """
+        lines = [u"line {}: {}".format(line_number, reason) for line_number, reason in self.errors]
+        if self.rejected > len(self.errors):
+            lines.append("... and {} more".format(self.rejected - len(self.errors)))
+        lines.append("{} questions, {} rejected.".format(self.accepted, self.rejected))
+        return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a question bank for mathtest.py --bank.")
+    parser.add_argument("bank", help="CSV or JSON lines file of questions")
+    parser.add_argument("-o", "--operator", help="Operators allowed. No spaces if multiple.")
+    parser.add_argument("--max-answer", type=int, help="Largest correct answer allowed.")
+    parser.add_argument("--max-number", type=int, default=MAX_NUMBER,
+                        help="Largest number allowed in a question. Default {}.".format(MAX_NUMBER))
+    args = parser.parse_args()
+
+    bank = QuestionBank(args.bank, valid_operators=list(args.operator) if args.operator else None,
+                        max_number=args.max_number, max_answer=args.max_answer)
+    for _ in bank:
+        pass
+    for line in bank.report_lines():
+        print(line)
+    return 1 if bank.rejected else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_cache.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+A cache of rendered worksheets on disk, so a reprint with the same settings is copied instead of made again.
+
+Entries are named by the SHA-256 of the settings that made them (as canonical JSON) and the renderer version, so
+the same settings always find the same entry and anything that would change the output gives a new name.
+An entry is a header with the size of each part (e.g. each SVG page) followed by the parts.
+
+Entries are written to a temporary file in the cache directory and renamed into place with os.replace, so other
+processes see a whole entry or none at all, and two processes writing the same entry at once is harmless.
+Reads go through mmap, so a hit is handed out without reading or copying the entry into memory first.
+The cache is kept under a size limit by deleting the least recently used entries; a hit touches the entry's
+modification time, which every process sharing the directory can see.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+import mathtest
+import mathtest_print
+
+MAGIC = b"MTRC"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")  # magic, version, part count; followed by the size of each part
+PART = struct.Struct("<Q")
+SUFFIX = ".entry"
+
+
+def worksheet_config(seed, students, **kwargs):
+    """
+    Everything that decides what a printed set of worksheets looks like.
+    :param seed: Random seed the worksheets are made with
+    :param students: Number of worksheets
+    :param kwargs: Test settings (see mathtest.CONFIG_KEYS) and render options (fmt, columns, rows,
+                   answer_key, visualize, title)
+    :return: Dictionary that can be passed to RenderCache
+    """
+    settings = mathtest.config_of(kwargs)
+    if "operator" in settings:
+        operators = [settings["operator"]]
+    else:
+        operators = settings.get("valid_operators") or mathtest.default_operators
+    return dict(
+        seed=seed,
+        students=students,
+        settings=settings,
+        # the ranges belong to the operators, so a changed operator makes different questions
+        operators=[(symbol, mathtest.operators[symbol].first_range, mathtest.operators[symbol].second_range)
+                   for symbol in operators],
+        render=dict((key, kwargs.get(key)) for key in ("fmt", "columns", "rows", "answer_key", "visualize", "title")),
+    )
+
+
+class CacheEntry(object):
+    """
+    A cached entry mapped into memory.  The parts are memoryviews of the mapping; close the entry when done.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as entry_file:
+            self.map = mmap.mmap(entry_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, version, count = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            view.release()
+            self.map.close()
+            raise ValueError("Not a cache entry (version {})".format(VERSION))
+        offset = HEADER.size + PART.size * count
+        self.parts = []
+        for index in range(count):
+            size = PART.unpack_from(view, HEADER.size + PART.size * index)[0]
+            self.parts.append(view[offset:offset + size])
+            offset += size
+        self._view = view
+
+    def close(self):
+        for part in self.parts:
+            part.release()
+        self._view.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RenderCache(object):
+    """
+    A directory of entries named by the hash of their settings, kept under max_bytes.
+    """
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, renderer_version=None):
+        """
+        :param directory: Where to keep the entries.  It's made if it doesn't exist and can be shared by processes.
+        :param max_bytes: Delete the least recently used entries when the cache is bigger than this
+        :param renderer_version: Part of every key.  Default is mathtest_print.RENDERER_VERSION.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.renderer_version = mathtest_print.RENDERER_VERSION if renderer_version is None else renderer_version
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, config):
+        """
+        :param config: Dictionary of settings (JSON types only), e.g. from worksheet_config
+        :return: Hex digest naming the entry
+        """
+        canonical = json.dumps(dict(config=config, renderer=self.renderer_version, version=VERSION),
+                               sort_keys=True, separators=(',', ':'), ensure_ascii=True)
+        return hashlib.sha256(canonical.encode('ascii')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, config):
+        """
+        :return: CacheEntry, or None if the settings aren't cached
+        """
+        path = self._path(self.key(config))
+        try:
+            entry = CacheEntry(path)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None)  # most recently used
+        except OSError:
+            pass  # evicted by another process since it was opened; the mapping still works
+        return entry
+
+    def put(self, config, parts):
+        """
+        Store an entry.
+        :param parts: List of bytes-like parts or paths of files to copy in, e.g. the files a render wrote
+        :return: The entry's key
+        """
+        key = self.key(config)
+        sizes = [os.path.getsize(part) if isinstance(part, str) else len(part) for part in parts]
+        descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as output:
+                output.write(HEADER.pack(MAGIC, VERSION, len(parts)))
+                for size in sizes:
+                    output.write(PART.pack(size))
+                for part in parts:
+                    if isinstance(part, str):
+                        with open(part, 'rb') as part_file:
+                            while True:
+                                chunk = part_file.read(1 << 20)
+                                if not chunk:
+                                    break
+                                output.write(chunk)
+                    else:
+                        output.write(part)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.evict()
+        return key
+
+    def entries(self):
+        """
+        :return: List of tuples of last used time, size and path for every entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue  # evicted by another process
+                entries.append((status.st_mtime, status.st_size, path))
+        entries.sort()
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Delete the least recently used entries until the cache is no bigger than max_bytes.
+        :return: Number of entries deleted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        deleted = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                deleted += 1
+            except OSError:
+                pass  # another process got to it first
+            total -= size
+        return deleted
+
+    def clear(self):
+        return self.evict(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or trim a worksheet cache made with mathtest_print.py --cache.")
+    parser.add_argument("directory", help="Cache directory")
+    parser.add_argument("--max-mb", type=float, help="Trim the cache to this size.")
+    parser.add_argument("--clear", action='store_true', help="Delete every entry.")
+    args = parser.parse_args()
+
+    cache = RenderCache(args.directory)
+    if args.clear:
+        print("Deleted {} entries.".format(cache.clear()))
+    elif args.max_mb is not None:
+        print("Deleted {} entries.".format(cache.evict(int(args.max_mb * 1024 * 1024))))
+    entries = cache.entries()
+    print("{} entries, {:0.1f} MB".format(len(entries), sum(size for _, size, _ in entries) / 1024.0 / 1024.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
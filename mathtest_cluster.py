@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_cluster.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Serve math tests from one worker process per core, each student always on the same worker.
+
+Clients connect (e.g. with telnet or netcat) and send their student id as the first line.  The front end picks
+the student's worker with a consistent hash ring and passes the connection itself to that worker, which gives the
+test with mathtest_aio.  The front end never touches the test traffic.  Each worker keeps the Tests of its students,
+so a student who disconnects carries on where they left off when they connect again.
+
+Workers that die are started again in the same place on the ring; only the sessions of that worker are lost.
+Sending STATS as the first line returns the counters of every worker and the answers per second as JSON.
+
+python mathtest_cluster.py --scale 8 runs mathtest_sim students against 1 to 8 workers and prints the throughput.
+Python 3.9+ on Unix (connections are handed to the workers with SCM_RIGHTS).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from bisect import bisect
+from collections import OrderedDict
+from time import perf_counter, sleep, strftime
+
+import mathtest
+import mathtest_aio
+
+COUNTERS = ("connections", "answers", "sessions")  # per worker, in a shared array the front end reads
+STATS = "STATS"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys to nodes.  Adding or removing a node only moves the keys next to its points.
+    """
+    def __init__(self, nodes=(), replicas=100):
+        """
+        :param nodes: Names of the nodes
+        :param replicas: Points on the ring per node; more spreads the keys more evenly
+        """
+        self.replicas = replicas
+        self.points = []  # sorted hashes
+        self.owners = {}  # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash(u"{}#{}".format(node, replica))
+            if point not in self.owners:
+                self.owners[point] = node
+                self.points.insert(bisect(self.points, point), point)
+
+    def remove(self, node):
+        for point in [point for point, owner in self.owners.items() if owner == node]:
+            del self.owners[point]
+            self.points.remove(point)
+
+    def node(self, key):
+        """
+        The node that owns key: the first point on the ring at or after the key's hash.
+        """
+        if not self.points:
+            raise KeyError("The ring has no nodes")
+        index = bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+class _Counter(object):
+    """
+    Listener that counts scored answers in this worker's row of the shared counters.
+    """
+    def __init__(self, counters, slot):
+        self.counters = counters
+        self.index = slot * len(COUNTERS) + COUNTERS.index("answers")
+
+    def __call__(self, event, data):
+        if event == "answer":
+            self.counters[self.index] += 1
+
+
+class Worker(object):
+    """
+    Gives tests on the connections the front end passes to it.  Runs in its own process.
+    """
+    def __init__(self, slot, channel, counters, max_sessions=10000, **kwargs):
+        """
+        :param slot: Number of this worker
+        :param channel: Unix datagram socket the connections arrive on
+        :param counters: Shared array of COUNTERS for every worker
+        :param max_sessions: Unfinished sessions to keep; the longest unused are dropped first
+        :param kwargs: Settings for the tests
+        """
+        self.slot = slot
+        self.channel = channel
+        self.counters = counters
+        self.max_sessions = max_sessions
+        self.kwargs = kwargs
+        self.sessions = OrderedDict()  # student -> unfinished Test, least recently used first
+        self.active = set()  # students connected right now
+        self.tasks = set()  # running sessions; the event loop only keeps weak references to tasks
+
+    def _count(self, name):
+        self.counters[self.slot * len(COUNTERS) + COUNTERS.index(name)] += 1
+
+    async def session(self, sock, student):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        io = mathtest_aio.AsyncStreamIO(reader, writer)
+        if student in self.active:
+            io.writeline("{} is already taking a test.".format(student))
+            writer.close()
+            return
+        self._count("connections")
+        self.active.add(student)
+        test = self.sessions.pop(student, None)
+        resume = test is not None
+        if test is None:
+            test = mathtest.Test(**self.kwargs)
+        self.sessions[student] = test
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        try:
+            if resume:
+                io.writeline("Welcome back, {}!".format(student))
+            await mathtest_aio.run(test, io, resume=resume, **self.kwargs)
+            self.sessions.pop(student, None)
+            self._count("sessions")
+            io.writeline("Percentage:      {:0.2f}%".format(test.grade))
+            await writer.drain()
+        except (EOFError, ConnectionError):
+            pass  # keep the Test for when the student comes back
+        finally:
+            self.active.discard(student)
+            writer.close()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+
+        def stop():
+            if not stopped.done():
+                stopped.set_result(None)
+
+        def receive():
+            while True:
+                try:
+                    message, fds, _, _ = socket.recv_fds(self.channel, 1024, 1)
+                except BlockingIOError:
+                    return
+                except OSError:
+                    message, fds = b'', []
+                if not message and not fds:
+                    # an empty message (or a closed channel) means stop
+                    stop()
+                    return
+                for fd in fds:
+                    task = loop.create_task(self.session(socket.socket(fileno=fd),
+                                                         message.decode('utf-8', 'replace')))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+        self.channel.setblocking(False)
+        loop.add_reader(self.channel.fileno(), receive)
+        parent = multiprocessing.parent_process()
+        if parent is not None:
+            loop.add_reader(parent.sentinel, stop)  # the front end died without telling us
+        await stopped
+
+
+def _worker_main(slot, channel, counters, max_sessions, kwargs):
+    # Ctrl-C is for the front end, which stops the workers; SIGTERM must not go to the front end's event loop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+    mathtest.listeners.append(_Counter(counters, slot))
+    asyncio.run(Worker(slot, channel, counters, max_sessions, **kwargs).serve())
+
+
+class ShardedServer(object):
+    """
+    The front end: accepts connections and hands each one to its student's worker.
+    """
+    def __init__(self, host="127.0.0.1", port=8023, workers=None, max_sessions=10000, **kwargs):
+        """
+        :param port: Port to listen on; 0 picks a free one (see self.port)
+        :param workers: Number of worker processes.  Default is one per core.
+        :param max_sessions: Unfinished sessions each worker keeps
+        :param kwargs: Settings for the tests, like Test.run
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_sessions = max_sessions
+        self.kwargs = kwargs
+        self.sock = socket.create_server((host, port), backlog=1024)
+        self.port = self.sock.getsockname()[1]
+        self.ring = HashRing(range(self.workers))
+        self.counters = multiprocessing.Array('q', self.workers * len(COUNTERS), lock=False)
+        self.processes = [None] * self.workers
+        self.channels = [None] * self.workers
+        self.respawns = 0
+        self.started = perf_counter()
+        self.stopping = False
+        self._last = (self.started, 0)  # time and total answers of the last throughput report
+
+    def start_worker(self, slot):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        process = multiprocessing.Process(target=_worker_main, name="mathtest-worker-{}".format(slot),
+                                          args=(slot, worker_channel, self.counters, self.max_sessions, self.kwargs))
+        process.daemon = True
+        process.start()
+        worker_channel.close()
+        channel.setblocking(False)
+        if self.channels[slot] is not None:
+            self.channels[slot].close()
+        self.processes[slot] = process
+        self.channels[slot] = channel
+        asyncio.get_running_loop().add_reader(process.sentinel, self._worker_exited, slot, process)
+
+    def _worker_exited(self, slot, process):
+        asyncio.get_running_loop().remove_reader(process.sentinel)
+        process.join()
+        if self.stopping or self.processes[slot] is not process:
+            return
+        print("{} worker {} exited with code {}; starting it again".format(strftime("%H:%M:%S"), slot,
+                                                                             process.exitcode))
+        self.respawns += 1
+        self.start_worker(slot)
+
+    def stats(self):
+        """
+        Counters of every worker and their totals.
+        :return: Dictionary that can be sent as JSON
+        """
+        width = len(COUNTERS)
+        workers = [dict(zip(COUNTERS, self.counters[slot * width:(slot + 1) * width]),
+                        pid=self.processes[slot].pid if self.processes[slot] else None)
+                   for slot in range(self.workers)]
+        totals = dict((name, sum(worker[name] for worker in workers)) for name in COUNTERS)
+        uptime = perf_counter() - self.started
+        return dict(workers=workers, respawns=self.respawns, uptime=uptime,
+                    answers_per_second=totals["answers"] / uptime if uptime > 0 else 0.0, **totals)
+
+    def throughput(self):
+        """
+        Answers per second across all workers since the last call.
+        """
+        now = perf_counter()
+        answers = self.stats()["answers"]
+        last_time, last_answers = self._last
+        self._last = (now, answers)
+        return (answers - last_answers) / (now - last_time) if now > last_time else 0.0
+
+    async def hand_off(self, student, fd):
+        """
+        Send a connection to the student's worker, waiting while the worker's queue is full.
+        """
+        loop = asyncio.get_running_loop()
+        slot = self.ring.node(student)
+        while True:
+            channel = self.channels[slot]
+            try:
+                socket.send_fds(channel, [student.encode('utf-8')], [fd])
+                return
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer(channel, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await asyncio.wait_for(writable, 5)
+                finally:
+                    loop.remove_writer(channel)
+
+    async def handle(self, reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), 30)
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        student = line.decode('utf-8', 'replace').strip()
+        if student == STATS:
+            writer.write(json.dumps(self.stats(), sort_keys=True).encode('utf-8') + b'\n')
+        elif student:
+            try:
+                await self.hand_off(student, writer.get_extra_info('socket').fileno())
+            except (OSError, asyncio.TimeoutError):
+                writer.write(b"The server is busy.  Try again in a moment.\n")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        # the worker has its own copy of the connection; closing ours doesn't end it
+        writer.close()
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.stats()
+            print("{} {} workers  {:0.1f} answers/s  {} answers  {} sessions finished  {} respawns".format(
+                strftime("%H:%M:%S"), self.workers, self.throughput(), stats["answers"], stats["sessions"],
+                self.respawns))
+
+    async def serve(self, report_interval=None):
+        """
+        Start the workers and serve until cancelled or sent SIGTERM.
+        :param report_interval: Print the throughput every this many seconds
+        """
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+        for slot in range(self.workers):
+            self.start_worker(slot)
+        reporter = loop.create_task(self._report(report_interval)) if report_interval else None
+        server = await asyncio.start_server(self.handle, sock=self.sock, backlog=1024)
+        try:
+            async with server:
+                await stopped
+        finally:
+            self.stop()
+            if reporter is not None:
+                reporter.cancel()
+
+    def stop(self):
+        """
+        Stop the workers.  An empty message tells them to exit; any still running after that are terminated.
+        """
+        self.stopping = True
+        for channel in self.channels:
+            if channel is not None:
+                try:
+                    channel.send(b'')
+                except OSError:
+                    pass
+                channel.close()
+        for process in self.processes:
+            if process is not None:
+                process.join(2)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+
+    def run(self, report_interval=None):
+        try:
+            asyncio.run(self.serve(report_interval))
+        except KeyboardInterrupt:
+            pass
+
+
+def request_stats(host="127.0.0.1", port=8023):
+    """
+    Ask a running server for its stats.
+    :return: Dictionary from ShardedServer.stats
+    """
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall(STATS.encode('ascii') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+def _serve_process(server):
+    server.run()
+
+
+def scale(max_workers, students=2000, clients=None, concurrency=50, **kwargs):
+    """
+    Run simulated students against 1 to max_workers workers on this machine and print the throughput.
+    :param students: Students per run
+    :param clients: Processes for the load generator.  Default is max_workers.
+    :param concurrency: Connections open at once per client process
+    :param kwargs: Settings for the tests
+    :return: List of (workers, report) tuples
+    """
+    import mathtest_sim
+    clients = clients or max_workers
+    results = []
+    print("{:>7} {:>12} {:>12} {:>12} {:>12}".format("workers", "sessions/s", "answers/s", "p50 latency",
+                                                     "p99 latency"))
+    for workers in range(1, max_workers + 1):
+        server = ShardedServer(port=0, workers=workers, **kwargs)
+        process = multiprocessing.Process(target=_serve_process, args=(server,))
+        process.start()
+        server.sock.close()  # the server process has it
+        try:
+            sleep(0.5)
+            class_list = mathtest_sim.make_students(students, seed=workers)
+            report = mathtest_sim.simulate_remote(class_list, ("127.0.0.1", server.port), workers=clients,
+                                                  concurrency=concurrency)
+        finally:
+            process.terminate()
+            process.join()
+        results.append((workers, report))
+        print("{:>7} {:>12.1f} {:>12.1f} {:>10.0f}us {:>10.0f}us".format(
+            workers, report["sessions_per_second"], report["answers"] / report["seconds"],
+            report["latency_p50"] * 1e6, report["latency_p99"] * 1e6))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve math tests from one process per core.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on. Default 127.0.0.1.")
+    parser.add_argument("-p", "--port", type=int, default=8023, help="Port to listen on. Default 8023.")
+    parser.add_argument("-w", "--workers", type=int, help="Worker processes. Default one per core.")
+    parser.add_argument("-q", "--questions", type=int, default=25, help="Questions per test. Default 25.")
+    parser.add_argument("-o", "--operator", help="Type of questions ({}). No spaces if multiple.".format(
+                        ' '.join(mathtest.operators).replace('%', '%%')),
+                        metavar="OPERATOR or OPERATORS")
+    parser.add_argument("-u", "--unique", action='store_true', help="Only unique questions.")
+    parser.add_argument("--max-sessions", type=int, default=10000,
+                        help="Unfinished sessions each worker keeps. Default 10000.")
+    parser.add_argument("--report", type=float, metavar="SECONDS", help="Print the throughput this often.")
+    parser.add_argument("--scale", type=int, metavar="N",
+                        help="Don't serve; measure throughput with 1 to N workers using simulated students.")
+    parser.add_argument("-n", "--students", type=int, default=2000, help="Students per --scale run. Default 2000.")
+    args = parser.parse_args()
+
+    kwargs = dict(questions=args.questions, unique=args.unique)
+    if args.operator:
+        kwargs["valid_operators"] = [x for x in args.operator]
+    if args.scale:
+        scale(args.scale, students=args.students, **kwargs)
+        return 0
+    server = ShardedServer(args.host, args.port, args.workers, args.max_sessions, **kwargs)
+    print("Serving on {}:{} with {} workers.".format(args.host, server.port, server.workers))
+    server.run(args.report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
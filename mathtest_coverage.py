@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_coverage.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Remember which facts each student has already seen so unique mode doesn't repeat them the next day.
+
+A Coverage is one bit per fact in the configured fact space (the list from Test._fact_index).
+A CoverageStore keeps every student's bitmap in one file of fixed-size slots that is read through mmap.
+"""
+import mmap
+import os
+from bisect import bisect_right
+
+import mathtest
+
+BLOCK_BYTES = 8  # uncovered facts are counted per 64-bit block for rank/select
+
+
+class Coverage(object):
+    """
+    A bitmap with one bit per fact.  A set bit means the student has already been asked that fact.
+    """
+    def __init__(self, size, data=None):
+        """
+        :param size: Number of facts
+        :param data: Optional bytes of an existing bitmap
+        """
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        if data is not None:
+            self.bits[:] = data[:len(self.bits)]
+        self._before = None  # uncovered facts before each block; built when needed
+
+    def __len__(self):
+        return self.size
+
+    def is_covered(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def _count_before(self):
+        """
+        Count the uncovered facts before every block so select_uncovered can binary search.
+        """
+        before = [0]
+        for start in range(0, len(self.bits), BLOCK_BYTES):
+            block_bits = min(BLOCK_BYTES * 8, self.size - start * 8)
+            covered = bin(int.from_bytes(bytes(self.bits[start:start + BLOCK_BYTES]), 'little')).count('1')
+            before.append(before[-1] + block_bits - covered)
+        self._before = before
+
+    @property
+    def uncovered(self):
+        """
+        Number of facts the student hasn't been asked yet.
+        """
+        if self._before is None:
+            self._count_before()
+        return self._before[-1]
+
+    def cover(self, index):
+        """
+        Mark a fact as asked.
+        """
+        if self.is_covered(index):
+            return
+        self.bits[index >> 3] |= 1 << (index & 7)
+        if self._before is not None:
+            for block in range(index // (BLOCK_BYTES * 8) + 1, len(self._before)):
+                self._before[block] -= 1
+
+    def clear(self):
+        """
+        Forget every fact, e.g. once the student has seen them all.
+        """
+        self.bits[:] = bytearray(len(self.bits))
+        self._before = None
+
+    def rank_uncovered(self, index):
+        """
+        Number of uncovered facts before index.
+        """
+        if self._before is None:
+            self._count_before()
+        block = index // (BLOCK_BYTES * 8)
+        rank = self._before[block]
+        for position in range(block * BLOCK_BYTES * 8, index):
+            if not self.is_covered(position):
+                rank += 1
+        return rank
+
+    def select_uncovered(self, rank):
+        """
+        Find the uncovered fact with the given rank (0 is the first uncovered fact).
+        Binary search for the block, then scan at most 64 bits.
+        :return: Index of the fact
+        """
+        if not 0 <= rank < self.uncovered:
+            raise IndexError("Only {} uncovered facts".format(self.uncovered))
+        block = bisect_right(self._before, rank) - 1
+        rank -= self._before[block]
+        for index in range(block * BLOCK_BYTES * 8, min(self.size, (block + 1) * BLOCK_BYTES * 8)):
+            if not self.is_covered(index):
+                if rank == 0:
+                    return index
+                rank -= 1
+        raise IndexError(rank)  # counts are out of date; can't happen unless bits were changed directly
+
+
+class CoverageStore(object):
+    """
+    Every student's Coverage in one file of fixed-size slots.
+    The student keys are kept in a text file next to it (one per line, in slot order, see mathtest.NameFile), so
+    several processes can share a store: each writes only its students' slots.
+    """
+    def __init__(self, path, slot_bits=1024):
+        """
+        :param path: Path of the bitmap file.  The keys go in path + ".ids".
+        :param slot_bits: Largest fact space a slot can hold.  Must stay the same for the life of the file.
+        """
+        self.path = path
+        self.slot_size = (slot_bits + 7) // 8
+        self._ids = mathtest.NameFile(path + ".ids")
+        self._file = open(path, "a+b")
+        self._map = None
+        self._capacity = 0
+        self._remap(max(len(self._ids), 64))
+
+    def _remap(self, slots):
+        """
+        Make the file big enough for this many slots and map it again.
+        """
+        if self._map is not None:
+            self._map.close()
+        if mathtest.fcntl is not None:
+            mathtest.fcntl.flock(self._file.fileno(), mathtest.fcntl.LOCK_EX)  # another process may be growing it
+        try:
+            self._file.seek(0, os.SEEK_END)
+            size = max(self._file.tell(), slots * self.slot_size)
+            self._file.truncate(size)
+        finally:
+            if mathtest.fcntl is not None:
+                mathtest.fcntl.flock(self._file.fileno(), mathtest.fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._capacity = size // self.slot_size
+
+    @staticmethod
+    def key(student, config=''):
+        return u"{}\t{}".format(student, config)
+
+    def load(self, student, size, config=''):
+        """
+        Get the student's Coverage for a fact space.  A new student gets an empty Coverage.
+        :param size: Number of facts in the space
+        :param config: Name of the fact space, e.g. from mathtest.Test.fact_space_name
+        """
+        if (size + 7) // 8 > self.slot_size:
+            raise ValueError("A fact space of {} facts doesn't fit in {} byte slots".format(size, self.slot_size))
+        slot = self._ids.number(self.key(student, config))
+        if slot is None:
+            return Coverage(size)
+        if slot >= self._capacity:
+            self._remap(slot + 1)  # another process added the student
+        offset = slot * self.slot_size
+        return Coverage(size, self._map[offset:offset + self.slot_size])
+
+    def save(self, student, coverage, config=''):
+        """
+        Write the student's Coverage back to the file.
+        """
+        slot = self._ids.number(self.key(student, config), add=True)
+        if slot >= self._capacity:
+            self._remap(max(slot + 1, self._capacity * 2))
+        offset = slot * self.slot_size
+        self._map[offset:offset + len(coverage.bits)] = bytes(coverage.bits)
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        self._ids.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_curses.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Full screen terminal front end for mathtest (python mathtest.py --curses).
+
+The top of the screen shows the last few messages and the current question, the bottom shows the scoreboard.
+Only lines that changed since the last draw are sent to the terminal, which keeps slow serial and SSH
+connections responsive.
+"""
+import curses
+import locale
+import sys
+
+import mathtest
+from mathtest import monotonic
+
+if sys.version_info.major == 3:
+    unichr = chr
+
+ENTER_KEYS = (u'\n', u'\r', curses.KEY_ENTER)
+BACKSPACE_KEYS = (u'\b', u'\x7f', curses.KEY_BACKSPACE)
+
+
+class CursesIO(mathtest.ConsoleIO):
+    """
+    Ask questions in a curses screen with a live scoreboard.
+    """
+    def __init__(self, screen=None):
+        """
+        :param screen: Optional curses window.  Default starts curses on the whole terminal.
+        """
+        locale.setlocale(locale.LC_ALL, '')
+        self.encoding = locale.getpreferredencoding()
+        self.started = screen is None
+        self.screen = screen or curses.initscr()
+        if self.started:
+            curses.noecho()
+            curses.cbreak()
+        self.screen.keypad(True)  # arrow keys, backspace and enter as curses.KEY_ codes, not escape sequences
+        self.test = None
+        self.score_kwargs = {}
+        self.log = []  # messages, one per line
+        self._partial = u''
+        self._drawn = {}  # screen row -> text currently shown there
+        self.closed = False
+
+    def attach(self, test):
+        self.test = test
+
+    def _layout(self):
+        height, width = self.screen.getmaxyx()
+        log_height = max(3, min(14, height // 2 - 2))
+        return height, width, log_height
+
+    def _put(self, row, text):
+        """
+        Show text on a row unless it's already there.
+        """
+        height, width, _ = self._layout()
+        if row >= height:
+            return
+        text = text[:width - 1]
+        if self._drawn.get(row) == text:
+            return
+        self.screen.move(row, 0)
+        self.screen.clrtoeol()
+        if text:
+            self.screen.addstr(row, 0, text.encode(self.encoding, 'replace') if sys.version_info.major == 2 else text)
+        self._drawn[row] = text
+
+    def _scoreboard(self):
+        if self.test is None:
+            return []
+        _, width, _ = self._layout()
+        kwargs = dict(self.score_kwargs)
+        kwargs.setdefault("columns", max(1, min(16, (width - 1) // 5)))
+        return self.test.display_string(**kwargs).strip('\n').split('\n')
+
+    def draw(self, prompt=u''):
+        """
+        Redraw the messages, prompt and scoreboard, sending only the rows that changed.
+        """
+        height, width, log_height = self._layout()
+        log = self.log[-log_height:]
+        for row in range(log_height):
+            self._put(row, log[row] if row < len(log) else u'')
+        self._put(log_height, prompt)
+        self._put(log_height + 1, u'-' * (width - 1))
+        scoreboard = self._scoreboard()
+        for row in range(log_height + 2, height):
+            line = row - log_height - 2
+            self._put(row, scoreboard[line] if line < len(scoreboard) else u'')
+        self.screen.move(log_height, min(len(prompt), width - 1))
+        self.screen.refresh()
+
+    def write(self, text):
+        if self.closed:
+            sys.stdout.write(text)
+            return
+        lines = (self._partial + text).split(u'\n')
+        self._partial = lines.pop()
+        self.log.extend(lines)
+        del self.log[:-100]
+
+    def read_line(self, prompt='', timeout=None):
+        if self.closed:
+            return mathtest.ConsoleIO.read_line(self, prompt, timeout)
+        prompt = self._partial + prompt
+        self._partial = u''
+        self.draw(prompt)
+        _, width, log_height = self._layout()
+        # keys are read one at a time so the time limit covers the whole answer, not just the first key
+        deadline = None if timeout is None else monotonic() + timeout
+        answer = u''
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self.log.append(prompt + answer)
+                        return None
+                    self.screen.timeout(max(1, int(remaining * 1000)))
+                key = self._key()
+                if key is None:
+                    continue  # timed out; checked above
+                if key in ENTER_KEYS:
+                    break
+                if key in BACKSPACE_KEYS:
+                    answer = answer[:-1]
+                elif isinstance(key, type(u'')) and key >= u' ':
+                    answer += key
+                else:
+                    continue
+                self._put(log_height, prompt + answer)
+                self.screen.move(log_height, min(len(prompt + answer), width - 1))
+                self.screen.refresh()
+        finally:
+            self.screen.timeout(-1)
+        self.log.append(prompt + answer)
+        return answer
+
+    def _key(self):
+        """
+        Wait for a key.
+        :return: The character typed, a curses.KEY_ constant for other keys, or None if the wait timed out
+        """
+        try:
+            if hasattr(self.screen, "get_wch"):
+                return self.screen.get_wch()
+            key = self.screen.getch()  # Python 2 only reads bytes
+        except curses.error:
+            return None
+        if key == -1:
+            return None
+        return unichr(key) if key < 256 else key
+
+    def show_score(self, test, **kwargs):
+        self.test = test
+        self.score_kwargs = kwargs
+        if self.closed:
+            mathtest.ConsoleIO.show_score(self, test, **kwargs)
+        else:
+            self.draw()
+
+    def close(self):
+        """
+        Wait for a key, then give the terminal back and print the final scoreboard and messages.
+        If an exception is on its way out the terminal is given back straight away so the traceback can be read.
+        """
+        if self.closed:
+            return
+        last_lines = self.log[-3:]
+        if sys.exc_info()[0] is None:
+            self.log.append(u"Press any key to exit.")
+            self.draw()
+            self.screen.getch()
+        if self.started:
+            self.screen.keypad(False)
+            curses.nocbreak()
+            curses.echo()
+            curses.endwin()
+        self.closed = True
+        print(u'\n'.join(self._scoreboard()))
+        print(u'\n'.join(line for line in last_lines + [self._partial] if line))
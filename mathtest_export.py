@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_export.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Export test results in columns (one row per answered question) as CSV or NumPy .npz.
+
+Columns:
+    session         number of the test session in the file
+    outcome         right, wrong or skip
+    first_number, operator, second_number
+    user_answer     blank in CSV (MISSING in .npz) if skipped
+    correct_answer
+    elapsed         seconds taken to answer, blank in CSV (nan in .npz) if not timed
+
+Writing .npz needs numpy.
+"""
+import csv
+import io
+import os
+from array import array
+
+import mathtest
+
+COLUMNS = ("session", "outcome", "first_number", "operator", "second_number", "user_answer", "correct_answer",
+           "elapsed")
+OUTCOMES = ("right", "wrong", "skip")
+MISSING = mathtest.AnswerKey.MISSING
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Writing or reading .npz results needs numpy (pip install numpy)")
+    return numpy
+
+
+def _last_csv_session(path):
+    """
+    Read the session number of the last row of a CSV results file without reading the whole file.
+    :return: Session number or -1 if there are no rows
+    """
+    with open(path, 'rb') as input_file:
+        input_file.seek(0, os.SEEK_END)
+        end = input_file.tell()
+        input_file.seek(max(0, end - 4096))
+        lines = input_file.read().splitlines()
+    for line in reversed(lines):
+        session = line.split(b',', 1)[0]
+        if session.isdigit():
+            return int(session)
+    return -1
+
+
+class ResultsWriter(object):
+    """
+    Append the results of many tests to one file.  Rows are kept in column buffers and written in bulk.
+    """
+    def __init__(self, path, fmt=None, buffer_rows=65536):
+        """
+        :param path: File to add results to.  It's created if it doesn't exist.
+        :param fmt: 'csv' or 'npz'.  Default comes from the path's extension.
+        :param buffer_rows: Write CSV rows to disk after this many have been buffered
+        """
+        self.path = path
+        self.fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+        if self.fmt not in ('csv', 'npz'):
+            raise ValueError("Unknown format '{}'. Use csv or npz.".format(self.fmt))
+        self.buffer_rows = buffer_rows
+        self.next_session = 0
+        self._existing = None
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            if self.fmt == 'csv':
+                # CSV rows are appended to the file, so only the last session number is needed
+                self.next_session = _last_csv_session(path) + 1
+            else:
+                self._existing = load(path)
+                if len(self._existing["session"]) > 0:
+                    self.next_session = int(max(self._existing["session"])) + 1
+        self._clear()
+        if self.fmt == 'npz':
+            self._numpy = _numpy()
+
+    def _clear(self):
+        self.session = array('l')
+        self.outcome = array('b')
+        self.first_number = array('l')
+        self.operator = []
+        self.second_number = array('l')
+        self.user_answer = array('l')
+        self.correct_answer = array('l')
+        self.elapsed = array('d')
+
+    def __len__(self):
+        return len(self.session)
+
+    def append(self, test, session=None):
+        """
+        Add the right, wrong and skipped questions of a Test.
+        :param session: Optional session number.  Default is one more than the last.
+        :return: The session number used
+        """
+        if session is None:
+            session = self.next_session
+        self.next_session = max(self.next_session, session + 1)
+        for outcome, name in enumerate(OUTCOMES):
+            for question in test.get(name):
+                user_answer = question.user_answer
+                self.session.append(session)
+                self.outcome.append(outcome)
+                self.first_number.append(question.first_number)
+                self.operator.append(question.operator)
+                self.second_number.append(question.second_number)
+                self.user_answer.append(MISSING if user_answer is None or user_answer == '' else user_answer)
+                self.correct_answer.append(question.correct_answer)
+                self.elapsed.append(float('nan') if question.elapsed is None else question.elapsed)
+        if self.fmt == 'csv' and len(self) >= self.buffer_rows:
+            self.flush()
+        return session
+
+    def _write_csv(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with io.open(self.path, 'a', newline='') as output:
+            writer = csv.writer(output)
+            if new_file:
+                writer.writerow(COLUMNS)
+            writer.writerows(zip(
+                self.session,
+                [OUTCOMES[outcome] for outcome in self.outcome],
+                self.first_number,
+                self.operator,
+                self.second_number,
+                ['' if answer == MISSING else answer for answer in self.user_answer],
+                self.correct_answer,
+                ['' if elapsed != elapsed else "{:0.6f}".format(elapsed) for elapsed in self.elapsed],
+            ))
+
+    def _write_npz(self):
+        numpy = self._numpy
+        columns = dict(
+            session=numpy.array(self.session, dtype=numpy.int64),
+            outcome=numpy.array([OUTCOMES[outcome] for outcome in self.outcome], dtype='<U5'),
+            first_number=numpy.array(self.first_number, dtype=numpy.int32),
+            operator=numpy.array(self.operator, dtype='<U1'),
+            second_number=numpy.array(self.second_number, dtype=numpy.int32),
+            user_answer=numpy.array(self.user_answer, dtype=numpy.int32),
+            correct_answer=numpy.array(self.correct_answer, dtype=numpy.int32),
+            elapsed=numpy.array(self.elapsed, dtype=numpy.float64),
+        )
+        if self._existing is not None:
+            columns = dict((name, numpy.concatenate([self._existing[name], columns[name]])) for name in COLUMNS)
+        temp_path = self.path + ".tmp.npz"
+        numpy.savez(temp_path, **columns)
+        os.replace(temp_path, self.path)
+        self._existing = columns
+
+    def flush(self):
+        """
+        Write the buffered rows.  A .npz file is rewritten completely, so only flush it when needed.
+        """
+        if len(self) == 0:
+            return
+        if self.fmt == 'csv':
+            self._write_csv()
+        else:
+            self._write_npz()
+        self._clear()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(path, fmt=None):
+    """
+    Load a whole results file.
+    :return: Dictionary of column name to column (numpy arrays for .npz, lists for CSV)
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt == 'npz':
+        with _numpy().load(path) as data:
+            return dict((name, data[name]) for name in COLUMNS)
+    columns = dict((name, []) for name in COLUMNS)
+    with io.open(path, newline='') as input_file:
+        for row in csv.DictReader(input_file):
+            columns["session"].append(int(row["session"]))
+            columns["outcome"].append(row["outcome"])
+            columns["first_number"].append(int(row["first_number"]))
+            columns["operator"].append(row["operator"])
+            columns["second_number"].append(int(row["second_number"]))
+            columns["user_answer"].append(int(row["user_answer"]) if row["user_answer"] != '' else None)
+            columns["correct_answer"].append(int(row["correct_answer"]))
+            columns["elapsed"].append(float(row["elapsed"]) if row["elapsed"] != '' else None)
+    return columns
@@ -22,23 +22,24 @@
 #
 #
 import mathtest
-import os
 import sys
 from pprint import pprint
 
+try:
+    from time import monotonic, perf_counter
+except ImportError:  # Python 2
+    from time import time as monotonic, time as perf_counter
+
+FRAME_SECONDS = 1.0 / 60  # the scoreboard is drawn at most this often
+
 if sys.version_info.major == 2:
     from Tkinter import *
     import tkMessageBox as messagebox
-    if os.name == 'nt':
-        operator_translation = {ord('*'): u"x", ord('/'): u"÷"}
-    else:
-        operator_translation = {ord('*'): u"×", ord('/'): u"÷"}
 else:
     from tkinter import *
     from tkinter import messagebox
     raw_input = input
     unicode = str
-    operator_translation = str.maketrans("*/", "×÷")
 
 
 class Dialog(Toplevel):
@@ -136,12 +137,16 @@ class Dialog(Toplevel):
 class QuestionWindow(Dialog):
     e1 = None
     still_going = True
+    timed_out = False
 
     def __init__(self, parent, **kwargs):
         self.question = kwargs.get("question")
         self.visualize = kwargs.get("visualize", False)
         self.window_x = kwargs.get("window_x")
         self.window_y = kwargs.get("window_y")
+        self.deadline = kwargs.get("deadline")  # time.monotonic() time to skip the question if it isn't answered
+        self._timer = None
+        self.start = perf_counter()
 
         if sys.version_info.major == 3:
             super(QuestionWindow, self).__init__(parent, title=kwargs.get('title'),
@@ -194,7 +199,7 @@ class QuestionWindow(Dialog):
         Label(
             master,
             text=u"{}{:>2}".format(
-                unicode(self.question.operator).translate(operator_translation),
+                unicode(self.question.operator).translate(mathtest.operator_translation),
                 self.question.second_number),
             font=('courier new', 12)
         ).grid(row=2, column=1, sticky='w')
@@ -206,12 +211,16 @@ class QuestionWindow(Dialog):
         self.e1.grid(row=3, column=1, sticky='w')
         self.e1.focus_set()
 
+        if self.deadline is not None:
+            self._timer = self.after(max(0, int((self.deadline - monotonic()) * 1000)), self.time_up)
+
     def apply(self):
         try:
             entry = self.e1.get()
             if entry != '':
                 entry = int(entry)
             self.question.user_answer = entry
+            self.question.elapsed = perf_counter() - self.start
         except ValueError:
             messagebox.showwarning(
                 "Bad input",
@@ -252,10 +261,25 @@ class QuestionWindow(Dialog):
 
     def skip(self, event=None):
         self.question.user_answer = ''
+        self.question.elapsed = perf_counter() - self.start
         # put focus back to the parent window
         self.parent.focus_set()
         self.destroy()
 
+    def time_up(self):
+        """
+        Skip the question when the time of a timed test runs out.
+        """
+        self._timer = None
+        self.timed_out = True
+        self.skip()
+
+    def destroy(self):
+        if self._timer is not None:
+            self.after_cancel(self._timer)
+            self._timer = None
+        Dialog.destroy(self)
+
     def cancel(self, event=None):
         # put focus back to the parent window
         self.still_going = False
@@ -267,10 +291,13 @@ class OptionWindow(Dialog):
     def __init__(self, parent, in_kwargs):
         self.parent = parent
         self.kwargs = in_kwargs
-        self.division = BooleanVar(value='/' in in_kwargs.get('valid_operators', ['/']))
-        self.multiplication = BooleanVar(value='*' in in_kwargs.get('valid_operators', ['*']))
-        self.addition = BooleanVar(value='+' in in_kwargs.get('valid_operators', ['+']))
-        self.subtraction = BooleanVar(value='-' in in_kwargs.get('valid_operators', ['-']))
+        # one checkbox per operator: the default ones first (ticked unless the settings say otherwise), then the rest
+        self.operators = mathtest.default_operators + [
+            operator for operator in mathtest.operators if operator not in mathtest.default_operators]
+        self.operator_choices = dict(
+            (operator, BooleanVar(value=operator in in_kwargs.get(
+                'valid_operators', mathtest.default_operators if operator in mathtest.default_operators else [])))
+            for operator in self.operators)
         self.visualize = BooleanVar(value=in_kwargs.get('visualize', False))
         self.questions = in_kwargs.get('questions', 25)
         self.questions_entry = None
@@ -282,27 +309,15 @@ class OptionWindow(Dialog):
     def body(self, master):
         row = 0
 
-        division_button = Checkbutton(master, text="Division", variable=self.division, onvalue=True, offvalue=False)
-        multiplication_button = Checkbutton(master, text="Multiplication", variable=self.multiplication, onvalue=True,
-                                            offvalue=False)
-        addition_button = Checkbutton(master, text="Addition", variable=self.addition, onvalue=True, offvalue=False)
-        subtraction_button = Checkbutton(master, text="Subtraction", variable=self.subtraction, onvalue=True,
-                                         offvalue=False)
+        operator_buttons = []
+        for operator in self.operators:
+            operator_button = Checkbutton(master, text=mathtest.operators[operator].name.capitalize(),
+                                          variable=self.operator_choices[operator], onvalue=True, offvalue=False)
+            operator_button.grid(row=row, sticky='w')
+            row += 1
+            operator_buttons.append(operator_button)
         visualize_button = Checkbutton(master, text="Visualize", variable=self.visualize, onvalue=True, offvalue=False)
 
-        division_button.grid(row=row, sticky='w')
-        row += 1
-        # division_button.select()
-        multiplication_button.grid(row=row, sticky='w')
-        row += 1
-        # multiplication_button.select()
-        addition_button.grid(row=row, sticky='w')
-        row += 1
-        # addition_button.select()
-        subtraction_button.grid(row=row, sticky='w')
-        row += 1
-        # subtraction_button.select()
-
         visualize_button.grid(row=row, sticky='w', pady=10)
         row += 1
 
@@ -312,8 +327,8 @@ class OptionWindow(Dialog):
         self.questions_entry = Entry(master)
         self.questions_entry.insert(0, '25')
 
-        self.questions_entry.grid(row=5, column=1, sticky='w')
-        division_button.focus_set()
+        self.questions_entry.grid(row=row - 1, column=1, sticky='w')
+        operator_buttons[0].focus_set()
 
     def buttonbox(self):
         box = Frame(self)
@@ -366,15 +381,11 @@ class OptionWindow(Dialog):
         kwargs = dict(unique=True)
         if "second_number" in self.kwargs.keys():
             kwargs["second_number"] = self.kwargs.get("second_number")
-        kwargs['valid_operators'] = []
-        if self.division.get():
-            kwargs['valid_operators'].append('/')
-        if self.multiplication.get():
-            kwargs['valid_operators'].append('*')
-        if self.addition.get():
-            kwargs['valid_operators'].append('+')
-        if self.subtraction.get():
-            kwargs['valid_operators'].append('-')
+        if "bank" in self.kwargs.keys():
+            kwargs["bank"] = self.kwargs.get("bank")
+        if "time_limit" in self.kwargs.keys():
+            kwargs["time_limit"] = self.kwargs.get("time_limit")
+        kwargs['valid_operators'] = [operator for operator in self.operators if self.operator_choices[operator].get()]
 
         kwargs['visualize'] = self.visualize.get()
 
@@ -406,6 +417,17 @@ class TestGUI(Tk):
                                width=80*12)
         self.test = mathtest.Test()
         self.still_going = True
+        self._display_kwargs = {}
+        self._redraw_id = None
+        self._dirty_since = None  # when the first change since the last render was asked for
+        self._last_render = None
+        # instrumentation of the scoreboard: updates asked for, renders done and seconds spent
+        self.display_requests = 0
+        self.display_renders = 0
+        self.render_seconds = 0.0
+        self.render_wait = 0.0  # from the first change being asked for to it being drawn
+        self.render_wait_max = 0.0
+        self.update_seconds = 0.0  # spent in update_display, keeping the next question waiting
 
     def get_options(self, **kwargs):
         """
@@ -418,18 +440,74 @@ class TestGUI(Tk):
 
     def update_display(self, **kwargs):
         """
-        Redraw the scoreboard with current information.
+        Mark the scoreboard out of date.  Changes are drawn together at most once a frame, when Tk is next idle,
+        so answering quickly or moving many questions at once doesn't redraw after every one.  The final grade is
+        drawn straight away.
         :return:
         """
-        final_grade = kwargs.get('final_grade', False)
-        if final_grade:
+        start = perf_counter()
+        self.display_requests += 1
+        self._display_kwargs = dict(kwargs)
+        if self._dirty_since is None:
+            self._dirty_since = start
+        if kwargs.get('final_grade', False):
+            self.flush_display()
+        elif self._redraw_id is None:
+            wait = 0 if self._last_render is None else FRAME_SECONDS - (start - self._last_render)
+            if wait > 0:
+                self._redraw_id = self.after(int(wait * 1000) + 1, self._schedule_redraw)
+            else:
+                self._redraw_id = self.after_idle(self._redraw)
+        self.update_seconds += perf_counter() - start
+
+    def _schedule_redraw(self):
+        self._redraw_id = self.after_idle(self._redraw)
+
+    def flush_display(self):
+        """
+        Draw any changes to the scoreboard now.
+        """
+        if self._redraw_id is not None:
+            self.after_cancel(self._redraw_id)
+        self._redraw()
+        self.update()
+
+    def _redraw(self):
+        self._redraw_id = None
+        if self._dirty_since is None:
+            return
+        start = perf_counter()
+        kwargs = self._display_kwargs
+        if kwargs.get('final_grade', False):
             self.display_string.set(
-                self.test.display_string(**kwargs) + '\nFinal Score: {:0.2f}%'.format(self.test.grade)
+                self.test.display_string(**kwargs) + '\nFinal Score: {:0.2f}%'.format(self.test.grade) + (
+                    '' if self.test.facts_per_minute is None else
+                    '\nFacts per minute: {:0.1f}'.format(self.test.facts_per_minute))
             )
         else:
             self.display_string.set(self.test.display_string(**kwargs))
         self.message.pack()
-        self.update()
+        self._last_render = perf_counter()
+        seconds = self._last_render - start
+        wait = self._last_render - self._dirty_since
+        self._dirty_since = None
+        self.display_renders += 1
+        self.render_seconds += seconds
+        self.render_wait += wait
+        self.render_wait_max = max(self.render_wait_max, wait)
+        if mathtest.listeners:
+            mathtest._notify("render", name="scoreboard", seconds=seconds)
+
+    def display_stats(self):
+        """
+        :return: Line with how many scoreboard updates were asked for, how many were drawn and how long they took
+        """
+        renders = max(self.display_renders, 1)
+        return ("Scoreboard: {} updates, {} renders, {:0.1f} ms per render, {:0.1f} ms average wait "
+                "({:0.1f} ms at most), {:0.1f} ms per update in the answer loop").format(
+            self.display_requests, self.display_renders, self.render_seconds * 1000 / renders,
+            self.render_wait * 1000 / renders, self.render_wait_max * 1000,
+            self.update_seconds * 1000 / max(self.display_requests, 1))
 
     def _post_question(self, q, score=False, **kwargs):
         self.still_going = q.still_going
@@ -442,7 +520,12 @@ class TestGUI(Tk):
     def run_new_questions(self, **kwargs):
         """
         Get new questions based off of elements in kwargs and prompt the user.
+        With time_limit in kwargs the questions stop when the time runs out and the rest are skipped.
         """
+        deadline = None
+        if kwargs.get("time_limit"):
+            start = perf_counter()
+            deadline = kwargs["deadline"] = monotonic() + kwargs["time_limit"]
         for question_number, question in self.test.get_questions(**kwargs):
             kwargs.update(dict(window_x=self.question_x))
             kwargs.update(dict(window_y=self.question_y))
@@ -457,6 +540,12 @@ class TestGUI(Tk):
                 break
             self.test.score()
             self.update_display(**kwargs)
+            if deadline is not None and (q.timed_out or monotonic() >= deadline):
+                break
+        if deadline is not None:
+            self.test.time_used = perf_counter() - start
+            self.test.skip_unanswered(**kwargs)
+            self.update_display(**kwargs)
 
     def run_skipped_questions(self, **kwargs):
         """
@@ -498,27 +587,41 @@ class TestGUI(Tk):
 
 def main():
     kwargs = mathtest.arg_parse()
+    if kwargs.get("metrics_port"):
+        import mathtest_metrics
+        mathtest_metrics.enable(kwargs["metrics_port"])
+    memory = None
+    if kwargs.get("memory"):
+        import mathtest_memory
+        budget = kwargs.get("memory_budget")
+        memory = mathtest_memory.enable(budget * 1e6 if budget else None)
     test = TestGUI()
     test.update_display(**kwargs)
     kwargs = test.get_options(**kwargs)
     test.run_new_questions(**kwargs)
 
-    if len(test.test.get('skip')) and not test.still_going:
-        test.still_going = messagebox.askyesno(title="Review", message="Review questions you skipped?")
+    if not kwargs.get("time_limit"):  # a timed test has no review
+        if len(test.test.get('skip')) and not test.still_going:
+            test.still_going = messagebox.askyesno(title="Review", message="Review questions you skipped?")
 
-    while len(test.test.get("skip")) > 0:
-        test.run_skipped_questions(**kwargs)
+        while len(test.test.get("skip")) > 0:
+            test.run_skipped_questions(**kwargs)
 
-    test.update_display(**kwargs)
+        test.update_display(**kwargs)
 
-    if len(test.test.wrong) > 0:
-        test.still_going = messagebox.askyesno(title="Review", message="Retry questions you got wrong?")
-    kwargs['visualize'] = True
-    while len(test.test.get("skip") + test.test.get("wrong")) > 0 and test.still_going:
-        test.run_wrong_questions(visualize=True)
-        test.run_skipped_questions(visualize=True)
+        if len(test.test.wrong) > 0:
+            test.still_going = messagebox.askyesno(title="Review", message="Retry questions you got wrong?")
+        kwargs['visualize'] = True
+        while len(test.test.get("skip") + test.test.get("wrong")) > 0 and test.still_going:
+            test.run_wrong_questions(visualize=True)
+            test.run_skipped_questions(visualize=True)
 
     test.end_test()
+    if mathtest.listeners:
+        print(test.display_stats())
+    if memory is not None:
+        print('\n'.join(memory.report_lines()))
+        memory.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_history.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Keep every answer ever given and find them again quickly, e.g. all of a student's division last month.
+
+Record with python mathtest.py --student NAME --history results.hist.  The store is a set of files:
+
+    results.hist            header, then one fixed-size RECORD per answer in the order they were added
+    results.hist.ids        student names, one per line; the line number is the student's number in the records.
+                            Processes lock it to add a student (see mathtest.NameFile).
+    results.hist.manifest   JSON list of the index runs and how many records they cover
+    results.hist.*.time     index runs of (time, record number), sorted
+    results.hist.*.student  index runs of (student, time, record number), sorted
+
+Records are only ever appended and are read through mmap.  Queries binary search each index run and scan the
+records added since the last compaction.  compact() indexes those records into a new run and merges runs of about
+the same size, so each record is rewritten a few times in its life instead of on every compaction, and no query
+has more than a few dozen runs to search.
+"""
+import argparse
+import calendar
+import heapq
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import namedtuple
+from datetime import datetime
+from time import mktime, time
+
+import mathtest
+
+MAGIC = b"MTHS"
+VERSION = 1
+HEADER = struct.Struct("<4sHH8x")  # magic, version, record size
+# time (microseconds since the epoch), student, first number, second number, user answer, correct answer,
+# elapsed seconds, operator, outcome
+RECORD = struct.Struct("<qIiiiifBB2x")
+TIME_ENTRY = struct.Struct("<qQ")  # time, record number
+STUDENT_ENTRY = struct.Struct("<IqQ")  # student, time, record number
+OUTCOMES = ("right", "wrong", "skip")
+MISSING = mathtest.AnswerKey.MISSING
+RUN_RECORDS = 1 << 20  # most records indexed into one new run; bigger tails are indexed as several runs
+CHUNK_ENTRIES = 1 << 16  # entries read or written at a time while merging
+
+Record = namedtuple("Record", ("time", "student", "first_number", "operator", "second_number", "user_answer",
+                               "correct_answer", "elapsed", "outcome"))
+
+
+def _microseconds(seconds):
+    return int(round(seconds * 1000000))
+
+
+def _bisect(buffer, layout, count, key):
+    """
+    Find the first entry of a sorted index run that isn't less than key.
+    :param key: Tuple compared with the first len(key) fields of each entry
+    """
+    low, high = 0, count
+    width = len(key)
+    while low < high:
+        middle = (low + high) // 2
+        if layout.unpack_from(buffer, middle * layout.size)[:width] < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class _Run(object):
+    """
+    One sorted index run, read through mmap.
+    """
+    def __init__(self, name, path, layout):
+        self.name = name
+        self.path = path
+        self.layout = layout
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self.count = size // layout.size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def __len__(self):
+        return self.count
+
+    def range(self, low_key, high_key):
+        """
+        Entries from low_key up to but not including high_key.
+        """
+        start = _bisect(self._map, self.layout, self.count, low_key)
+        end = _bisect(self._map, self.layout, self.count, high_key)
+        for index in range(start, end):
+            yield self.layout.unpack_from(self._map, index * self.layout.size)
+
+    def entries(self):
+        """
+        Every entry in order, read a chunk at a time.
+        """
+        size = self.layout.size
+        for start in range(0, self.count, CHUNK_ENTRIES):
+            end = min(self.count, start + CHUNK_ENTRIES)
+            for entry in self.layout.iter_unpack(self._map[start * size:end * size]):
+                yield entry
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class HistoryStore(object):
+    """
+    Append-only store of answers with indexes by time and by student.
+    """
+    def __init__(self, path, tail_limit=65536):
+        """
+        :param path: The record file; the other files are named after it
+        :param tail_limit: Compact automatically once this many records aren't indexed.  0 turns it off.
+        """
+        self.path = path
+        self.tail_limit = tail_limit
+        new = not os.path.exists(path) or os.path.getsize(path) < HEADER.size
+        self._file = open(path, 'a+b')
+        if new:
+            self._file.truncate(0)
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            self._file.flush()
+        self._file.seek(0)
+        magic, version, record_size = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError("{} isn't a version {} history file".format(path, VERSION))
+        size = os.fstat(self._file.fileno()).st_size
+        self.count = (size - HEADER.size) // RECORD.size
+        if size != HEADER.size + self.count * RECORD.size:
+            self._file.truncate(HEADER.size + self.count * RECORD.size)  # half written record from a crash
+        self._pending = []  # packed records not written yet
+        self._map = None
+        self._mapped = 0  # records covered by self._map
+
+        self._ids = mathtest.NameFile(path + ".ids")  # shared safely with other processes adding students
+        self.names = self._ids.names
+
+        self.indexed = 0
+        self.time_runs = []
+        self.student_runs = []
+        self._next_run = 0
+        if os.path.exists(path + ".manifest"):
+            with io.open(path + ".manifest", encoding='utf-8') as manifest:
+                manifest = json.load(manifest)
+            self.indexed = manifest["indexed"]
+            self._next_run = manifest["next_run"]
+            self.time_runs = [self._open_run(name, "time") for name in manifest["runs"]]
+            self.student_runs = [self._open_run(name, "student") for name in manifest["runs"]]
+
+    def __len__(self):
+        return self.count + len(self._pending)
+
+    def _run_path(self, name, kind):
+        return u"{}.{}.{}".format(self.path, name, kind)
+
+    def _open_run(self, name, kind):
+        return _Run(name, self._run_path(name, kind), TIME_ENTRY if kind == "time" else STUDENT_ENTRY)
+
+    def student_number(self, student, add=False):
+        """
+        The number a student is stored under.
+        :param add: Give a new student the next number.  Otherwise an unknown student is None.
+        """
+        return self._ids.number(student, add=add)
+
+    def append(self, student, question, outcome, timestamp=None):
+        """
+        Add one answer.
+        :param student: Name of the student
+        :param outcome: right, wrong or skip
+        :param timestamp: Seconds since the epoch.  Default is now.
+        """
+        user_answer = question.user_answer
+        self._pending.append(RECORD.pack(
+            _microseconds(time() if timestamp is None else timestamp),
+            self.student_number(student, add=True),
+            question.first_number,
+            question.second_number,
+            MISSING if user_answer is None or user_answer == '' else user_answer,
+            question.correct_answer,
+            float('nan') if question.elapsed is None else question.elapsed,
+            ord(question.operator),
+            OUTCOMES.index(outcome),
+        ))
+        if len(self._pending) >= 4096:
+            self.flush()
+
+    def append_test(self, student, test, timestamp=None):
+        """
+        Add the right, wrong and skipped questions of a Test.
+        """
+        timestamp = time() if timestamp is None else timestamp
+        for outcome in OUTCOMES:
+            for question in test.get(outcome):
+                self.append(student, question, outcome, timestamp)
+
+    def flush(self):
+        """
+        Write the added records to the file, then compact if too many of them aren't indexed.
+        """
+        if self._pending:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(b''.join(self._pending))
+            self._file.flush()
+            self.count += len(self._pending)
+            self._pending = []
+        if self.tail_limit and self.count - self.indexed >= self.tail_limit:
+            self.compact()
+
+    def _records(self):
+        """
+        The record file mapped up to the last flushed record.
+        """
+        if self._map is None or self._mapped != self.count:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped = self.count
+        return self._map
+
+    def record(self, number):
+        """
+        Read one record.
+        :return: Record
+        """
+        values = RECORD.unpack_from(self._records(), HEADER.size + number * RECORD.size)
+        return self._record(values)
+
+    def _record(self, values):
+        microseconds, student, first_number, second_number, user_answer, correct_answer, elapsed, operator, \
+            outcome = values
+        if student >= len(self.names):
+            self._ids.refresh()  # added by another process
+        return Record(microseconds / 1e6, self.names[student], first_number, chr(operator), second_number,
+                      None if user_answer == MISSING else user_answer, correct_answer,
+                      None if elapsed != elapsed else elapsed, OUTCOMES[outcome])
+
+    def _tail(self, start, end):
+        """
+        Unpacked records from start to end, read a chunk at a time.
+        :yields: Tuple of record number and the unpacked record
+        """
+        records = self._records()
+        for chunk in range(start, end, CHUNK_ENTRIES):
+            chunk_end = min(end, chunk + CHUNK_ENTRIES)
+            data = records[HEADER.size + chunk * RECORD.size:HEADER.size + chunk_end * RECORD.size]
+            for number, values in enumerate(RECORD.iter_unpack(data), chunk):
+                yield number, values
+
+    def query(self, student=None, start=None, end=None, operator=None, outcome=None):
+        """
+        Find answers.
+        :param student: Only this student's answers (uses the student index)
+        :param start: Seconds since the epoch of the earliest answer
+        :param end: Seconds since the epoch just after the latest answer
+        :param operator: Only questions with this operator (or any of these operators)
+        :param outcome: Only right, wrong or skip answers
+        :yields: Record, in time order
+        """
+        self.flush()
+        low = -2 ** 63 if start is None else _microseconds(start)
+        high = 2 ** 63 - 1 if end is None else _microseconds(end)
+        operators = None if operator is None else set(ord(x) for x in operator)
+        outcome = None if outcome is None else OUTCOMES.index(outcome)
+        student_number = None
+        if student is not None:
+            student_number = self.student_number(student)
+            if student_number is None:
+                return
+            runs = [((entry[1], entry[2]) for entry in run.range((student_number, low), (student_number, high)))
+                    for run in self.student_runs]
+        else:
+            runs = [run.range((low,), (high,)) for run in self.time_runs]
+        # records that aren't indexed yet are checked one by one; they're in the order they were added, which
+        # isn't time order when answers are added with older timestamps, so they're sorted
+        runs.append(sorted((values[0], number) for number, values in self._tail(self.indexed, self.count)
+                           if low <= values[0] < high and (student_number is None or values[1] == student_number)))
+        records = self._records()
+        for _, record_number in heapq.merge(*runs):
+            values = RECORD.unpack_from(records, HEADER.size + record_number * RECORD.size)
+            if operators is not None and values[7] not in operators:
+                continue
+            if outcome is not None and values[8] != outcome:
+                continue
+            yield self._record(values)
+
+    def _write_run(self, name, kind, layout, entries):
+        """
+        Write sorted entries to a new run file.
+        :return: Number of entries written
+        """
+        count = 0
+        path = self._run_path(name, kind)
+        with open(path + ".tmp", 'wb') as output:
+            chunk = []
+            for entry in entries:
+                chunk.append(layout.pack(*entry))
+                if len(chunk) == CHUNK_ENTRIES:
+                    output.write(b''.join(chunk))
+                    count += len(chunk)
+                    chunk = []
+            output.write(b''.join(chunk))
+            count += len(chunk)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(path + ".tmp", path)
+        return count
+
+    def _save_manifest(self):
+        names = [run.name for run in self.time_runs]
+        with io.open(self.path + ".manifest.tmp", 'w', encoding='utf-8') as manifest:
+            manifest.write(json.dumps(dict(indexed=self.indexed, next_run=self._next_run, runs=names)))
+        os.replace(self.path + ".manifest.tmp", self.path + ".manifest")
+
+    def _new_run_name(self):
+        self._next_run += 1
+        return u"{:06}".format(self._next_run)
+
+    def compact(self):
+        """
+        Index the records added since the last compaction, then merge index runs of similar size.
+        Only the new records and the runs being merged are read; the other runs are left alone.
+        """
+        self.flush_records()
+        while self.indexed < self.count:
+            end = min(self.count, self.indexed + RUN_RECORDS)
+            tail = list(self._tail(self.indexed, end))
+            name = self._new_run_name()
+            self._write_run(name, "time", TIME_ENTRY, sorted((values[0], number) for number, values in tail))
+            self._write_run(name, "student", STUDENT_ENTRY,
+                            sorted((values[1], values[0], number) for number, values in tail))
+            del tail
+            self.time_runs.append(self._open_run(name, "time"))
+            self.student_runs.append(self._open_run(name, "student"))
+            self.indexed = end
+            self._save_manifest()
+        # merge the newest run into the one before it while that one is no more than twice as big,
+        # which keeps the number of runs logarithmic in the number of records
+        while len(self.time_runs) > 1 and len(self.time_runs[-2]) <= 2 * len(self.time_runs[-1]):
+            self._merge_last_two()
+
+    def _merge_last_two(self):
+        name = self._new_run_name()
+        old = []
+        for kind, layout, runs in (("time", TIME_ENTRY, self.time_runs),
+                                   ("student", STUDENT_ENTRY, self.student_runs)):
+            older, newer = runs[-2], runs[-1]
+            self._write_run(name, kind, layout, heapq.merge(older.entries(), newer.entries()))
+            runs[-2:] = [self._open_run(name, kind)]
+            old += [older, newer]
+        self._save_manifest()
+        for run in old:
+            run.close()
+            os.remove(run.path)
+
+    def flush_records(self):
+        """
+        Write the added records without compacting.
+        """
+        tail_limit, self.tail_limit = self.tail_limit, 0
+        try:
+            self.flush()
+        finally:
+            self.tail_limit = tail_limit
+
+    def close(self):
+        self.flush()
+        if self._map is not None:
+            self._map.close()
+        for run in self.time_runs + self.student_runs:
+            run.close()
+        self._file.close()
+        self._ids.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _parse_time(text):
+    """
+    Seconds since the epoch of a local date or date and time like 2017-09-01 or 2017-09-01T08:30.
+    """
+    moment = datetime.fromisoformat(text)
+    if moment.tzinfo is not None:
+        return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+    return mktime(moment.timetuple()) + moment.microsecond / 1e6
+
+
+def benchmark(path, records=1000000, students=10000, queries=1000):
+    """
+    Fill a store with random answers over a year, then time student and time range queries.
+    """
+    import random
+    from timeit import default_timer
+    rand = random.Random(1)
+    now = time()
+    year = 365 * 24 * 3600.0
+    with HistoryStore(path, tail_limit=0) as store:
+        start = default_timer()
+        for _ in range(records):
+            question = mathtest.Question()
+            question.generate_rand_question()
+            question.user_answer = question.correct_answer if rand.random() < 0.8 else ''
+            question.elapsed = rand.uniform(0.5, 15)
+            store.append(u"student{}".format(rand.randrange(students)), question,
+                         "right" if question.user_answer != '' else "skip", now - rand.uniform(0, year))
+        store.flush()
+        print("Appended {} records in {:0.1f}s".format(records, default_timer() - start))
+        start = default_timer()
+        store.compact()
+        print("Indexed in {:0.1f}s ({} runs)".format(default_timer() - start, len(store.time_runs)))
+
+        def student_month():
+            return dict(student=u"student{}".format(rand.randrange(students)), start=now - year / 12, operator='/')
+
+        def everyone_hour():
+            hour = now - rand.uniform(0, year)
+            return dict(start=hour, end=hour + 3600)
+
+        for label, make_query in (("student, last month, division", student_month),
+                                  ("everyone, one hour", everyone_hour)):
+            found = 0
+            start = default_timer()
+            for _ in range(queries):
+                found += sum(1 for _ in store.query(**make_query()))
+            elapsed = default_timer() - start
+            print("{:<32} {:0.3f}ms per query, {:0.1f} records found on average".format(
+                label, elapsed / queries * 1000, found / float(queries)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up answers in a math test history file.")
+    parser.add_argument("history", help="File made with mathtest.py --history")
+    parser.add_argument("-s", "--student", help="Only this student.")
+    parser.add_argument("--since", type=_parse_time, metavar="DATE", help="From this date (2017-09-01).")
+    parser.add_argument("--until", type=_parse_time, metavar="DATE", help="Before this date.")
+    parser.add_argument("-o", "--operator", help="Only these operators ({}). No spaces if multiple.".format(
+                        ' '.join(mathtest.operators).replace('%', '%%')))
+    parser.add_argument("--outcome", choices=OUTCOMES, help="Only right, wrong or skipped answers.")
+    parser.add_argument("--count", action='store_true', help="Only print how many answers match.")
+    parser.add_argument("--compact", action='store_true', help="Index every record before querying.")
+    parser.add_argument("--benchmark", type=int, metavar="RECORDS",
+                        help="Fill a new history file with this many random answers and time queries.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        if os.path.exists(args.history):
+            parser.error("{} already exists; benchmark needs a new file".format(args.history))
+        benchmark(args.history, args.benchmark)
+        return 0
+    with HistoryStore(args.history) as store:
+        if args.compact:
+            store.compact()
+        found = 0
+        for record in store.query(student=args.student, start=args.since, end=args.until, operator=args.operator,
+                                  outcome=args.outcome):
+            found += 1
+            if not args.count:
+                question = mathtest.Question(first_number=record.first_number, operator=record.operator,
+                                             second_number=record.second_number)
+                print(u"{:%Y-%m-%d %H:%M:%S}  {:<12} {:<16} {:>4} {:<5} {}".format(
+                    datetime.fromtimestamp(record.time), record.student,
+                    question.human_readable(), '' if record.user_answer is None else record.user_answer,
+                    record.outcome, '' if record.elapsed is None else "{:0.1f}s".format(record.elapsed)))
+        if args.count:
+            print(found)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
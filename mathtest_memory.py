@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_memory.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Find out what is using the memory in long sessions (python mathtest.py --memory or --memory-budget MB).
+
+tracemalloc remembers where every block of memory was allocated.  MemoryAccounting listens to mathtest's events
+and every few answers takes a snapshot and files each block under the part of the program that allocated it,
+going by the innermost frame of its traceback that is in one of these:
+    results    the answered questions kept in right, wrong and skip (Test.score and the review lists)
+    questions  making questions and the fact index
+    display    display_string, the rows of equations and the visualizations of every registered operator
+    io         reading answers and writing prompts
+    gui        the Tk windows (mathtest_gui and tkinter)
+Blocks made by the other mathtest modules are filed under the module's name (history, export, ...), the samples
+kept by the accounting itself under "accounting" and the rest under "other".
+
+Each sample has the bytes of each part, how much that has grown since accounting started and the growth per
+answered question.  If a budget is set, going over it raises a MemoryBudgetWarning through the warnings module
+naming the part that has grown most.  It warns again only after memory has gone back under the budget.
+Tracing makes every allocation slower, so it is only turned on when asked for.
+"""
+import argparse
+import inspect
+import os
+import sys
+import tracemalloc
+import warnings
+from bisect import bisect_right
+from collections import defaultdict
+
+import mathtest
+
+try:
+    from time import perf_counter
+except ImportError:  # Python 2
+    from time import time as perf_counter
+
+# functions in mathtest whose allocations belong to each part; the visualizers of the operators are added to display
+SUBSYSTEMS = (
+    ("results", ("Test.score", "Test.review_wrong", "Test._move_skipped_to_wrong", "Test.reset", "Test.run_timed",
+                 "Test.skip_unanswered")),
+    ("questions", ("Question.generate_rand_question", "Test.get_questions", "Test._fact_index", "Test._all_questions",
+                   "Test._question_for", "Test.question_list", "Test.assign_worksheets", "Test.deal_worksheets",
+                   "AnswerKey.__init__")),
+    ("display", ("Test.display_string", "Test._rows_str", "Test._row_blocks", "Test.print_rows",
+                 "Question.visualize_string", "Question.human_readable", "ConsoleIO.show_score")),
+    ("io", ("ConsoleIO.write", "ConsoleIO.writeline", "ConsoleIO.read_line", "PipeIO.write", "PipeIO.flush",
+            "PipeIO._fill", "PipeIO.read_line", "ScriptedIO.write", "ScriptedIO.read_line", "Question.prompt",
+            "Question._prompt_steps")),
+)
+TK_MODULES = ("tkinter", "Tkinter", "tkMessageBox")
+HERE = os.path.abspath(__file__)
+IGNORED = (tracemalloc.__file__, __file__)  # tracemalloc's own bookkeeping and the accounting itself
+
+
+class MemoryBudgetWarning(RuntimeWarning):
+    """
+    Traced memory went over the budget.
+    """
+
+
+def _function(name):
+    value = mathtest
+    for part in name.split('.'):
+        value = value.__dict__[part] if isinstance(value, type) else getattr(value, part)
+    return getattr(value, "__func__", value)  # staticmethod and classmethod
+
+
+def _line_ranges():
+    """
+    The lines of each function in SUBSYSTEMS.
+    :return: Dictionary of file name to a sorted list of tuples of first line, last line and part
+    """
+    functions = [(part, _function(name)) for part, names in SUBSYSTEMS for name in names]
+    functions += [("display", operator.visualize) for operator in mathtest.operators.values()
+                  if operator.visualize is not None]
+    functions.append(("accounting", MemoryAccounting))  # the samples and caches kept here
+    ranges = defaultdict(list)
+    for part, function in functions:
+        try:
+            lines, first = inspect.getsourcelines(function)
+            filename = inspect.getsourcefile(function)
+        except (IOError, OSError, TypeError):
+            continue  # no source, e.g. a builtin; its callers decide
+        ranges[os.path.abspath(filename)].append((first, first + len(lines) - 1, part))
+    return dict((filename, sorted(entries)) for filename, entries in ranges.items())
+
+
+class MemoryAccounting(object):
+    """
+    Listener for mathtest events that samples traced memory by part of the program and watches the budget.
+    """
+    def __init__(self, budget=None, interval=25, frames=25):
+        """
+        :param budget: Optional bytes of traced memory to warn above
+        :param interval: Take a sample every this many answers
+        :param frames: Frames of traceback to keep for each allocation; more finds the caller more often
+        """
+        self.budget = budget
+        self.interval = interval
+        self.frames = frames
+        self.answers = 0
+        self.samples = []  # tuples of answers, seconds and dictionary of part -> bytes
+        self.baseline = {}
+        self._ranges = None
+        self._parts = {}  # traceback -> part; most blocks share a few tracebacks
+        self._over = False
+        self._started_tracing = False
+        self._start = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        self._ranges = _line_ranges()
+        self._start = perf_counter()
+        self.baseline = self.sample()[2]
+        return self
+
+    def stop(self):
+        if self in mathtest.listeners:
+            mathtest.listeners.remove(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __call__(self, event, data):
+        if event != "answer":
+            return
+        self.answers += 1
+        if self.answers % self.interval == 0:
+            self.samples.append(self.sample())
+        if self.budget is not None:
+            self.check_budget()
+
+    def _part(self, traceback):
+        part = self._parts.get(traceback)
+        if part is None:
+            part = "other"
+            # innermost frame first; tracebacks are oldest first since Python 3.7
+            for frame in (reversed(traceback) if sys.version_info >= (3, 7) else traceback):
+                filename = os.path.abspath(frame.filename)
+                entries = self._ranges.get(filename)
+                if entries:
+                    index = bisect_right(entries, (frame.lineno, float('inf'))) - 1
+                    if index >= 0 and entries[index][0] <= frame.lineno <= entries[index][1]:
+                        part = entries[index][2]
+                        break
+                name = os.path.splitext(os.path.basename(filename))[0]
+                if name == "mathtest_gui" or any(module in filename for module in TK_MODULES):
+                    part = "gui"
+                    break
+                if name.startswith("mathtest_") and filename != HERE:
+                    part = name[len("mathtest_"):]
+                    break
+            self._parts[traceback] = part
+        return part
+
+    def sample(self):
+        """
+        Take a snapshot and add up the traced bytes of each part.
+        :return: Tuple of answers so far, seconds since starting and dictionary of part -> bytes
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED])
+        parts = defaultdict(int)
+        for trace in snapshot.traces:
+            parts[self._part(trace.traceback)] += trace.size
+        return self.answers, perf_counter() - self._start, dict(parts)
+
+    def growth(self, parts=None):
+        """
+        :param parts: Dictionary of part -> bytes; default is the last sample
+        :return: Dictionary of part -> bytes grown since starting
+        """
+        if parts is None:
+            parts = self.samples[-1][2] if self.samples else self.baseline
+        return dict((part, parts.get(part, 0) - self.baseline.get(part, 0)) for part in set(parts) | set(self.baseline))
+
+    def check_budget(self):
+        """
+        Warn once if traced memory is over the budget.  Cheap enough to call after every answer.
+        """
+        current = tracemalloc.get_traced_memory()[0]
+        if current <= self.budget:
+            self._over = False
+            return
+        if self._over:
+            return
+        self._over = True
+        sample = self.sample()
+        self.samples.append(sample)
+        growth = self.growth(sample[2])
+        worst = max(growth, key=growth.get)
+        warnings.warn(MemoryBudgetWarning(
+            "Traced memory is {:0.1f} MB, over the budget of {:0.1f} MB after {} answers; "
+            "{} has grown most (+{:0.1f} kB, {:0.0f} bytes per answer)".format(
+                current / 1e6, self.budget / 1e6, self.answers, worst, growth[worst] / 1e3,
+                growth[worst] / float(max(self.answers, 1)))), stacklevel=2)
+
+    def report_lines(self):
+        """
+        The memory of each part now, how much it has grown and the growth over time.
+        :return: List of lines
+        """
+        answers, seconds, parts = self.sample()
+        growth = self.growth(parts)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Memory after {} answers: {:0.1f} kB traced, {:0.1f} kB at most".format(
+            answers, current / 1e3, peak / 1e3),
+            "{:<12}{:>12}{:>12}{:>14}".format("Part", "Bytes", "Growth", "Per answer")]
+        for part in sorted(set(parts) | set(growth), key=lambda part: -parts.get(part, 0)):
+            lines.append("{:<12}{:>12}{:>+12}{:>14.1f}".format(
+                part, parts.get(part, 0), growth[part], growth[part] / float(max(answers, 1))))
+        if self.samples:
+            lines.append("{:>8}{:>10}{:>14}".format("Answers", "Seconds", "Bytes"))
+            for sample_answers, sample_seconds, sample_parts in self.samples:
+                lines.append("{:>8}{:>10.1f}{:>14}".format(sample_answers, sample_seconds,
+                                                           sum(sample_parts.values())))
+        return lines
+
+
+def enable(budget=None, interval=25, frames=25):
+    """
+    Start memory accounting for mathtest.
+    :param budget: Optional bytes of traced memory to warn above
+    :return: MemoryAccounting; call report_lines() for the results and stop() when done
+    """
+    accounting = MemoryAccounting(budget, interval, frames).start()
+    mathtest.listeners.append(accounting)
+    return accounting
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a long scripted test and show where the memory goes.")
+    parser.add_argument("-q", "--questions", type=int, default=2000, help="Questions to answer. Default 2000.")
+    parser.add_argument("-i", "--interval", type=int, default=250, help="Answers between samples. Default 250.")
+    parser.add_argument("-b", "--budget", type=float, metavar="MB", help="Warn when traced memory is over this.")
+    args = parser.parse_args()
+
+    accounting = enable(None if args.budget is None else args.budget * 1e6, args.interval)
+    test = mathtest.Test()
+    answers = ["1"] * args.questions
+    try:
+        test.run(io=mathtest.ScriptedIO(answers), questions=args.questions)
+    except EOFError:
+        pass  # ran out of answers while reviewing
+    print('\n'.join(accounting.report_lines()))
+    accounting.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_metrics.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Prometheus metrics for kiosks and labs (python mathtest.py --metrics-port 9100).
+
+Metrics are collected from the events in mathtest.listeners and served as Prometheus text on
+http://127.0.0.1:PORT/metrics.  The thread running the test changes the numbers while the HTTP thread reads them,
+so both take a lock; it's never contended except during a scrape and costs well under a microsecond per event.
+"""
+import os
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+import mathtest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+ANSWER_BUCKETS = (0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)  # seconds
+RENDER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class Histogram(object):
+    """
+    Counts of observations at or below each bucket bound, plus their sum.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """
+        Prometheus lines for this histogram (buckets are cumulative).
+        """
+        lines = []
+        total = 0
+        for bound, count in zip(list(self.bounds) + ["+Inf"], list(self.counts)):
+            total += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, total))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels.rstrip(','), self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels.rstrip(','), total))
+        return lines
+
+
+def resident_bytes():
+    """
+    Current resident memory of this process, or the peak if the current value isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+class Metrics(object):
+    """
+    Listener for mathtest events that keeps counters and histograms.
+    """
+    def __init__(self):
+        self.questions = defaultdict(int)  # operator -> count
+        self.answers = defaultdict(int)  # (outcome, operator) -> count
+        self.answer_seconds = defaultdict(lambda: Histogram(ANSWER_BUCKETS))  # operator -> Histogram
+        self.render_seconds = defaultdict(lambda: Histogram(RENDER_BUCKETS))  # name -> Histogram
+        self.lock = threading.Lock()  # new keys are added while a scrape may be reading
+
+    def __call__(self, event, data):
+        with self.lock:
+            if event == "question":
+                self.questions[data["question"].operator] += 1
+            elif event == "answer":
+                question = data["question"]
+                self.answers[(data["outcome"], question.operator)] += 1
+                if question.elapsed is not None:
+                    self.answer_seconds[question.operator].observe(question.elapsed)
+            elif event == "render":
+                self.render_seconds[data["name"]].observe(data["seconds"])
+
+    def exposition(self):
+        """
+        All metrics in the Prometheus text format.
+        """
+        with self.lock:
+            lines = self._metric_lines()
+        lines += [
+            "# HELP process_resident_memory_bytes Resident memory size in bytes.",
+            "# TYPE process_resident_memory_bytes gauge",
+            "process_resident_memory_bytes {}".format(resident_bytes()),
+        ]
+        return u'\n'.join(lines) + u'\n'
+
+    def _metric_lines(self):
+        lines = [
+            "# HELP mathtest_questions_generated_total Questions generated.",
+            "# TYPE mathtest_questions_generated_total counter",
+        ]
+        for operator, count in sorted(self.questions.items()):
+            lines.append('mathtest_questions_generated_total{{operator="{}"}} {}'.format(operator, count))
+        lines += [
+            "# HELP mathtest_answers_total Answers scored by outcome.",
+            "# TYPE mathtest_answers_total counter",
+        ]
+        for (outcome, operator), count in sorted(self.answers.items()):
+            lines.append('mathtest_answers_total{{outcome="{}",operator="{}"}} {}'.format(outcome, operator, count))
+        lines += [
+            "# HELP mathtest_answer_seconds Time taken to answer a question.",
+            "# TYPE mathtest_answer_seconds histogram",
+        ]
+        for operator, histogram in sorted(self.answer_seconds.items()):
+            lines += histogram.lines("mathtest_answer_seconds", 'operator="{}",'.format(operator))
+        lines += [
+            "# HELP mathtest_render_seconds Time taken to build display_string and visualize_string.",
+            "# TYPE mathtest_render_seconds histogram",
+        ]
+        for name, histogram in sorted(self.render_seconds.items()):
+            lines += histogram.lines("mathtest_render_seconds", 'function="{}",'.format(name))
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None  # set by start_server
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.metrics.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # don't print a line for every scrape over the test
+
+
+def start_server(metrics, port, host="127.0.0.1"):
+    """
+    Serve metrics on a background thread.
+    :return: HTTPServer; call shutdown() to stop it
+    """
+    handler = type("BoundMetricsHandler", (MetricsHandler,), dict(metrics=metrics))
+    server = HTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="mathtest-metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def enable(port, host="127.0.0.1"):
+    """
+    Start collecting metrics from mathtest and serve them.
+    :return: Tuple of Metrics and the HTTPServer
+    """
+    metrics = Metrics()
+    mathtest.listeners.append(metrics)
+    return metrics, start_server(metrics, port, host)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_print.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Print worksheets and answer keys as SVG or PostScript.
+
+Pages use the same grid of 5 character cells as the score display (Test._row_blocks) in a monospaced font.
+Pages are written to disk one at a time as they are rendered, so a print run of any size uses the same memory.
+PostScript goes in one file with a page per worksheet page; SVG has no pages, so each page is its own file.
+"""
+import argparse
+import io
+import os
+import random
+import tempfile
+from functools import lru_cache
+from itertools import islice
+
+import mathtest
+
+RENDERER_VERSION = 2
+
+PAGE_WIDTH = 612  # US letter in points
+PAGE_HEIGHT = 792
+MARGIN = 36
+FONT_SIZE = 12.0
+MIN_FONT_SIZE = 9.0  # smallest font that's still easy to read; longer pages go on to another page
+CHARACTER_WIDTH = 0.6  # width of a Courier character in ems
+LINE_HEIGHT = 1.2  # line spacing in ems
+
+
+def page_lines(questions, columns=8, answer_key=False, visualize=False, title=u''):
+    """
+    Lay out one page of questions as lines of text.
+    :param questions: Questions on the page
+    :param columns: Questions per row
+    :param answer_key: Show the correct answers under the blank answer lines
+    :param visualize: Add the visualization of every question under its row
+    :param title: Line at the top of the page
+    :return: List of strings
+    """
+    lines = [title, u'']
+    number = 0
+    for block in mathtest.Test._row_blocks(questions, columns=columns, showing_answers=answer_key,
+                                           user_answers=False):
+        for line in block:
+            lines.append(u''.join(line).rstrip())
+        lines.append(u'')
+        if visualize:
+            for question in questions[number:number + len(block[0])]:
+                number += 1
+                lines.append(u"{}) {}".format(number, question.human_readable()))
+                lines.extend(question.visualize_string().rstrip().split('\n'))
+                lines.append(u'')
+    return lines
+
+
+@lru_cache(maxsize=None)
+def _page_template(fmt, font_size):
+    """
+    The text that starts and ends a page.  Only the font size changes between pages.
+    :return: Tuple of header and footer
+    """
+    if fmt == 'svg':
+        header = u'<?xml version="1.0" encoding="UTF-8"?>\n' \
+                 u'<svg xmlns="http://www.w3.org/2000/svg" width="{w}pt" height="{h}pt" viewBox="0 0 {w} {h}">\n' \
+                 u'<rect width="100%" height="100%" fill="white"/>\n' \
+                 u'<g font-family="Courier New, Courier, monospace" font-size="{f:g}" xml:space="preserve">\n'
+        footer = u'</g>\n</svg>\n'
+    else:
+        header = u'/Courier-Latin1 findfont {f:g} scalefont setfont\n'
+        footer = u'showpage\n'
+    return header.format(w=PAGE_WIDTH, h=PAGE_HEIGHT, f=font_size), footer
+
+
+POSTSCRIPT_PROLOG = u"""%!PS-Adobe-3.0
+%%Creator: mathtest_print
+%%Pages: (atend)
+%%EndComments
+%%BeginProlog
+/Courier findfont dup length dict begin
+  { 1 index /FID ne { def } { pop pop } ifelse } forall
+  /Encoding ISOLatin1Encoding def
+  currentdict
+end /Courier-Latin1 exch definefont pop
+%%EndProlog
+"""
+
+
+@lru_cache(maxsize=4096)
+def _glyph_run(fmt, line):
+    """
+    Escape one line of text for the output format.  Worksheet lines repeat a lot, so these are cached.
+    """
+    if fmt == 'svg':
+        return line.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+    run = []
+    for character in line:
+        if character in u'()\\':
+            run.append(u'\\' + character)
+        elif ord(character) < 128:
+            run.append(character)
+        elif ord(character) < 256:
+            run.append(u'\\{:03o}'.format(ord(character)))  # Latin-1, e.g. × and ÷
+        else:
+            run.append(u'?')
+    return u''.join(run)
+
+
+def _split_lines(lines, per_page):
+    """
+    Split the lines of a page that's too long into pages of at most per_page lines, breaking at blank lines so
+    rows and pictures stay together.  Pages after the first repeat the title (the first line).
+    :return: List of lists of lines
+    """
+    pages = []
+    continued = [lines[0] + u" (continued)", u'']
+    while len(lines) > per_page:
+        blanks = [number for number in range(len(continued) + 1, per_page + 1) if lines[number] == u'']
+        cut = blanks[-1] if blanks else per_page
+        pages.append(lines[:cut])
+        rest = lines[cut:]
+        while rest and rest[0] == u'':
+            rest = rest[1:]
+        lines = continued + rest
+    pages.append(lines)
+    return pages
+
+
+def render_pages(fmt, lines):
+    """
+    Render the lines of one worksheet page.  The font shrinks to fit down to MIN_FONT_SIZE; lines that still
+    don't fit go on more pages.
+    :return: List of strings, each a whole page (PostScript pages without their %%Page comment)
+    """
+    usable_height = PAGE_HEIGHT - 2 * MARGIN
+    usable_width = PAGE_WIDTH - 2 * MARGIN
+    longest = max([len(line) for line in lines] + [1])
+    font_size = min(FONT_SIZE, usable_height / (len(lines) * LINE_HEIGHT), usable_width / (longest * CHARACTER_WIDTH))
+    font_size = max(MIN_FONT_SIZE, round(font_size, 1))
+    header, footer = _page_template(fmt, font_size)
+    rendered = []
+    for chunk in _split_lines(lines, int(usable_height / (font_size * LINE_HEIGHT))):
+        page = [header]
+        for number, line in enumerate(chunk):
+            if line == u'':
+                continue
+            baseline = MARGIN + (number + 1) * font_size * LINE_HEIGHT
+            if fmt == 'svg':
+                page.append(u'<text x="{}" y="{:g}">{}</text>\n'.format(MARGIN, baseline, _glyph_run(fmt, line)))
+            else:
+                page.append(u'{} {:g} moveto ({}) show\n'.format(MARGIN, PAGE_HEIGHT - baseline,
+                                                                _glyph_run(fmt, line)))
+        page.append(footer)
+        rendered.append(u''.join(page))
+    return rendered
+
+
+def _render_job(job):
+    """
+    Lay out and render the pages of one page of questions.  Runs in the worker processes, so it takes one argument.
+    """
+    fmt, questions, options = job
+    return render_pages(fmt, page_lines(questions, **options))
+
+
+def _pages(worksheets, per_page, title):
+    """
+    Split worksheets into pages without reading more than one page ahead.
+    :yields: Tuple of page title and the Questions on that page
+    """
+    for number, worksheet in enumerate(worksheets):
+        worksheet = iter(worksheet)
+        page = list(islice(worksheet, per_page))
+        sheet_page = 1
+        while page:
+            yield u"{}  #{} page {}".format(title, number + 1, sheet_page), page
+            page = list(islice(worksheet, per_page))
+            sheet_page += 1
+
+
+def page_path(path, page_number):
+    """
+    The file an SVG page is written to: sheet.svg -> sheet-0001.svg
+    """
+    base, extension = os.path.splitext(path)
+    return u"{}-{:04}{}".format(base, page_number, extension)
+
+
+def render(worksheets, path, fmt=None, columns=8, rows=5, answer_key=False, visualize=False,
+           title=u"Name: ______________________", workers=1):
+    """
+    Render worksheets to disk.
+    :param worksheets: Iterable of worksheets, each an iterable of Questions.  Each worksheet starts a new page.
+    :param path: Output file.  For SVG, page numbers are added to the name (sheet.svg -> sheet-0001.svg).
+    :param fmt: 'svg' or 'ps'.  Default comes from the path's extension.
+    :param columns: Questions per row
+    :param rows: Rows of questions per page
+    :param answer_key: Print the correct answers
+    :param visualize: Print the visualization of each question
+    :param workers: Number of processes to render pages with
+    :return: List of files written
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in ('svg', 'ps'):
+        raise ValueError("Unknown format '{}'. Use svg or ps.".format(fmt))
+    options = dict(columns=columns, answer_key=answer_key, visualize=visualize)
+    jobs = ((fmt, questions, dict(options, title=page_title))
+            for page_title, questions in _pages(worksheets, columns * rows, title))
+
+    pool = None
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        rendered = mathtest.imap_bounded(pool, _render_job, jobs, workers * 4)
+    else:
+        rendered = (_render_job(job) for job in jobs)
+
+    written = []
+    output = None
+    try:
+        if fmt == 'ps':
+            output = io.open(path, 'w', encoding='latin-1', newline='\n')
+            output.write(POSTSCRIPT_PROLOG)
+            written.append(path)
+        pages = 0
+        for job_pages in rendered:
+            for page in job_pages:
+                pages += 1
+                if fmt == 'svg':
+                    with io.open(page_path(path, pages), 'w', encoding='utf-8', newline='\n') as page_file:
+                        page_file.write(page)
+                    written.append(page_path(path, pages))
+                else:
+                    output.write(u'%%Page: {n} {n}\n'.format(n=pages))
+                    output.write(page)
+        if fmt == 'ps':
+            output.write(u"%%Trailer\n%%Pages: {}\n%%EOF\n".format(pages))
+    finally:
+        if output is not None:
+            output.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return written
+
+
+def _write_atomically(path, data):
+    """
+    Write a file through a temporary file renamed into place, so it's never seen half written.
+    """
+    descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            output.write(data)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)  # mkstemp makes the file private; give it the usual permissions
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print math worksheets as SVG or PostScript.")
+    parser.add_argument("output", help="File to write: worksheet.ps or worksheet.svg")
+    parser.add_argument("-o", "--operator", help="Type of questions ({}). No spaces if multiple.".format(
+                        ' '.join(mathtest.operators).replace('%', '%%')),
+                        metavar="OPERATOR or OPERATORS")
+    parser.add_argument("-q", "--questions", type=int, default=40, help="Questions per worksheet. Default 40.")
+    parser.add_argument("-s", "--students", type=int, default=1, help="Number of worksheets. Default 1.")
+    parser.add_argument("-c", "--columns", type=int, default=8, help="Questions per row. Default 8.")
+    parser.add_argument("-r", "--rows", type=int, default=5, help="Rows per page. Default 5.")
+    parser.add_argument("-a", "--answer-key", action='store_true', help="Print the answer key.")
+    parser.add_argument("-v", "--visualize", action='store_true', help="Print a visualization of each question.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Processes to render with. Default 1.")
+    parser.add_argument("--seed", type=int, help="Seed so the same worksheets can be printed again.")
+    parser.add_argument("--cache", metavar="DIRECTORY",
+                        help="Keep rendered worksheets here and copy them when the same ones are printed again. "
+                             "Without --seed one is picked and printed so the same worksheets can be asked for.")
+    parser.add_argument("--cache-mb", type=float, default=256, help="Largest size of the cache. Default 256 MB.")
+    args = parser.parse_args()
+
+    kwargs = dict(questions=args.questions)
+    if args.operator:
+        kwargs["valid_operators"] = [x for x in args.operator]
+    options = dict(columns=args.columns, rows=args.rows, answer_key=args.answer_key, visualize=args.visualize)
+    cache = config = None
+    if args.cache and args.seed is None:
+        # worksheets are only the same again with the same seed
+        args.seed = random.SystemRandom().randrange(2 ** 31)
+        print("Using --seed {}; print with it again to copy these worksheets from the cache.".format(args.seed))
+    if args.cache:
+        import mathtest_cache
+        cache = mathtest_cache.RenderCache(args.cache, int(args.cache_mb * 1024 * 1024))
+        fmt = os.path.splitext(args.output)[1].lstrip('.').lower()
+        config = mathtest_cache.worksheet_config(args.seed, args.students, fmt=fmt, **dict(kwargs, **options))
+        entry = cache.get(config)
+        if entry is not None:
+            with entry:
+                written = [args.output] if fmt == 'ps' else [page_path(args.output, number + 1)
+                                                             for number in range(len(entry.parts))]
+                for path, part in zip(written, entry.parts):
+                    _write_atomically(path, part)
+            print("Copied {} file{} from the cache.".format(len(written), '' if len(written) == 1 else 's'))
+            return 0
+    if args.seed is not None:
+        random.seed(args.seed)
+    worksheets = mathtest.Test().deal_worksheets(args.students, **kwargs)
+    written = render(worksheets, args.output, workers=args.workers, **options)
+    if cache is not None:
+        cache.put(config, written)
+    print("Wrote {} file{}.".format(len(written), '' if len(written) == 1 else 's'))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
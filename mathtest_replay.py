@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_replay.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Record test sessions and replay them through Test without anyone typing.
+
+Record with python mathtest.py --record sessions.jsonl.  Each line of the file is one session: the random seed,
+the settings, every prompt with the answer typed and how long it took, the right/wrong/skip lists and the final
+score display.  Replaying runs the same settings and seed with the recorded answers and reports any differences.
+
+Questions can also depend on things outside the settings.  With --student the student's coverage at the start is
+saved in the session, and with --bank the bank's path and a hash of its contents; a bank that has changed since is
+reported as a difference instead of replaying other questions.
+"""
+import argparse
+import base64
+import difflib
+import hashlib
+import io
+import json
+import random
+import sys
+from time import sleep
+
+import mathtest
+
+try:
+    from time import perf_counter
+except ImportError:  # Python 2
+    from time import time as perf_counter
+
+VERSION = 1
+TIMED_OUT = object()  # stands in for a recorded answer of None (time ran out) among the answers ScriptedIO gives back
+
+
+class RecordingIO(mathtest.ConsoleIO):
+    """
+    Pass everything through to another backend and remember the prompts, answers and timings.
+    """
+    def __init__(self, inner):
+        self.inner = inner
+        self.answers = []
+        self._last = perf_counter()
+
+    def write(self, text):
+        self.inner.write(text)
+
+    def writeline(self, text=''):
+        self.inner.writeline(text)
+
+    def read_line(self, prompt='', timeout=None):
+        if timeout is None:
+            answer = self.inner.read_line(prompt)
+        else:
+            answer = self.inner.read_line(prompt, timeout=timeout)
+        now = perf_counter()
+        self.answers.append(dict(prompt=prompt, answer=answer, delay=round(now - self._last, 6)))
+        self._last = now
+        return answer
+
+    def attach(self, test):
+        self.inner.attach(test)
+
+    def show_score(self, test, **kwargs):
+        self.inner.show_score(test, **kwargs)
+
+    def close(self):
+        self.inner.close()
+
+
+class ReplayIO(mathtest.ScriptedIO):
+    """
+    Give the recorded answers back, optionally waiting as long as the student did.
+    The prompts asked are kept in self.prompts to compare with the recording.
+    """
+    def __init__(self, answers, realtime=False):
+        mathtest.ScriptedIO.__init__(self, [TIMED_OUT if answer["answer"] is None else answer["answer"]
+                                            for answer in answers])
+        self.delays = iter([answer["delay"] for answer in answers])
+        self.realtime = realtime
+        self.prompts = []
+
+    def read_line(self, prompt='', timeout=None):
+        self.prompts.append(prompt)
+        delay = next(self.delays, 0)
+        if self.realtime and delay > 0:
+            sleep(delay)
+        answer = mathtest.ScriptedIO.read_line(self, prompt)
+        return None if answer is TIMED_OUT else answer
+
+
+def _values(question_list):
+    return [list(question.values()) for question in question_list]
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def session_record(test, recording_io, seed, kwargs, coverage=None):
+    """
+    Make the record of a finished session.
+    :param coverage: Optional Coverage bitmap (bytes) the student started with
+    :return: Dictionary that can be saved as JSON
+    """
+    config = mathtest.config_of(kwargs)
+    record = dict(
+        version=VERSION,
+        seed=seed,
+        config=config,
+        answers=recording_io.answers,
+        right=_values(test.right),
+        wrong=_values(test.wrong),
+        skip=_values(test.skip),
+        display=test.display_string(showing_answers=True, **config),
+    )
+    if coverage is not None:
+        record["coverage"] = dict(size=len(kwargs["coverage"]), bits=base64.b64encode(coverage).decode('ascii'))
+    if isinstance(kwargs.get("bank"), (str, type(u''))):
+        record["bank"] = dict(path=kwargs["bank"], sha256=_file_hash(kwargs["bank"]))
+    return record
+
+
+def save(path, record):
+    """
+    Append a session to a recording file.
+    """
+    with io.open(path, 'a', encoding='utf-8') as output:
+        output.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + u'\n')
+
+
+def load(path):
+    """
+    Read every session in a recording file.
+    :yields: Dictionary per session
+    """
+    with io.open(path, encoding='utf-8') as input_file:
+        for line in input_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def replay(record, realtime=False):
+    """
+    Run a recorded session again.
+    :param realtime: Wait as long as the student took before each answer
+    :return: List of difference lines; empty if the replay matches the recording
+    """
+    if record.get("version") != VERSION:
+        return ["unsupported recording version {}".format(record.get("version"))]
+    config = record["config"]
+    kwargs = dict(config)
+    if "bank" in record:
+        bank = record["bank"]
+        try:
+            changed = _file_hash(bank["path"]) != bank["sha256"]
+        except (IOError, OSError):
+            return ["question bank {} is missing".format(bank["path"])]
+        if changed:
+            return ["question bank {} has changed since the session was recorded".format(bank["path"])]
+        kwargs["bank"] = bank["path"]
+    if "coverage" in record:
+        from mathtest_coverage import Coverage
+        kwargs["coverage"] = Coverage(record["coverage"]["size"], base64.b64decode(record["coverage"]["bits"]))
+    random.seed(record["seed"])
+    test = mathtest.Test(**config)
+    replay_io = ReplayIO(record["answers"], realtime=realtime)
+    try:
+        test.run(io=replay_io, **kwargs)
+    except EOFError:
+        pass  # the student stopped here
+
+    differences = []
+    recorded_prompts = [answer["prompt"] for answer in record["answers"]]
+    if replay_io.prompts[:len(recorded_prompts)] != recorded_prompts:
+        differences += difflib.unified_diff(recorded_prompts, replay_io.prompts, "recorded prompts",
+                                            "replayed prompts", lineterm='')
+    for name in ("right", "wrong", "skip"):
+        replayed = _values(test.get(name))
+        if replayed != record[name]:
+            differences += difflib.unified_diff([repr(x) for x in record[name]], [repr(x) for x in replayed],
+                                                "recorded " + name, "replayed " + name, lineterm='')
+    display = test.display_string(showing_answers=True, **config)
+    if display != record["display"]:
+        differences += difflib.unified_diff(record["display"].split('\n'), display.split('\n'),
+                                            "recorded display", "replayed display", lineterm='')
+    return differences
+
+
+def _replay_chunk(args):
+    records, realtime = args
+    return [replay(record, realtime=realtime) for record in records]
+
+
+def replay_all(records, realtime=False, workers=1, chunk_size=100):
+    """
+    Replay many sessions.
+    :yields: Tuple of session number and its list of differences, in order
+    """
+    def chunks():
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                yield chunk, realtime
+                chunk = []
+        if chunk:
+            yield chunk, realtime
+
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        results = mathtest.imap_bounded(pool, _replay_chunk, chunks(), workers * 2)
+    else:
+        pool = None
+        results = (_replay_chunk(chunk) for chunk in chunks())
+    number = 0
+    try:
+        for result in results:
+            for differences in result:
+                yield number, differences
+                number += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded math test sessions and report differences.")
+    parser.add_argument("recording", help="File made with mathtest.py --record")
+    parser.add_argument("-r", "--realtime", action='store_true', help="Wait as long as the student did.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Processes to replay with. Default 1.")
+    parser.add_argument("-q", "--quiet", action='store_true', help="Only print the summary.")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    sessions = 0
+    different = 0
+    for number, differences in replay_all(load(args.recording), realtime=args.realtime, workers=args.workers):
+        sessions += 1
+        if differences:
+            different += 1
+            if not args.quiet:
+                print("Session {} differs:".format(number + 1))
+                print('\n'.join(differences))
+                print('')
+    elapsed = perf_counter() - start
+    print("Replayed {} sessions in {:0.3f}s ({:0.0f}/s); {} differ.".format(
+        sessions, elapsed, sessions / elapsed if elapsed > 0 else 0, different))
+    return 1 if different else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_report.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Score sheets and class summaries for a whole class, school or district.
+
+Sessions are read from a results file made with mathtest.py --export (CSV) or a recording made with --record.
+An optional roster CSV with session, student and class columns names the students and puts them in classes.
+
+Sessions are handed to worker processes in chunks.  Each worker lays out the score sheets for its chunk with
+Test.display_string and counts the answers of every class in a Summary: accuracy per operator and per fact and
+the grade distribution.  The parent writes the sheets to the report in session order as chunks come back and adds
+the chunk's Summaries into the running totals, so it only ever holds a few chunks and one Summary per class.
+The class summaries are written after the last score sheet.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from collections import Counter
+
+import mathtest
+
+try:
+    from time import perf_counter
+except ImportError:  # Python 2
+    from time import time as perf_counter
+
+if sys.version_info.major == 3:
+    unicode = str
+
+OUTCOMES = ("right", "wrong", "skip")
+GRADES = ((90, "A"), (80, "B"), (70, "C"), (60, "D"), (0, "F"))  # lowest percentage for each grade
+EVERYONE = u"Everyone"
+
+
+def letter_grade(percentage):
+    for lowest, grade in GRADES:
+        if percentage >= lowest:
+            return grade
+    return GRADES[-1][1]
+
+
+class Summary(object):
+    """
+    Answer counts for a group of sessions.  Summaries of different sessions can be added together with merge.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.sessions = 0
+        self.operators = Counter()  # (operator, outcome) -> answers
+        self.facts = Counter()  # (first number, operator, second number, outcome) -> answers
+        self.grades = Counter()  # letter grade -> sessions
+
+    def add(self, test):
+        """
+        Count the answers of one finished Test.
+        """
+        self.sessions += 1
+        for outcome in OUTCOMES:
+            for question in test.get(outcome):
+                self.operators[(question.operator, outcome)] += 1
+                self.facts[(question.first_number, question.operator, question.second_number, outcome)] += 1
+        self.grades[letter_grade(test.grade)] += 1
+
+    def merge(self, other):
+        """
+        Add the counts of another Summary to this one.
+        :return: self
+        """
+        self.sessions += other.sessions
+        self.operators.update(other.operators)
+        self.facts.update(other.facts)
+        self.grades.update(other.grades)
+        return self
+
+    def operator_accuracy(self):
+        """
+        :return: List of tuples of operator, right, wrong, skipped and percent right; in registry order
+        """
+        rows = []
+        for operator in mathtest.operators:
+            right, wrong, skip = [self.operators[(operator, outcome)] for outcome in OUTCOMES]
+            if right + wrong + skip:
+                rows.append((operator, right, wrong, skip, 100.0 * right / (right + wrong + skip)))
+        return rows
+
+    def hardest_facts(self, count=10, least_answers=3):
+        """
+        The facts answered right least often.
+        :param count: Number of facts
+        :param least_answers: Only facts asked at least this many times
+        :return: List of tuples of Fact, times right, times asked and percent right
+        """
+        asked = Counter()
+        right = Counter()
+        for (first_number, operator, second_number, outcome), answers in self.facts.items():
+            fact = (first_number, operator, second_number)
+            asked[fact] += answers
+            if outcome == "right":
+                right[fact] += answers
+        rows = [(100.0 * right[fact] / answers, -answers, fact) for fact, answers in asked.items()
+                if answers >= least_answers]
+        rows.sort()
+        return [(mathtest.Fact(*fact), right[fact], -answers, percentage)
+                for percentage, answers, fact in rows[:count]]
+
+    def lines(self, facts=10):
+        """
+        The summary laid out for the report.
+        :param facts: Number of hardest facts to list
+        :return: List of lines
+        """
+        lines = [u"{}: {} session{}".format(self.name, self.sessions, '' if self.sessions == 1 else 's'), u""]
+        lines.append(u"Grades:   " + u"  ".join(u"{} {:>4}".format(grade, self.grades[grade]) for _, grade in GRADES))
+        lines.append(u"")
+        lines.append(u"Operator   Right   Wrong  Skipped  Percentage")
+        for operator, right, wrong, skip, percentage in self.operator_accuracy():
+            lines.append(u"   {:<5} {:>7} {:>7} {:>8}  {:>9.2f}%".format(
+                unicode(operator).translate(mathtest.operator_translation), right, wrong, skip, percentage))
+        hardest = self.hardest_facts(facts)
+        if hardest:
+            lines += [u"", u"Hardest facts:"]
+            for fact, right, asked, percentage in hardest:
+                lines.append(u"   {:<12} {:>5} of {:<5} right  {:>6.2f}%".format(
+                    unicode(fact).translate(mathtest.operator_translation).rstrip(), right, asked, percentage))
+        lines.append(u"")
+        return lines
+
+
+def _question(row):
+    """
+    Make a scored Question from a row of outcome, first number, operator, second number, user's answer and elapsed.
+    """
+    outcome, first_number, operator, second_number, user_answer, elapsed = row
+    question = mathtest.Question(first_number=first_number, operator=operator, second_number=second_number,
+                                 valid_operators=list(mathtest.operators))
+    question.user_answer = u'' if outcome == "skip" and user_answer is None else user_answer
+    question.elapsed = elapsed
+    return question
+
+
+def session_test(rows):
+    """
+    Rebuild a finished Test from the rows of one session.
+    """
+    test = mathtest.Test()
+    for row in rows:
+        test.get(row[0]).append(_question(row))
+    return test
+
+
+def score_sheet(test, number, student, class_name, columns=16):
+    """
+    One student's score sheet: a heading, the grade and the usual score display.
+    """
+    if student:
+        heading = u"{} (session {}{})".format(student, number, u", " + class_name if class_name else u"")
+    else:
+        heading = u"Session {}{}".format(number, u" (" + class_name + u")" if class_name else u"")
+    return u"{}\n{}\nGrade: {} ({:0.2f}%)\n{}\n".format(
+        heading, u"=" * len(heading), letter_grade(test.grade), test.grade,
+        test.display_string(showing_answers=True, columns=columns))
+
+
+def _report_chunk(job):
+    """
+    Score sheets and Summaries for a chunk of sessions.  Runs in the worker processes, so it takes one argument.
+    :return: Tuple of the sheets (one string) and a dictionary of class name to Summary
+    """
+    sessions, options = job
+    sheets = []
+    summaries = {}
+    for number, student, class_name, rows in sessions:
+        test = session_test(rows)
+        if options["sheets"]:
+            sheets.append(score_sheet(test, number, student, class_name, columns=options["columns"]))
+        summaries.setdefault(class_name, Summary(class_name)).add(test)
+    return u''.join(sheets), summaries
+
+
+def exported_sessions(path):
+    """
+    Read the sessions in a CSV results file (mathtest.py --export) one at a time.
+    :yields: Tuple of session number and its list of rows
+    """
+    with io.open(path, newline='') as input_file:
+        reader = csv.reader(input_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [header.index(name) for name in ("session", "outcome", "first_number", "operator",
+                                                   "second_number", "user_answer", "elapsed")]
+        session = None
+        rows = []
+        for row in reader:
+            number, outcome, first_number, operator, second_number, user_answer, elapsed = [row[x] for x in columns]
+            number = int(number)
+            if number != session:
+                if rows:
+                    yield session, rows
+                session = number
+                rows = []
+            rows.append((outcome, int(first_number), operator, int(second_number),
+                         int(user_answer) if user_answer != '' else None, float(elapsed) if elapsed != '' else None))
+        if rows:
+            yield session, rows
+
+
+def recorded_sessions(path):
+    """
+    Read the sessions in a recording (mathtest.py --record) one at a time.
+    :yields: Tuple of session number and its list of rows
+    """
+    import mathtest_replay
+    for number, record in enumerate(mathtest_replay.load(path)):
+        yield number, [(outcome, first_number, operator, second_number, user_answer, None)
+                       for outcome in OUTCOMES
+                       for first_number, operator, second_number, user_answer in record[outcome]]
+
+
+def load_roster(path):
+    """
+    Read a roster CSV with session, student and class columns.
+    :return: Dictionary of session number to tuple of student and class
+    """
+    with io.open(path, newline='') as input_file:
+        return dict((int(row["session"]), (row.get("student") or u'', row.get("class") or u''))
+                    for row in csv.DictReader(input_file))
+
+
+def _chunks(sessions, roster, chunk_size, options):
+    chunk = []
+    for number, rows in sessions:
+        student, class_name = roster.get(number, (u'', u''))
+        chunk.append((number, student, class_name, rows))
+        if len(chunk) == chunk_size:
+            yield chunk, options
+            chunk = []
+    if chunk:
+        yield chunk, options
+
+
+def report(sessions, path, roster=None, workers=1, chunk_size=200, columns=16, sheets=True, facts=10):
+    """
+    Write score sheets and class summaries for many sessions.
+    :param sessions: Iterable of session number and rows, e.g. from exported_sessions or recorded_sessions
+    :param path: Report file to write
+    :param roster: Optional dictionary of session number to tuple of student and class (see load_roster)
+    :param workers: Number of processes to lay out sheets and count answers with
+    :param chunk_size: Sessions per job handed to a worker
+    :param columns: Questions per row on the score sheets
+    :param sheets: Write a score sheet per session; False writes only the summaries
+    :param facts: Number of hardest facts to list per summary
+    :return: Dictionary of class name to Summary; the Summary of everyone is under EVERYONE and sessions that
+             aren't in a class are under ''
+    """
+    jobs = _chunks(sessions, roster or {}, chunk_size, dict(columns=columns, sheets=sheets))
+    pool = None
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        results = mathtest.imap_bounded(pool, _report_chunk, jobs, workers * 2)
+    else:
+        results = (_report_chunk(job) for job in jobs)
+
+    summaries = {}
+    temp_path = path + ".tmp"
+    try:
+        with io.open(temp_path, 'w', encoding='utf-8') as output:
+            for chunk_sheets, chunk_summaries in results:
+                output.write(chunk_sheets)
+                for class_name, summary in chunk_summaries.items():
+                    if class_name in summaries:
+                        summaries[class_name].merge(summary)
+                    else:
+                        summaries[class_name] = summary
+            everyone = Summary(EVERYONE)
+            for summary in summaries.values():
+                everyone.merge(summary)
+            class_names = sorted(name for name in summaries if name)
+            output.write(u"\n".join(
+                [u"#" * 80, u"Summaries", u"#" * 80, u""] +
+                [line for name in class_names for line in summaries[name].lines(facts)] +
+                everyone.lines(facts)) + u"\n")
+        os.replace(temp_path, path)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    summaries[EVERYONE] = everyone
+    return summaries
+
+
+def _sample_sessions(count, questions=25):
+    import random
+    rand = random.Random(1)
+    for number in range(count):
+        rows = []
+        for _ in range(questions):
+            question = mathtest.Question()
+            question.generate_rand_question()
+            luck = rand.random()
+            if luck < 0.8:
+                rows.append(("right", question.first_number, question.operator, question.second_number,
+                             question.correct_answer, rand.uniform(0.5, 10)))
+            elif luck < 0.95:
+                rows.append(("wrong", question.first_number, question.operator, question.second_number,
+                             question.correct_answer + 1, rand.uniform(0.5, 10)))
+            else:
+                rows.append(("skip", question.first_number, question.operator, question.second_number, None, None))
+        yield number, rows
+
+
+def benchmark(path, sessions=10000, workers=(1, 2, 4)):
+    """
+    Time reports of generated sessions with different numbers of workers.
+    """
+    sample = list(_sample_sessions(sessions))
+    roster = dict((number, (u"student{}".format(number), u"class{}".format(number % 40))) for number in range(sessions))
+    for worker_count in workers:
+        start = perf_counter()
+        report(sample, path, roster=roster, workers=worker_count)
+        elapsed = perf_counter() - start
+        print("{} workers: {} sessions in {:0.2f}s ({:0.0f}/s), {:0.1f} MB".format(
+            worker_count, sessions, elapsed, sessions / elapsed, os.path.getsize(path) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write score sheets and class summaries for many test sessions.")
+    parser.add_argument("sessions", nargs='?',
+                        help="Results CSV (mathtest.py --export) or recording (mathtest.py --record, .jsonl)")
+    parser.add_argument("output", help="Report file to write")
+    parser.add_argument("-r", "--roster", help="CSV with session, student and class columns.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Processes to build the report with. Default 1.")
+    parser.add_argument("--chunk-size", type=int, default=200, help="Sessions per job. Default 200.")
+    parser.add_argument("-c", "--columns", type=int, default=16, help="Questions per row. Default 16.")
+    parser.add_argument("--summary-only", action='store_true', help="Leave out the score sheets.")
+    parser.add_argument("--facts", type=int, default=10, help="Hardest facts listed per summary. Default 10.")
+    parser.add_argument("--json", help="Also save the per class accuracy and grades to this JSON file.")
+    parser.add_argument("--benchmark", type=int, metavar="SESSIONS",
+                        help="Time reports of this many generated sessions instead.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.output, args.benchmark)
+        return 0
+    if args.sessions is None:
+        parser.error("a sessions file is needed")
+    if os.path.splitext(args.sessions)[1].lower() in ('.jsonl', '.json'):
+        sessions = recorded_sessions(args.sessions)
+    else:
+        sessions = exported_sessions(args.sessions)
+    roster = load_roster(args.roster) if args.roster else None
+
+    start = perf_counter()
+    summaries = report(sessions, args.output, roster=roster, workers=args.workers, chunk_size=args.chunk_size,
+                       columns=args.columns, sheets=not args.summary_only, facts=args.facts)
+    elapsed = perf_counter() - start
+    if args.json:
+        with io.open(args.json, 'w', encoding='utf-8') as output:
+            output.write(unicode(json.dumps(dict(
+                (name, dict(sessions=summary.sessions,
+                            grades=dict(summary.grades),
+                            operators=dict((operator, dict(right=right, wrong=wrong, skip=skip, percentage=percentage))
+                                           for operator, right, wrong, skip, percentage
+                                           in summary.operator_accuracy())))
+                for name, summary in summaries.items() if name), sort_keys=True, indent=1)))
+    print("Reported {} sessions in {:0.2f}s.".format(summaries[EVERYONE].sessions, elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
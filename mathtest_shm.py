@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_shm.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Publish the fact table, answer key and a uniqueness bitset once so worker processes can attach without copying.
+
+The tables are stored in one block with a fixed layout, in the machine's native byte order because the answer key
+and facts are read through memoryview.cast (so a file from write_file only suits machines of the same byte order):
+
+    header      HEADER struct, see below
+    answer key  int32 per entry, the AnswerKey table
+    facts       three int16 per fact: first number, operator code, second number
+    used        one bit per fact, shared by every process that attaches
+
+The block can live in multiprocessing.shared_memory (Python 3.8+) or in a file that is mmap'd.
+"""
+import atexit
+import mmap
+import os
+import struct
+import sys
+
+import mathtest
+
+MAGIC = b"MTFT"
+VERSION = 1
+# magic, version, first limit, second limit, fact count,
+# answer key offset, answer key size, facts offset, used offset, used size
+HEADER = struct.Struct("=4sHHHIIIIII")
+FACT = struct.Struct("=hhh")  # native order and sizes, like the memoryview the facts are read through
+DEFAULT_OPERATORS = ["/", "*", "+", "-"]
+
+
+def _align(offset, size=8):
+    return (offset + size - 1) // size * size
+
+
+def build(valid_operators=None):
+    """
+    Build the tables for the given operators.
+    :param valid_operators: Operators in the fact table.  Default is all four.
+    :return: bytearray with the whole block
+    """
+    answer_key = mathtest.AnswerKey()
+    key_bytes = answer_key.tobytes()
+    facts = mathtest.Test()._fact_index(valid_operators=valid_operators or DEFAULT_OPERATORS)
+
+    key_offset = _align(HEADER.size)
+    facts_offset = _align(key_offset + len(key_bytes))
+    used_offset = _align(facts_offset + FACT.size * len(facts))
+    used_size = (len(facts) + 7) // 8
+
+    block = bytearray(used_offset + used_size)
+    HEADER.pack_into(block, 0, MAGIC, VERSION, answer_key.first_limit, answer_key.second_limit, len(facts),
+                     key_offset, len(key_bytes), facts_offset, used_offset, used_size)
+    block[key_offset:key_offset + len(key_bytes)] = key_bytes
+    for index, question in enumerate(facts):
+        FACT.pack_into(block, facts_offset + FACT.size * index, question.first_number,
+                       mathtest.operator_codes[question.operator], question.second_number)
+    return block
+
+
+class FactTables(object):
+    """
+    Read-only views of a block made by build.  Nothing is copied; the views point straight into the buffer.
+    """
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, version, first_limit, second_limit, fact_count, key_offset, key_size, facts_offset, used_offset, \
+            used_size = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a fact table block (version {})".format(VERSION))
+        self.buffer = buffer
+        self.answer_key = mathtest.AnswerKey.frombuffer(view[key_offset:key_offset + key_size],
+                                                        first_limit, second_limit)
+        self.facts = view[facts_offset:facts_offset + FACT.size * fact_count].cast('h')
+        self.used = view[used_offset:used_offset + used_size]
+        self.fact_count = fact_count
+
+    def __len__(self):
+        return self.fact_count
+
+    def fact(self, index):
+        """
+        :return: Tuple of first number, operator, second number
+        """
+        return self.facts[index * 3], mathtest.operator_symbols[self.facts[index * 3 + 1]], self.facts[index * 3 + 2]
+
+    def question(self, index, **kwargs):
+        """
+        Make a Question for one fact.
+        :param kwargs: Other keyword arguments for Question, e.g. valid_operators
+        """
+        first_number, operator, second_number = self.fact(index)
+        return mathtest.Question(first_number=first_number, operator=operator, second_number=second_number,
+                                 **kwargs)
+
+    def is_used(self, index):
+        return bool(self.used[index >> 3] & (1 << (index & 7)))
+
+    def mark_used(self, index):
+        """
+        Set the fact's bit in the shared uniqueness bitset.  Not atomic; give each worker its own facts to mark.
+        """
+        self.used[index >> 3] |= 1 << (index & 7)
+
+    def install(self):
+        """
+        Make mathtest use this answer key instead of building its own.
+        """
+        mathtest.answer_key = self.answer_key
+
+    def release(self):
+        """
+        Drop the views so the underlying shared memory or mmap can be closed.
+        """
+        self.answer_key.table.release()
+        self.facts.release()
+        self.used.release()
+
+
+def publish(valid_operators=None, name=None):
+    """
+    Build the tables into a new shared memory block.  Unlink it when every worker is done.
+    :return: Tuple of SharedMemory and FactTables; pass shared_memory.name to the workers
+    """
+    from multiprocessing import shared_memory
+    block = build(valid_operators)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=len(block))
+    shm.buf[:len(block)] = block
+    return shm, FactTables(shm.buf)
+
+
+def attach(name):
+    """
+    Attach to tables published by another process.  On Linux the block is mapped straight from /dev/shm: importing
+    multiprocessing.shared_memory costs each worker several MB of RSS, far more than the tables themselves.
+    :return: Tuple of SharedMemory (or mmap) and FactTables
+    """
+    path = os.path.join("/dev/shm", name.lstrip("/"))
+    if os.path.exists(path):
+        with open(path, "r+b") as block_file:
+            mapped = mmap.mmap(block_file.fileno(), 0)
+        return mapped, FactTables(mapped)
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, FactTables(shm.buf)
+
+
+def detach(shm, tables):
+    """
+    Release the views and close (but don't unlink) the shared memory or mmap from attach or publish.
+    """
+    tables.release()
+    shm.close()
+
+
+def write_file(path, valid_operators=None):
+    """
+    Save the tables to a file that can be opened with open_file.
+    """
+    with open(path, "wb") as output_file:
+        output_file.write(build(valid_operators))
+
+
+def open_file(path, writable=False):
+    """
+    mmap a file made by write_file.
+    :param writable: Map it writable so the uniqueness bitset can be updated
+    :return: FactTables
+    """
+    with open(path, "r+b" if writable else "rb") as input_file:
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    return FactTables(mapped)
+
+
+_worker_tables = None  # keeps the shared memory attached for the life of a worker
+_worker_baseline = 0  # RSS in KB before the worker set up its tables; see benchmark
+
+
+def init_worker(name):
+    """
+    Pool initializer: attach to published tables and install their answer key.
+    multiprocessing.Pool(initializer=init_worker, initargs=(shm.name,))
+    """
+    global _worker_tables
+    _worker_tables = attach(name)
+    _worker_tables[1].install()
+    atexit.register(detach, *_worker_tables)
+
+
+def _rss():
+    """
+    Current RSS in KB (the peak where /proc isn't available).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE // 1024
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _rebuild_worker():
+    """
+    Pool initializer for comparison: every worker builds its own tables.
+    """
+    global _worker_baseline
+    _worker_baseline = _rss()
+    mathtest._default_answer_key()
+    mathtest.Test()._fact_index(valid_operators=DEFAULT_OPERATORS)
+
+
+def _shared_worker(name):
+    global _worker_baseline
+    _worker_baseline = _rss()
+    init_worker(name)
+
+
+def _worker_report(_):
+    """
+    Grade every fact once.
+    :return: Tuple of this worker's RSS and how much it grew setting up and grading, in KB
+    """
+    total = 0
+    if _worker_tables is not None:
+        # straight from the shared facts; making Questions would intern a Fact per fact in every worker
+        tables = _worker_tables[1]
+        for index in range(len(tables)):
+            first_number, operator, second_number = tables.fact(index)
+            total += tables.answer_key.lookup(operator, first_number, second_number)
+    else:
+        for question in mathtest.Test()._fact_index(valid_operators=DEFAULT_OPERATORS):
+            total += question.correct_answer
+    rss = _rss()
+    return rss, rss - _worker_baseline
+
+
+def benchmark(workers=4):
+    """
+    Compare worker startup time and RSS between attaching to shared tables and rebuilding them in each worker.
+    Uses the spawn start method so workers don't inherit the parent's tables by forking.  RSS growth is counted from
+    when the worker starts setting up, after the interpreter and mathtest are loaded, which are the same either way.
+    """
+    import multiprocessing
+    from time import time
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    shm, tables = publish()
+    try:
+        for label, initializer, initargs in (("rebuild", _rebuild_worker, ()),
+                                             ("shared", _shared_worker, (shm.name,))):
+            start = time()
+            pool = context.Pool(workers, initializer=initializer, initargs=initargs)
+            reports = pool.map(_worker_report, range(workers), chunksize=1)
+            elapsed = time() - start
+            pool.close()
+            pool.join()
+            results[label] = (elapsed, max(rss for rss, _ in reports), max(growth for _, growth in reports))
+    finally:
+        detach(shm, tables)
+        shm.unlink()
+    for label, (elapsed, rss, growth) in sorted(results.items()):
+        print("{:<8} {} workers started and graded in {:0.3f}s, worker RSS {} KB ({} KB for the tables)".format(
+            label, workers, elapsed, rss, growth))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
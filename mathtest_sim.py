@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  mathtest_sim.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Load test the math test engine with simulated students.
+
+Every virtual student takes a whole Test.run (questions, scoring, skipped questions and review) with its own
+accuracy, skip rate, think time and random seed.  The report shows sessions per second, how long the engine
+took between an answer and the next prompt, and the peak memory used.
+"""
+import argparse
+import random
+import sys
+from time import sleep
+
+import mathtest
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    from time import perf_counter
+except ImportError:  # Python 2
+    from time import time as perf_counter
+
+
+class VirtualStudent(object):
+    """
+    The profile of one simulated student.
+    """
+    def __init__(self, seed, accuracy=0.8, skip_rate=0.05, think_time=2.0, review=True):
+        """
+        :param seed: Seed for the questions this student gets and the answers they give
+        :param accuracy: Chance of answering a question correctly
+        :param skip_rate: Chance of skipping a question
+        :param think_time: Average seconds spent on each answer
+        :param review: Whether the student agrees to review wrong answers
+        """
+        self.seed = seed
+        self.accuracy = accuracy
+        self.skip_rate = skip_rate
+        self.think_time = think_time
+        self.review = review
+
+    def __repr__(self):
+        return "VirtualStudent(seed={s.seed}, accuracy={s.accuracy:0.2f}, skip_rate={s.skip_rate:0.2f}, " \
+               "think_time={s.think_time:0.2f}, review={s.review})".format(s=self)
+
+
+def make_students(number, seed=0, accuracy=0.8, skip_rate=0.05, think_time=2.0, review=True):
+    """
+    Make a class of students whose profiles vary around the given averages.
+    :param number: Number of students
+    :param seed: Seed for the whole class; each student gets its own seed from this
+    :return: List of VirtualStudent
+    """
+    rand = random.Random(seed)
+    students = []
+    for _ in range(number):
+        students.append(VirtualStudent(
+            seed=rand.getrandbits(32),
+            accuracy=min(1.0, max(0.0, rand.gauss(accuracy, 0.1))),
+            skip_rate=min(1.0, max(0.0, rand.gauss(skip_rate, skip_rate / 2))),
+            think_time=max(0.0, rand.gauss(think_time, think_time / 4)),
+            review=review,
+        ))
+    return students
+
+
+def choose_answer(student, rand, prompt, correct_answer):
+    """
+    The answer a student gives to a prompt.
+    :param rand: The student's random.Random
+    :param correct_answer: Function returning the correct answer, only called if it's needed
+    :return: String
+    """
+    if prompt.endswith("(Y/N)>"):
+        return 'y' if student.review else 'n'
+    chance = rand.random()
+    if chance < student.skip_rate:
+        return ''
+    answer = correct_answer()
+    if chance < student.skip_rate + student.accuracy:
+        return str(answer)
+    return str(answer + rand.choice((-1, 1)))
+
+
+class StudentIO(mathtest.ConsoleIO):
+    """
+    Answer the questions of a Test the way a VirtualStudent would.
+    Output is thrown away; the time the engine spends between answers is kept in self.latencies.
+    """
+    def __init__(self, student, test, real_time=False, max_answers=None):
+        """
+        :param real_time: Actually wait the student's think time before answering
+        :param max_answers: Walk away (EOFError) after this many answers
+        """
+        self.student = student
+        self.test = test
+        self.real_time = real_time
+        self.max_answers = max_answers
+        self.random = random.Random(student.seed)
+        self.latencies = []
+        self.answers = 0
+        self.think_time = 0.0
+        self._answered_at = None
+
+    def write(self, text):
+        pass
+
+    def _answer(self, prompt):
+        return choose_answer(self.student, self.random, prompt, lambda: self.test.question.correct_answer)
+
+    def read_line(self, prompt='', timeout=None):
+        now = perf_counter()
+        if self._answered_at is not None:
+            self.latencies.append(now - self._answered_at)
+        if self.max_answers is not None and self.answers >= self.max_answers:
+            raise EOFError
+        answer = self._answer(prompt)
+        think_time = max(0.0, self.random.gauss(self.student.think_time, self.student.think_time / 4))
+        if timeout is not None and think_time > timeout:
+            answer, think_time = None, timeout  # too slow for a timed test
+        self.think_time += think_time
+        if self.real_time:
+            sleep(think_time)
+        self.answers += 1
+        self._answered_at = perf_counter()
+        return answer
+
+
+def run_session(student, real_time=False, **kwargs):
+    """
+    Put one student through a full test.
+    :param kwargs: keyword arguments to pass Test.run
+    :return: Dictionary with the grade, number of answers, engine latencies and whether the student walked away
+    """
+    kwargs = dict(kwargs)
+    random.seed(student.seed)  # the engine draws questions from the module random
+    test = mathtest.Test(**kwargs)
+    io = StudentIO(student, test, real_time=real_time, max_answers=kwargs.get("questions", 25) * 10)
+    kwargs["io"] = io
+    abandoned = False
+    try:
+        test.run(**kwargs)
+    except EOFError:
+        abandoned = True
+    return dict(grade=test.grade, answers=io.answers, latencies=io.latencies, abandoned=abandoned)
+
+
+def _run_sessions(args):
+    """
+    Run a group of sessions.  Used by the process pool, so it takes one argument.
+    """
+    students, real_time, kwargs = args
+    return [run_session(student, real_time=real_time, **kwargs) for student in students]
+
+
+_symbols = dict((glyph, chr(symbol)) for symbol, glyph in mathtest.operator_translation.items())
+_symbols[u"x"] = "*"
+
+
+def _prompt_answer(prompt):
+    """
+    The correct answer to a question prompt like "6 × 7 = ".
+    """
+    first_number, symbol, second_number = prompt.split(u'\n')[-1].split()[:3]
+    return mathtest.Fact(int(first_number), _symbols.get(symbol, symbol), int(second_number)).correct_answer
+
+
+async def _remote_session(student, address, real_time=False):
+    """
+    Put one student through a test on a mathtest_cluster server.
+    """
+    import asyncio
+    rand = random.Random(student.seed)
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write(u"student-{}\n".format(student.seed).encode('utf-8'))
+    latencies = []
+    answers = 0
+    text = u''
+    answered_at = None
+    abandoned = True
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            text += chunk.decode('utf-8')
+            if not (text.endswith(u"= ") or text.endswith(u"(Y/N)>")):
+                continue
+            if answered_at is not None:
+                latencies.append(perf_counter() - answered_at)
+            if answers >= 1000:
+                break  # something is wrong; walk away
+            answer = choose_answer(student, rand, text, lambda: _prompt_answer(text))
+            if real_time:
+                await asyncio.sleep(max(0.0, rand.gauss(student.think_time, student.think_time / 4)))
+            writer.write(answer.encode('utf-8') + b'\n')
+            answers += 1
+            answered_at = perf_counter()
+            text = u''
+        grade = 0.0
+        for line in text.split(u'\n'):
+            if line.startswith(u"Percentage:"):
+                grade = float(line.split()[1].rstrip(u'%'))
+                abandoned = False
+    except ConnectionError:
+        grade = 0.0
+    finally:
+        writer.close()
+    return dict(grade=grade, answers=answers, latencies=latencies, abandoned=abandoned)
+
+
+def _run_remote_sessions(args):
+    """
+    Run a group of sessions against a server, concurrency at a time.  Used by the process pool.
+    """
+    import asyncio
+    students, address, real_time, concurrency = args
+
+    async def run_all():
+        limit = asyncio.Semaphore(concurrency)
+
+        async def run_one(student):
+            async with limit:
+                return await _remote_session(student, address, real_time)
+        return await asyncio.gather(*[run_one(student) for student in students])
+
+    return asyncio.run(run_all())
+
+
+def peak_rss():
+    """
+    Peak resident memory in kilobytes of this process and of its finished child processes.
+    :return: Tuple of (self, children) or (None, None) if it can't be measured
+    """
+    if resource is None:
+        return None, None
+    scale = 1024 if sys.platform == 'darwin' else 1  # macOS reports bytes
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[int(round(percent / 100.0 * (len(sorted_values) - 1)))]
+
+
+def _run_chunks(function, chunks, workers):
+    """
+    Run function on every chunk, in a process pool if workers > 1.
+    :return: Tuple of the session results and the seconds it took
+    """
+    start = perf_counter()
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = [session for chunk in pool.imap_unordered(function, chunks) for session in chunk]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [session for chunk in chunks for session in function(chunk)]
+    return results, perf_counter() - start
+
+
+def simulate(students, workers=1, real_time=False, chunk_size=50, **kwargs):
+    """
+    Run every student through a test and measure the engine.
+    :param students: List of VirtualStudent
+    :param workers: Number of processes; 1 runs everything in this process
+    :param real_time: Wait each student's think time (only sensible with many workers)
+    :param kwargs: keyword arguments to pass Test.run
+    :return: Dictionary report
+    """
+    chunks = [(students[x:x + chunk_size], real_time, kwargs) for x in range(0, len(students), chunk_size)]
+    results, elapsed = _run_chunks(_run_sessions, chunks, workers)
+    return _report(results, elapsed)
+
+
+def simulate_remote(students, address, workers=1, concurrency=50, real_time=False, chunk_size=500):
+    """
+    Run every student through a test on a mathtest_cluster server and measure it.
+    The test settings are the server's.  Latency is from sending an answer to receiving the next prompt.
+    :param address: Tuple of host and port
+    :param workers: Number of client processes
+    :param concurrency: Students connected at once per client process
+    :return: Dictionary report like simulate
+    """
+    chunks = [(students[x:x + chunk_size], tuple(address), real_time, concurrency)
+              for x in range(0, len(students), chunk_size)]
+    results, elapsed = _run_chunks(_run_remote_sessions, chunks, workers)
+    return _report(results, elapsed)
+
+
+def _report(results, elapsed):
+    """
+    Summarize the session results of simulate or simulate_remote.
+    """
+    latencies = sorted(latency for session in results for latency in session["latencies"])
+    rss, children_rss = peak_rss()
+    return dict(
+        sessions=len(results),
+        seconds=elapsed,
+        sessions_per_second=len(results) / elapsed if elapsed > 0 else 0.0,
+        answers=sum(session["answers"] for session in results),
+        abandoned=sum(1 for session in results if session["abandoned"]),
+        average_grade=sum(session["grade"] for session in results) / len(results) if results else 0.0,
+        latency_p50=percentile(latencies, 50),
+        latency_p90=percentile(latencies, 90),
+        latency_p99=percentile(latencies, 99),
+        latency_max=latencies[-1] if latencies else 0.0,
+        peak_rss_kb=rss,
+        peak_child_rss_kb=children_rss,
+    )
+
+
+def report_string(report):
+    """
+    Format a report from simulate for the screen.
+    """
+    report_string = "Sessions:          {sessions} ({abandoned} walked away)\n"
+    report_string += "Answers:           {answers}\n"
+    report_string += "Average grade:     {average_grade:0.2f}%\n"
+    report_string += "Total time:        {seconds:0.3f}s\n"
+    report_string += "Sessions/second:   {sessions_per_second:0.1f}\n"
+    report_string += "Latency p50:       {p50:0.1f}us\n"
+    report_string += "Latency p90:       {p90:0.1f}us\n"
+    report_string += "Latency p99:       {p99:0.1f}us\n"
+    report_string += "Latency max:       {max:0.1f}us\n"
+    report_string += "Peak RSS:          {peak_rss_kb} KB (largest worker {peak_child_rss_kb} KB)\n"
+    return report_string.format(p50=report["latency_p50"] * 1e6, p90=report["latency_p90"] * 1e6,
+                                p99=report["latency_p99"] * 1e6, max=report["latency_max"] * 1e6, **report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the math test with simulated students.")
+    parser.add_argument("-n", "--students", type=int, default=1000, help="Number of students. Default 1000.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes. Default 1.")
+    parser.add_argument("-q", "--questions", type=int, default=25, help="Questions per test. Default 25.")
+    parser.add_argument("-o", "--operator", help="Type of questions ({}). No spaces if multiple.".format(
+                        ' '.join(mathtest.operators).replace('%', '%%')),
+                        metavar="OPERATOR or OPERATORS")
+    parser.add_argument("-u", "--unique", action='store_true', help="Only unique questions.")
+    parser.add_argument("--accuracy", type=float, default=0.8, help="Average accuracy. Default 0.8.")
+    parser.add_argument("--skip-rate", type=float, default=0.05, help="Average skip rate. Default 0.05.")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Average seconds per answer. Default 2.")
+    parser.add_argument("--real-time", action='store_true', help="Wait the think time before each answer.")
+    parser.add_argument("--no-review", action='store_true', help="Students decline to review wrong answers.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the class. Default 0.")
+    parser.add_argument("--server", metavar="HOST:PORT",
+                        help="Take the tests on a mathtest_cluster server instead of in this process. "
+                             "The server's settings are used.")
+    parser.add_argument("-c", "--concurrency", type=int, default=50,
+                        help="Students connected at once per process with --server. Default 50.")
+    args = parser.parse_args()
+
+    kwargs = dict(questions=args.questions, unique=args.unique)
+    if args.operator:
+        kwargs["valid_operators"] = [x for x in args.operator]
+    students = make_students(args.students, seed=args.seed, accuracy=args.accuracy, skip_rate=args.skip_rate,
+                             think_time=args.think_time, review=not args.no_review)
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        report = simulate_remote(students, (host or "127.0.0.1", int(port)), workers=args.workers,
+                                 concurrency=args.concurrency, real_time=args.real_time)
+    else:
+        report = simulate(students, workers=args.workers, real_time=args.real_time, **kwargs)
+    print(report_string(report))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
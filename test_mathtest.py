@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  test_mathtest.py
+#
+#  Copyright 2017  <tjohnsen@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""
+Command line tests: python -m unittest test_mathtest
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_mathtest(arguments, answers):
+    """
+    Run mathtest.py with the answers typed in.
+    :return: Everything it printed
+    """
+    process = subprocess.run([sys.executable, os.path.join(HERE, "mathtest.py")] + arguments,
+                             input=u''.join(answer + u'\n' for answer in answers), stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True, timeout=60)
+    return process.returncode, process.stdout
+
+
+def final_counts(output):
+    """
+    The numbers under the headings of the last scoreboard printed.
+    """
+    lines = output.splitlines()
+    last = max(number for number, line in enumerate(lines) if line.split() and set(line.split()) == {'-----'})
+    return [int(count) for count in lines[last + 1].split()]
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_modulo(self):
+        returncode, output = run_mathtest(["-o", "%", "-q", "3"], ["0", "0", "0", "n"])
+        self.assertEqual(returncode, 0, output)
+        self.assertEqual(sum(final_counts(output)), 3, output)
+
+    def test_power_with_max_answer(self):
+        returncode, output = run_mathtest(["-o", "^", "--max-answer", "5", "-q", "2"], ["0", "0", "n"])
+        self.assertEqual(returncode, 0, output)
+        self.assertEqual(sum(final_counts(output)), 2, output)
+
+    def test_timed_bank_skips_the_rows_not_reached(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        bank = os.path.join(directory, "bank.csv")
+        with open(bank, 'w') as bank_file:
+            bank_file.write("first_number,operator,second_number\n")
+            for number in range(1, 6):
+                bank_file.write("{0},+,{0}\n".format(number))
+        returncode, output = run_mathtest(["-q", "5", "-t", "30", "--bank", bank], ["2", "4"])
+        self.assertEqual(returncode, 0, output)
+        skipped = output.split("Skipped:")[-1].split()
+        self.assertEqual(skipped[:3], ["3", "4", "5"], output)
+
+
+if __name__ == '__main__':
+    unittest.main()